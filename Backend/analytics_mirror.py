@@ -0,0 +1,366 @@
+# analytics_mirror.py
+
+"""
+This file keeps a local SQLite copy of the 'shifts', 'attendance' and
+'payroll_approvals' collections for historical reporting.
+
+Questions such as hours per month per location, attendance trends or past pay
+periods used to need a scan of a whole Firestore collection each time. The mirror
+answers them from indexed SQLite tables instead.
+
+Syncing is incremental. Every writer stamps documents with
+updated_at = SERVER_TIMESTAMP, and each sync only reads the documents whose
+updated_at is newer than the collection's watermark (less a small overlap, because
+server timestamps are assigned at commit time). The first sync, and the nightly full
+resync, read the whole collection and replace the table, which also picks up
+documents deleted elsewhere and older documents without updated_at. Months moved to
+cold storage (see cold_storage.py) are loaded from their archive files.
+
+The database lives at ANALYTICS_DB_PATH (default analytics.sqlite3 next to this file).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from firebase_config import db
+import cold_storage
+from logging_google_sheets import get_pay_period_dates
+from metrics import inc
+
+load_dotenv()
+
+DB_PATH = os.getenv("ANALYTICS_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "analytics.sqlite3"))
+# Reports first catch up with Firestore if the last sync is older than this.
+MAX_STALE_SECONDS = float(os.getenv("ANALYTICS_MAX_STALE_SECONDS", "300"))
+# Documents committed this long before the watermark are read again, in case their
+# server timestamp is older than a document that was already synced.
+WATERMARK_OVERLAP = timedelta(seconds=60)
+PAGE_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shifts (
+    id TEXT PRIMARY KEY,
+    event TEXT,
+    user_id TEXT,
+    timestamp TEXT,
+    location TEXT,
+    role TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS shifts_location_timestamp ON shifts (location, timestamp);
+CREATE INDEX IF NOT EXISTS shifts_user_timestamp ON shifts (user_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS attendance_days (
+    id TEXT PRIMARY KEY,
+    location TEXT,
+    date TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS attendance_days_location_date ON attendance_days (location, date);
+CREATE INDEX IF NOT EXISTS attendance_days_date ON attendance_days (date);
+
+CREATE TABLE IF NOT EXISTS attendance_marks (
+    day_id TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    status TEXT,
+    timestamp TEXT,
+    last_edited TEXT,
+    PRIMARY KEY (day_id, student_id)
+);
+
+CREATE TABLE IF NOT EXISTS payroll_approvals (
+    id TEXT PRIMARY KEY,
+    location TEXT,
+    pay_period_id TEXT,
+    status TEXT,
+    approved_at TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS payroll_approvals_approved_at ON payroll_approvals (approved_at);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    collection TEXT PRIMARY KEY,
+    watermark TEXT,
+    last_synced_at REAL,
+    documents INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def _iso(value):
+    """Firestore timestamps come back as datetimes; everything is stored as ISO text."""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _store_shift(conn, doc_id, data):
+    conn.execute(
+        "INSERT OR REPLACE INTO shifts (id, event, user_id, timestamp, location, role, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (doc_id, data.get("event"), data.get("user_id"), _iso(data.get("timestamp")), data.get("location"),
+         data.get("role"), _iso(data.get("updated_at"))))
+
+
+def _store_attendance(conn, doc_id, data):
+    conn.execute("INSERT OR REPLACE INTO attendance_days (id, location, date, updated_at) VALUES (?, ?, ?, ?)",
+                 (doc_id, data.get("location"), data.get("date"), _iso(data.get("updated_at"))))
+    conn.execute("DELETE FROM attendance_marks WHERE day_id = ?", (doc_id,))
+    # The first mark of a day is stored under 'student_id' by take_attendance, later
+    # ones under 'student'; both are student ID -> mark maps.
+    students = {**(data.get("student_id") or {}), **(data.get("student") or {})}
+    conn.executemany(
+        "INSERT INTO attendance_marks (day_id, student_id, status, timestamp, last_edited) VALUES (?, ?, ?, ?, ?)",
+        [(doc_id, student_id, mark.get("status"), _iso(mark.get("timestamp")), _iso(mark.get("last_edited")))
+         for student_id, mark in students.items() if isinstance(mark, dict)])
+
+
+def _store_payroll_approval(conn, doc_id, data):
+    conn.execute(
+        "INSERT OR REPLACE INTO payroll_approvals (id, location, pay_period_id, status, approved_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (doc_id, data.get("location"), data.get("pay_period_id"), data.get("status"), _iso(data.get("approved_at")),
+         _iso(data.get("updated_at"))))
+
+
+# collection: (function storing one document, tables holding its documents)
+COLLECTIONS = {
+    "shifts": (_store_shift, ("shifts",)),
+    "attendance": (_store_attendance, ("attendance_days", "attendance_marks")),
+    "payroll_approvals": (_store_payroll_approval, ("payroll_approvals",)),
+}
+
+
+class AnalyticsMirror:
+    """A SQLite mirror of the reporting collections, synced from Firestore by watermark."""
+
+    def __init__(self, db_path=DB_PATH):
+        self._db_path = db_path
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so each thread has its own.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _state(self, collection):
+        row = self._connection().execute("SELECT * FROM sync_state WHERE collection = ?", (collection,)).fetchone()
+        return dict(row) if row else None
+
+    def sync(self, full=False):
+        """
+        Brings every mirrored collection up to date with Firestore.
+
+        Args:
+            full (bool): Re-read the whole collections instead of only changed documents.
+
+        Returns:
+            dict: The number of documents read per collection.
+        """
+        with self._sync_lock:
+            return {collection: self._sync_collection(collection, full) for collection in COLLECTIONS}
+
+    def _sync_collection(self, collection, full):
+        store, tables = COLLECTIONS[collection]
+        state = self._state(collection)
+        started = datetime.now(timezone.utc)
+        conn = self._connection()
+
+        if full or state is None or state["watermark"] is None:
+            # Read everything and replace the tables in one transaction, so readers never
+            # see a half-loaded mirror. Writes made during the scan are newer than
+            # `started` and are picked up again by the next incremental sync.
+            docs = cold_storage.archived_documents(collection) if collection in cold_storage.COLLECTIONS else []
+            docs += [(doc.id, doc.to_dict() or {}) for doc in db.collection(collection).stream()]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in tables:
+                    conn.execute(f"DELETE FROM {table}")
+                for doc_id, data in docs:
+                    store(conn, doc_id, data)
+                self._save_state(conn, collection, (started - WATERMARK_OVERLAP).isoformat(), len(docs), replace=True)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            inc("analytics_mirror_documents_total", {"collection": collection, "mode": "full"}, len(docs))
+            return len(docs)
+
+        watermark = datetime.fromisoformat(state["watermark"])
+        newest = watermark
+        read = 0
+        query = (db.collection(collection).where("updated_at", ">", watermark - WATERMARK_OVERLAP)
+                 .order_by("updated_at").limit(PAGE_SIZE))
+        last = None
+        while True:
+            page = list((query.start_after(last) if last is not None else query).stream())
+            if not page:
+                break
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for doc in page:
+                    data = doc.to_dict() or {}
+                    store(conn, doc.id, data)
+                    if isinstance(data.get("updated_at"), datetime):
+                        newest = max(newest, data["updated_at"])
+                read += len(page)
+                self._save_state(conn, collection, newest.isoformat(), len(page))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if len(page) < PAGE_SIZE:
+                break
+            last = page[-1]
+
+        if not read:
+            conn.execute("UPDATE sync_state SET last_synced_at = ? WHERE collection = ?", (time.time(), collection))
+        inc("analytics_mirror_documents_total", {"collection": collection, "mode": "incremental"}, read)
+        return read
+
+    def _save_state(self, conn, collection, watermark, documents, replace=False):
+        if replace:
+            conn.execute("INSERT OR REPLACE INTO sync_state (collection, watermark, last_synced_at, documents) "
+                         "VALUES (?, ?, ?, ?)", (collection, watermark, time.time(), documents))
+        else:
+            conn.execute("UPDATE sync_state SET watermark = ?, last_synced_at = ?, documents = documents + ? "
+                         "WHERE collection = ?", (watermark, time.time(), documents, collection))
+
+    def ensure_fresh(self, max_stale=MAX_STALE_SECONDS):
+        """Runs an incremental sync if any collection was last synced more than max_stale seconds ago."""
+        states = [self._state(collection) for collection in COLLECTIONS]
+        if any(state is None or time.time() - (state["last_synced_at"] or 0) > max_stale for state in states):
+            self.sync()
+
+    def forget(self, collection, doc_ids):
+        """Removes documents that were just deleted in Firestore from the mirror."""
+        _, tables = COLLECTIONS[collection]
+        conn = self._connection()
+        for doc_id in doc_ids:
+            if collection == "attendance":
+                conn.execute("DELETE FROM attendance_marks WHERE day_id = ?", (doc_id,))
+            conn.execute(f"DELETE FROM {tables[0]} WHERE id = ?", (doc_id,))
+
+    def status(self):
+        """Returns the watermark, last sync time and document count of each collection."""
+        rows = self._connection().execute("SELECT * FROM sync_state ORDER BY collection").fetchall()
+        return [{**dict(row), "last_synced_at": datetime.fromtimestamp(row["last_synced_at"]).isoformat()
+                 if row["last_synced_at"] else None} for row in rows]
+
+    def hours_report(self, start_date, end_date, location=None, group_by="month", by_user=False):
+        """
+        Adds up hours worked between two dates, pairing each clock-in with the next
+        clock-out of the same user at the same location (as the 15-day summary does).
+
+        Args:
+            start_date (date): First day of the range.
+            end_date (date): Last day of the range.
+            location (str, optional): Only this location.
+            group_by (str): "day", "month" or "pay_period"; shifts count towards the
+                period their clock-in falls in.
+            by_user (bool): Break the totals down per user.
+
+        Returns:
+            list: {"location", "period", ["user_id",] "hours", "shifts"} dicts.
+        """
+        sql = ("SELECT location, user_id, event, timestamp FROM shifts WHERE timestamp >= ? AND timestamp <= ?"
+               + (" AND location = ?" if location else "") + " ORDER BY location, user_id, timestamp")
+        params = [datetime.combine(start_date, datetime.min.time()).isoformat(),
+                  datetime.combine(end_date, datetime.max.time()).isoformat()] + ([location] if location else [])
+
+        totals = {}
+        clock_in = None
+        current = None
+        for row in self._connection().execute(sql, params):
+            if (row["location"], row["user_id"]) != current:
+                current = (row["location"], row["user_id"])
+                clock_in = None
+            event_time = datetime.fromisoformat(row["timestamp"])
+            if row["event"] == "clock-in":
+                clock_in = event_time
+            elif row["event"] == "clock-out" and clock_in:
+                key = (row["location"], _period(clock_in.date(), group_by)) + ((row["user_id"],) if by_user else ())
+                seconds, shifts = totals.get(key, (0.0, 0))
+                totals[key] = (seconds + (event_time - clock_in).total_seconds(), shifts + 1)
+                clock_in = None
+
+        report = []
+        for key in sorted(totals):
+            seconds, shifts = totals[key]
+            entry = {"location": key[0], "period": key[1], "hours": round(seconds / 3600, 2), "shifts": shifts}
+            if by_user:
+                entry["user_id"] = key[2]
+            report.append(entry)
+        return report
+
+    def attendance_report(self, start_date, end_date, location=None, group_by="month"):
+        """
+        Counts students marked present between two dates.
+
+        Returns:
+            list: {"location", "period", "present", "days", "average_present"} dicts, where
+            days is the number of days with an attendance record.
+        """
+        period = "d.date" if group_by == "day" else "substr(d.date, 1, 7)"
+        sql = (f"SELECT d.location AS location, {period} AS period, COUNT(DISTINCT d.id) AS days, "
+               "COALESCE(SUM(m.status = 'present'), 0) AS present "
+               "FROM attendance_days d LEFT JOIN attendance_marks m ON m.day_id = d.id "
+               "WHERE d.date >= ? AND d.date <= ?" + (" AND d.location = ?" if location else "")
+               + " GROUP BY d.location, period ORDER BY d.location, period")
+        params = [start_date.isoformat(), end_date.isoformat()] + ([location] if location else [])
+        return [{**dict(row), "average_present": round(row["present"] / row["days"], 2) if row["days"] else 0}
+                for row in self._connection().execute(sql, params)]
+
+    def payroll_approvals(self, start_date=None, end_date=None, location=None):
+        """Returns the payroll approvals recorded between two dates, newest first."""
+        clauses, params = [], []
+        if start_date:
+            clauses.append("approved_at >= ?")
+            params.append(start_date.isoformat())
+        if end_date:
+            clauses.append("approved_at < ?")
+            params.append((end_date + timedelta(days=1)).isoformat())
+        if location:
+            clauses.append("location = ?")
+            params.append(location)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connection().execute(
+            f"SELECT id, location, pay_period_id, status, approved_at FROM payroll_approvals{where} "
+            "ORDER BY approved_at DESC", params)
+        return [dict(row) for row in rows]
+
+
+def _period(day, group_by):
+    if group_by == "day":
+        return day.isoformat()
+    if group_by == "pay_period":
+        start_date, end_date = get_pay_period_dates(day)
+        return f"{start_date.isoformat()} to {end_date.isoformat()}"
+    return day.strftime("%Y-%m")
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror():
+    """Returns the process-wide analytics mirror, creating its database on first use."""
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None:
+            _mirror = AnalyticsMirror()
+        return _mirror
+
+
+def forget(collection, doc_ids):
+    """Drops documents deleted in Firestore from the mirror, if there is one on this machine."""
+    if _mirror is not None or os.path.exists(DB_PATH):
+        get_mirror().forget(collection, doc_ids)
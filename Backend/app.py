@@ -1,15 +1,20 @@
 import os
 from dotenv import load_dotenv 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 import requests
 import smtplib
 import ssl
 from email.message import EmailMessage
 from firebase_admin import auth, exceptions as firebase_exceptions
+# Set up logging before the imports below, which log while they load.
+import structured_logging
+structured_logging.setup()
 from locations import locations
 from clock_in_out import get_location_roster, clock_in, clock_out
-from logging_google_sheets import update_spreadsheet, generate_15_day_location_summary, cleanup_old_sheets
+from ingest_journal import get_journal, journal_status
+from logging_google_sheets import update_spreadsheet, generate_15_day_location_summary, cleanup_old_sheets, precreate_period_tabs
+from workbook_routing import all_workbooks
 from firebase_config import db  
 from datetime import datetime
 from firebase_admin import firestore
@@ -17,22 +22,47 @@ from attendance import get_student_list, take_attendance, edit_attendance, atten
 from attendance_google_sheet import micro_attendance, macro_attendance
 from edit_work_hours import app as edit_work_hours_app
 from online_tutoring import delete_online_session, add_tutor_to_session
+from batch_sync import process_event_batch
 from online_sessions import create_online_session, delete_online_session, edit_online_session, add_tutor, remove_tutor, get_all_online_sessions
 import logging
-
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+import metrics
+import firestore_instrumentation
+import job_queue
+import periodic_tasks
+import analytics_mirror
+import cold_storage
+import delta_sync
+import static_frontend
+import tracing
+import profiling
+from single_flight import coalesce
+from request_auth import admin_uid
+import json
+from user_import import build_user_profile, parse_rows, import_id_for, import_users
+import user_lifecycle
+from periodic_tasks import previous_month
+from metrics import track_call
+
+# Logging is set up by structured_logging.setup() above
 logger = logging.getLogger(__name__)
 logger.info("Application started")
-logger.warning("This is a warning")
-logger.error("An error occurred")
 
 # Load environment variables from .env file
 load_dotenv()
 FIREBASE_API_KEY = os.getenv('FIREBASE_API_KEY')
 
-app = Flask(__name__)
+# No static folder: /static/ belongs to the React build (see static_frontend.py).
+app = Flask(__name__, static_folder=None)
 CORS(app)
+# First, so the request span encloses everything the other hooks do.
+tracing.init_app(app)
+# Admins can profile a request (and the job it queues) with X-Profile: sample.
+profiling.init_app(app)
+structured_logging.init_app(app)
+metrics.init_app(app)
+firestore_instrumentation.init_app(app)
+# With SERVE_FRONTEND=true the React build is served from here too (API routes take precedence).
+static_frontend.init_app(app)
 
 # Register the routes from edit_work_hours.py
 app.register_blueprint(edit_work_hours_app, url_prefix='/work_hours')
@@ -41,6 +71,10 @@ app.register_blueprint(edit_work_hours_app, url_prefix='/work_hours')
 
 @app.route('/')
 def home():
+    # The React app's index.html when the backend serves the frontend build.
+    index = static_frontend.index()
+    if index is not None:
+        return index
     return "Welcome to the House of Wisdom Tutoring App Backend!"
 
 @app.route('/register', methods=['POST'])
@@ -70,31 +104,8 @@ def register_user():
         auth.set_custom_user_claims(user.uid, {'role': role})
 
         # --- This section now implements your DB Schema ---
-        user_data = {
-            'email': email,
-            'firstName': firstName,
-            'lastName': lastName,
-            'role': role,
-            'created_at': firestore.SERVER_TIMESTAMP
-        }
-
-        if role == 'student':
-            user_data.update({
-                'gradeLevel': data.get('gradeLevel', None),
-                'parentContact': data.get('parentContact', ''),
-                'tutoringLocation': [],
-                'topics': []
-            })
-        elif role == 'tutor':
-            user_data.update({
-                'googleMeetsLink': '',
-                'tutoringLocation': [],
-                'topics': []
-            })
-        elif role in ['seniorProjectManager', 'juniorProjectManager']:
-            user_data.update({
-                'tutoringLocation': [],
-            })
+        # Locations are assigned later through /update_profile.
+        user_data = build_user_profile(email, firstName, lastName, role, {**data, 'tutoringLocation': []})
         
         # Create the document in Firestore
         db.collection('users').document(user.uid).set(user_data)
@@ -150,7 +161,7 @@ def forgot_password():
         em.set_content(body)
 
         context = ssl.create_default_context()
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465, context=context) as smtp:
+        with track_call('smtp', 'send'), smtplib.SMTP_SSL('smtp.gmail.com', 465, context=context) as smtp:
             smtp.login(email_sender, email_password)
             smtp.sendmail(email_sender, email_receiver, em.as_string())
 
@@ -159,7 +170,7 @@ def forgot_password():
     except auth.UserNotFoundError:
         return jsonify({"message": "If your email is registered, you will receive a password reset link."}), 200
     except Exception as e:
-        print(f"Error in forgot_password: {e}")
+        logger.error(f"Error in forgot_password: {e}")
         return jsonify({"error": "An error occurred while trying to reset the password."}), 500
 
 @app.route('/login', methods=['POST'])
@@ -184,7 +195,8 @@ def login_user():
            "password": password,
            "returnSecureToken": True
        }
-       response = requests.post(url, json=payload)
+       with track_call('identity_toolkit', 'signInWithPassword'):
+           response = requests.post(url, json=payload)
        
        if response.status_code != 200:
            return jsonify({"error": "Invalid email or password"}), 401
@@ -242,6 +254,7 @@ def update_user_profile(uid):
         if not update_data:
             return jsonify({"message": "No valid profile fields to update"}), 200
 
+        update_data['updated_at'] = firestore.SERVER_TIMESTAMP
         user_ref.update(update_data)
         return jsonify({"message": f"Profile for {uid} updated successfully"}), 200
     except firebase_exceptions.FirebaseError as e:
@@ -252,6 +265,7 @@ def update_user_profile(uid):
 # --- Clock-in/out System Routes ---
 
 @app.route('/roster/<location>', methods=['GET'])
+@coalesce
 def get_roster(location):
     try: 
         roster = get_location_roster(location)
@@ -298,6 +312,17 @@ def handle_clock_out():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
+@app.route('/clock/journal/status', methods=['GET'])
+def get_clock_journal_status():
+    """
+    Reports how many journaled clock events are still waiting to be written to Firestore
+    and how far behind the oldest one is.
+    """
+    try:
+        return jsonify(journal_status()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/work_hours', methods=['GET'])
 def get_work_hours():
     user_id = request.args.get('user_id')
@@ -316,14 +341,124 @@ def get_work_hours():
 def work_hours_health():
     return jsonify({"status": "Work Hours API is running"}), 200
 
+# --- Background Jobs ---
+# Report generation, payroll approval and cleanup can take minutes, longer than
+# clients and proxies wait for a response, so these routes queue a job and return
+# 202 with its ID. GET /jobs/<job_id> reports its status, progress and result.
+
+def _queue_job(kind, params=None):
+    job, created = job_queue.submit(kind, params)
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "deduplicated": not created,
+        "status_url": f"/jobs/{job['id']}"
+    }), 202
+
+@job_queue.job("15_day_summary")
+def _run_15_day_summary(params, job):
+    return generate_15_day_location_summary(params["location"])
+
+@job_queue.job("micro_attendance")
+def _run_micro_attendance(params, job):
+    result = micro_attendance(params["google_sheet_name"], params["location"])
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+@job_queue.job("macro_attendance")
+def _run_macro_attendance(params, job):
+    return macro_attendance(params.get("report_month"))
+
+# These send emails, so a run interrupted by a crash is not started again.
+@job_queue.job("payroll_approval", retry_interrupted=False)
+def _run_payroll_approval(params, job):
+    result = handle_payroll_approval(params["location"], params["role"], params.get("locations") or [])
+    if result.get("status") != "success":
+        raise RuntimeError(result.get("message") or "Payroll approval failed")
+    return result
+
+@job_queue.job("payroll_final_email", retry_interrupted=False)
+def _run_payroll_final_email(params, job):
+    result = send_final_approval_email()
+    if result.get("status") != "success":
+        raise RuntimeError(result["message"])
+    return result
+
+@job_queue.job("precreate_period_tabs")
+def _run_precreate_period_tabs(params, job):
+    return precreate_period_tabs(datetime.strptime(params["period_start"], "%Y-%m-%d").date())
+
+@job_queue.job("sheet_cleanup")
+def _run_sheet_cleanup(params, job):
+    workbooks = [(name, sheet_type) for sheet_type in ("log", "summary") for name in all_workbooks(sheet_type)]
+    for i, (workbook_name, sheet_type) in enumerate(workbooks):
+        job.progress(i / len(workbooks), f"Cleaning up {workbook_name}")
+        cleanup_old_sheets(workbook_name, sheet_type=sheet_type)
+    return {"message": "Old sheets cleaned up successfully.", "workbooks": [name for name, _ in workbooks]}
+
+@job_queue.job("analytics_sync")
+def _run_analytics_sync(params, job):
+    return {"documents": analytics_mirror.get_mirror().sync(full=params.get("full", False))}
+
+@job_queue.job("users_deactivate")
+def _run_users_deactivate(params, job):
+    return user_lifecycle.deactivate_users(params["uids"], progress=job.progress)
+
+@job_queue.job("users_delete")
+def _run_users_delete(params, job):
+    return user_lifecycle.delete_users(params["uids"], progress=job.progress)
+
+@job_queue.job("users_reassign_location")
+def _run_users_reassign_location(params, job):
+    return user_lifecycle.reassign_location(params["uids"], params.get("add"), params.get("remove"),
+                                            progress=job.progress)
+
+@job_queue.job("archive_closed_periods")
+def _run_archive_closed_periods(params, job):
+    return cold_storage.archive_closed_periods(progress=job.progress)
+
+@job_queue.job("purge_tombstones")
+def _run_purge_tombstones(params, job):
+    return delta_sync.purge_tombstones()
+
+# Pay-period boundaries, nightly cleanup and overnight summaries (see periodic_tasks.py).
+periodic_tasks.start()
+# Replay clock events left uncommitted by the last shutdown now, not at the next clock-in.
+get_journal()
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """
+    Returns a background job's status ("queued", "running", "succeeded" or "failed"),
+    progress (0 to 1), latest message, and its result or error once it has finished.
+    """
+    try:
+        job = job_queue.get_job(job_id)
+        if job is None:
+            return jsonify({"error": "Job not found."}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    Lists recent background jobs, newest first. Optional query parameters: status, limit.
+    """
+    try:
+        limit = min(request.args.get('limit', 50, type=int), 500)
+        return jsonify(job_queue.list_jobs(request.args.get('status'), limit)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 #15 Day Summary Route
 @app.route('/15_day_summary/<location>', methods = ['POST'])
 def handle_15_day_summary(location):
-    """ Generates a 15-day summary report for a specific location.
+    """ Queues a job that generates a 15-day summary report for a specific location.
     """
     try:
-        result = generate_15_day_location_summary(location)
-        return jsonify(result), 200
+        return _queue_job("15_day_summary", {"location": location})
     except Exception as e:
         return jsonify({"error" : f"failed to generate summary for {location}: {str(e)}"}), 500
      
@@ -331,6 +466,7 @@ def handle_15_day_summary(location):
 
 #Retrieves a list of all students registered at a specific tutoring location
 @app.route('/attendance/students/<location>', methods=['GET'])
+@coalesce
 def handle_get_student_list(location):
     """
     Retrieves a list of all students registered at a specific tutoring location.
@@ -388,6 +524,7 @@ def handle_edit_attendance():
     
 #Handles the count of present students at a location 
 @app.route('/attendance/count/<location>', methods=['GET'])
+@coalesce
 def handle_attendance_count(location):   
     """
     Endpoint to get the count of present students at a location for the current day.
@@ -400,6 +537,34 @@ def handle_attendance_count(location):
     except Exception as e:
         return jsonify({"error": str(e)}), 500  
     
+#Handles buffered events uploaded by a kiosk that was offline
+@app.route('/sync/batch', methods=['POST'])
+def handle_batch_sync():
+    """
+    Endpoint for the Senior PM's device to upload buffered clock-in/out events and
+    attendance marks in a single request.
+    Expected JSON body:
+    {
+        "events": [
+            {"event_id": "uuid", "type": "clock-in", "client_timestamp": "2025-08-01T15:02:11-07:00",
+             "location": "Everett", "user_id": "uid", "role": "tutor"},
+            {"event_id": "uuid", "type": "attendance", "client_timestamp": "2025-08-01T15:10:00-07:00",
+             "location": "Everett", "student_id": "uid", "status": "present"}
+        ]
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    events = data.get('events')
+
+    if not isinstance(events, list):
+        return jsonify({"error": "events must be a list"}), 400
+
+    try:
+        result = process_event_batch(events)
+        return jsonify(result), 200 if "error" not in result else 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # --- Admin Routes ---
 from payroll_validation import handle_payroll_approval 
 
@@ -407,13 +572,20 @@ from payroll_validation import handle_payroll_approval
 def admin_payroll_approve(): 
     """
     Endpoint to approve payroll for a specific location and pay period.
+    Expects JSON: {"location": "...", "role": "...", "locations": [...]} where role and
+    locations are the approving user's; a Senior PM may only approve their own locations.
+    Queues a background job; poll /jobs/<job_id> for the outcome.
     """
-    data = request.get_json()
+    data = request.get_json() or {}
     location = data.get('location')
-    if not location:
-        return jsonify({"error": "location is required"}), 400
-    result = handle_payroll_approval(location)
-    return jsonify(result), 200 if result.get("status") == "success" else 500
+    role = data.get('role')
+    if not location or not role:
+        return jsonify({"error": "location and role are required"}), 400
+    try:
+        return _queue_job("payroll_approval", {"location": location, "role": role,
+                                               "locations": data.get('locations') or []})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 from payroll_validation import handle_payroll_approval, send_final_approval_email
 
@@ -421,10 +593,10 @@ from payroll_validation import handle_payroll_approval, send_final_approval_emai
 def trigger_final_payroll_email():
     """
     Manually triggers the final payroll email to all admins after all locations are approved.
+    Queues a background job; poll /jobs/<job_id> for the outcome.
     """
     try:
-        send_final_approval_email()
-        return jsonify({"message": "Final payroll email sent."}), 200
+        return _queue_job("payroll_final_email")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -443,15 +615,14 @@ def admin_payroll_approval_summary():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-from logging_google_sheets import cleanup_old_sheets
 @app.route('/payroll/cleanup', methods=['POST'])
 def admin_cleanup_sheets():
     """
     Endpoint to clean up old Google Sheets for payroll.
+    Queues a background job that cleans up every location's log and summary workbook.
     """
     try:
-        cleanup_old_sheets()
-        return jsonify({"message": "Old sheets cleaned up successfully."}), 200
+        return _queue_job("sheet_cleanup")
     except Exception as e:
         return jsonify({"error": str(e)}), 500 
 
@@ -473,8 +644,7 @@ def handle_micro_attendance():
         return jsonify({"error": "google_sheet_name and location are required"}), 400
 
     try:
-        micro_attendance(google_sheet_name, location)
-        return jsonify({"message": f"Micro attendance logged successfully for {location}."}), 200
+        return _queue_job("micro_attendance", {"google_sheet_name": google_sheet_name, "location": location})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -482,15 +652,127 @@ def handle_micro_attendance():
 def handle_macro_attendance():
     """
     Endpoint to trigger monthly attendance summary logging.
-    Only works if today is the 1st of the month.
+    Only works if today is the 1st of the month, unless the JSON body names the
+    month to report on as {"report_month": "YYYY-MM"}.
     """
     try:
-        today = datetime.now()
-        if today.day != 1:
-            return jsonify({"message": "Macro attendance reports are only generated on the 1st day of each month."}), 400
+        data = request.get_json(silent=True) or {}
+        report_month = data.get('report_month')
+        if report_month:
+            try:
+                datetime.strptime(report_month, "%Y-%m")
+            except ValueError:
+                return jsonify({"error": "report_month must look like YYYY-MM"}), 400
+        else:
+            today = datetime.now()
+            if today.day != 1:
+                return jsonify({"message": "Macro attendance reports are only generated on the 1st day of each month."}), 400
+            report_month = previous_month(today.date())
         
-        macro_attendance()
-        return jsonify({"message": "Macro attendance report generated successfully."}), 200
+        return _queue_job("macro_attendance", {"report_month": report_month})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/users/import', methods=['POST'])
+def bulk_import_users():
+    """
+    Creates many users from a CSV or JSON file, in chunks of 500. Admins only: send
+    the admin's Firebase ID token as "Authorization: Bearer <token>". Rows whose email
+    already has an account are reported as errors unless ?update_existing=true is
+    given, which overwrites those accounts.
+    Upload the file as multipart field "file" or send it as the request body;
+    the format comes from ?format=csv|json, the file extension or the content type.
+    Columns: email, password, firstName, lastName, role, and optionally gradeLevel,
+    parentContact and tutoringLocation (";"-separated in CSV).
+
+    The response is newline-delimited JSON with one result per row as it is
+    processed, then a summary. Re-sending the same file (or the same ?import_id=)
+    skips the chunks that were already imported.
+    """
+    if admin_uid() is None:
+        return jsonify({"error": "Admin sign-in required."}), 403
+    update_existing = request.args.get('update_existing', '').lower() == 'true'
+    upload = request.files.get('file')
+    content = (upload.read() if upload else request.get_data()).decode('utf-8-sig')
+    filename = (upload.filename if upload else '') or ''
+    fmt = request.args.get('format') or ('json' if filename.endswith('.json') or request.is_json else 'csv')
+    try:
+        rows = parse_rows(content, fmt)
+    except ValueError as e:
+        return jsonify({"error": f"Could not read the import file: {e}"}), 400
+    if not rows:
+        return jsonify({"error": "The import file has no rows"}), 400
+    import_id = request.args.get('import_id') or import_id_for(content)
+
+    def generate():
+        try:
+            for result in import_users(rows, import_id, update_existing):
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            yield json.dumps({"done": True, "import_id": import_id, "error": str(e)}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Import-Id': import_id})
+
+def _requested_uids(data):
+    uids = data.get('uids')
+    if not isinstance(uids, list) or not uids or not all(isinstance(uid, str) and uid for uid in uids):
+        return None
+    # Duplicates are dropped but the order is kept.
+    return list(dict.fromkeys(uids))
+
+@app.route('/users/deactivate', methods=['POST'])
+def bulk_deactivate_users():
+    """
+    Queues a job that disables the Auth accounts of {"uids": [...]}, signs them out
+    and marks their profiles inactive. Poll /jobs/<job_id> for progress. Admins only.
+    """
+    if admin_uid() is None:
+        return jsonify({"error": "Admin sign-in required."}), 403
+    uids = _requested_uids(request.get_json(silent=True) or {})
+    if not uids:
+        return jsonify({"error": "uids must be a non-empty list of user IDs"}), 400
+    try:
+        return _queue_job("users_deactivate", {"uids": uids})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/users/delete', methods=['POST'])
+def bulk_delete_users():
+    """
+    Queues a job that deletes {"uids": [...]} from Auth and removes their profiles,
+    shifts, attendance marks and online-session entries. Poll /jobs/<job_id> for progress.
+    Admins only.
+    """
+    if admin_uid() is None:
+        return jsonify({"error": "Admin sign-in required."}), 403
+    uids = _requested_uids(request.get_json(silent=True) or {})
+    if not uids:
+        return jsonify({"error": "uids must be a non-empty list of user IDs"}), 400
+    try:
+        return _queue_job("users_delete", {"uids": uids})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/users/reassign_location', methods=['POST'])
+def bulk_reassign_location():
+    """
+    Queues a job that changes the tutoringLocation of {"uids": [...]}:
+    "add" adds a location, "remove" removes one ("*" removes all others). Admins only.
+    """
+    if admin_uid() is None:
+        return jsonify({"error": "Admin sign-in required."}), 403
+    data = request.get_json(silent=True) or {}
+    uids = _requested_uids(data)
+    add, remove = data.get('add'), data.get('remove')
+    if not uids:
+        return jsonify({"error": "uids must be a non-empty list of user IDs"}), 400
+    if not add and not remove:
+        return jsonify({"error": "add or remove is required"}), 400
+    if add and add not in locations:
+        return jsonify({"error": f"Unknown location: {add}"}), 400
+    try:
+        return _queue_job("users_reassign_location", {"uids": uids, "add": add, "remove": remove})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -518,6 +800,7 @@ def delete_user(uid):
     try:
         auth.delete_user(uid)
         db.collection('users').document(uid).delete()
+        delta_sync.record_deletions('users', [uid])
         return jsonify({"message": f"User {uid} deleted."}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -537,6 +820,170 @@ def clockins_today():
         return jsonify({"error": str(e)}), 500
 
 
+# --- Historical Reports (served from the local analytics mirror) ---
+
+def _report_range():
+    """Reads the required start and end query parameters (YYYY-MM-DD) of a report."""
+    start = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+    end = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+    if end < start:
+        raise ValueError("end must not be before start")
+    return start, end
+
+@app.route('/reports/hours', methods=['GET'])
+def hours_report():
+    """
+    Returns hours worked between two dates per location and period.
+    Query parameters: start, end (YYYY-MM-DD), optional location,
+    group_by ("day", "month" or "pay_period"; default "month") and by_user=true.
+    """
+    try:
+        start, end = _report_range()
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"start and end are required as YYYY-MM-DD: {e}"}), 400
+    group_by = request.args.get('group_by', 'month')
+    if group_by not in ('day', 'month', 'pay_period'):
+        return jsonify({"error": "group_by must be day, month or pay_period"}), 400
+    try:
+        mirror = analytics_mirror.get_mirror()
+        mirror.ensure_fresh()
+        report = mirror.hours_report(start, end, request.args.get('location'), group_by,
+                                     request.args.get('by_user', 'false').lower() == 'true')
+        return jsonify({"start": start.isoformat(), "end": end.isoformat(), "group_by": group_by, "rows": report}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/reports/attendance', methods=['GET'])
+def attendance_report():
+    """
+    Returns students marked present between two dates per location and period.
+    Query parameters: start, end (YYYY-MM-DD), optional location and
+    group_by ("day" or "month"; default "month").
+    """
+    try:
+        start, end = _report_range()
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"start and end are required as YYYY-MM-DD: {e}"}), 400
+    group_by = request.args.get('group_by', 'month')
+    if group_by not in ('day', 'month'):
+        return jsonify({"error": "group_by must be day or month"}), 400
+    try:
+        mirror = analytics_mirror.get_mirror()
+        mirror.ensure_fresh()
+        report = mirror.attendance_report(start, end, request.args.get('location'), group_by)
+        return jsonify({"start": start.isoformat(), "end": end.isoformat(), "group_by": group_by, "rows": report}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/reports/payroll_approvals', methods=['GET'])
+def payroll_approvals_report():
+    """
+    Returns past payroll approvals, newest first.
+    Optional query parameters: start, end (YYYY-MM-DD, by approval date) and location.
+    """
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if 'start' in request.args else None
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if 'end' in request.args else None
+    except ValueError as e:
+        return jsonify({"error": f"start and end must be YYYY-MM-DD: {e}"}), 400
+    try:
+        mirror = analytics_mirror.get_mirror()
+        mirror.ensure_fresh()
+        return jsonify(mirror.payroll_approvals(start, end, request.args.get('location'))), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/reports/mirror', methods=['GET'])
+def analytics_mirror_status():
+    """
+    Returns the analytics mirror's watermark, last sync time and document count per collection.
+    """
+    try:
+        return jsonify(analytics_mirror.get_mirror().status()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/reports/mirror/sync', methods=['POST'])
+def sync_analytics_mirror():
+    """
+    Queues a sync of the analytics mirror. Send {"full": true} to re-read every
+    document, e.g. after deleting data directly in the Firebase console.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        return _queue_job("analytics_sync", {"full": bool(data.get('full', False))})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# --- Cold Storage ---
+
+@app.route('/archive/run', methods=['POST'])
+def run_archival():
+    """
+    Queues a job that moves shifts and attendance from months that ended more than
+    ARCHIVE_AFTER_DAYS ago out of Firestore into archive files.
+    """
+    try:
+        return _queue_job("archive_closed_periods")
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/archive/manifest', methods=['GET'])
+def archive_manifest():
+    """
+    Returns the archive manifest: every archived month with its file, document count and checksum.
+    """
+    try:
+        return jsonify(cold_storage.get_manifest(refresh=True)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/archive/shifts', methods=['GET'])
+def shift_history_route():
+    """
+    Returns the shifts between two dates, whether they are still in Firestore or archived.
+    Query parameters: start, end (YYYY-MM-DD), optional location and user_id.
+    """
+    try:
+        start, end = _report_range()
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"start and end are required as YYYY-MM-DD: {e}"}), 400
+    try:
+        shifts = cold_storage.shift_history(start, end, request.args.get('location'), request.args.get('user_id'))
+        return jsonify([{"id": doc_id, **shift} for doc_id, shift in shifts]), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# --- Delta Sync ---
+
+@app.route('/sync/changes', methods=['GET'])
+def sync_changes():
+    """
+    Returns what changed in users, attendance, shifts and online sessions since the
+    token from the previous call, or a full snapshot and a first token without one.
+    Query parameters: token, location (limits attendance and shifts), collections
+    (comma-separated, default all).
+
+    Call again straight away while "has_more" is true. When "reset" is true the token
+    was too old or for another location: discard local data and use the snapshot.
+    """
+    collections = tuple(filter(None, request.args.get('collections', ','.join(delta_sync.COLLECTIONS)).split(',')))
+    unknown = [name for name in collections if name not in delta_sync.COLLECTIONS]
+    if unknown:
+        return jsonify({"error": f"Unknown collections: {', '.join(unknown)}"}), 400
+    location = request.args.get('location')
+    if location and location not in locations:
+        return jsonify({"error": "Invalid location."}), 400
+    try:
+        return jsonify(delta_sync.changes(request.args.get('token'), location, collections)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 # --- Online Tutoring Session Routes ---
 
 @app.route('/online_sessions/create', methods=['POST'])
@@ -688,6 +1135,7 @@ def get_meet_link_route(session_id):
 
 
 @app.route('/online_sessions', methods=['GET'])
+@coalesce
 def get_all_sessions_route():
     """
     Retrieves all online sessions.
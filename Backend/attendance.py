@@ -1,5 +1,6 @@
 # attendance.py
 from datetime import datetime
+from firebase_admin import firestore
 from firebase_config import db
 
 def get_student_list(location):
@@ -53,10 +54,12 @@ def take_attendance(location, student_id, status):
                 }
             },
             'location': location,
-            'date': date_str
+            'date': date_str,
+            'updated_at': firestore.SERVER_TIMESTAMP
         }
         if attendance_doc.exists:
-            attendance_ref.update({f'student.{student_id}': data['student_id'][student_id]})
+            attendance_ref.update({f'student.{student_id}': data['student_id'][student_id],
+                                   'updated_at': firestore.SERVER_TIMESTAMP})
         else:
             attendance_ref.set(data)
         return {'message': f"Attendance recorded for {student_id} at {location} on {date_str},"}
@@ -87,11 +90,24 @@ def edit_attendance(location, student_id, status):
 
     update_data = {
         f'student.{student_id}.status': status,
-        f'student.{student_id}.last_edited' : datetime.now().isoformat()
+        f'student.{student_id}.last_edited' : datetime.now().isoformat(),
+        'updated_at': firestore.SERVER_TIMESTAMP
     }
     
     attendance_ref.update(update_data)
     return {'message': f"Updated attendance for student {student_id} at {location} on {date_str}. "}
+def count_present(students):
+    """
+    Counts the students marked 'present' in an attendance document's 'student' map.
+
+    Args:
+        students (dict): Maps student IDs to their attendance record.
+
+    Returns:
+        int: The number of present students.
+    """
+    return sum(1 for s in students.values() if s.get('status') == 'present')
+
 def attendance_count(location):
     """
     Calculates and returns the total number of students marked as 'present'
@@ -113,8 +129,7 @@ def attendance_count(location):
         return {'location': location, 'present_count': 0, 'date': date_str}
 
     data = attendance_doc.to_dict()
-    students = data.get('student', {})
-    present_count = sum (1 for s in students.values() if s.get('status') == 'present')
+    present_count = count_present(data.get('student', {}))
 
     return {
         'location': location,
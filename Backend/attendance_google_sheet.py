@@ -1,12 +1,35 @@
 # attendance_google_sheet.py
 from logging_google_sheets import get_gspread_client
+from report_sheets import write_report
+from sheets_scheduler import call as sheets_call, REPORT
 from datetime import datetime, timedelta
 from calendar import monthrange
 import gspread
+import logging
 from firebase_config import db
-from attendance import get_student_list
+from attendance import get_student_list, count_present
 from locations import locations
 
+logger = logging.getLogger(__name__)
+
+def build_attendance_rows(student_list, attendance_data):
+    """
+    Builds one [First Name, Last Name, Status] row per student for the daily report.
+
+    Args:
+        student_list (list): Student profiles, each with an 'id'.
+        attendance_data (dict): The 'student' map of the day's attendance document.
+
+    Returns:
+        list: The report rows; students without a mark are 'Unmarked'.
+    """
+    rows = []
+    for student in student_list:
+        # Determine student's attendance status.
+        status = attendance_data.get(student.get('id'), {}).get('status', 'Unmarked')
+        rows.append([student.get('firstName', ''), student.get('lastName', ''), status])
+    return rows
+
 def micro_attendance(google_sheet_name, location):
     """
     Creates a daily attendance report for a specific location in a dedicated Google Sheet.
@@ -14,93 +37,81 @@ def micro_attendance(google_sheet_name, location):
     Args:
         google_sheet_name (str): The name of the Google Sheet to write the report to.
         location (str): The specific location to generate the report for.
+
+    Returns:
+        dict: A success message, or an error message.
     """
     try:
-        # Authenticate with Google Sheets and get the client.
-        client = get_gspread_client()
-        if not client:
-            print("Failed to get Google Sheets client.")
-            return
-
-        # Open the specified Google Sheet by its name.
-        try:
-            workbook = client.open(google_sheet_name)
-        except gspread.exceptions.SpreadsheetNotFound:
-            print(f"Spreadsheet '{google_sheet_name}' not found. Please create it first.")
-            return
-
-        # Create a name for the new worksheet/tab based on the current date.
+        # Create a name for the worksheet/tab based on the current date.
         date_str = datetime.now().strftime('%Y-%m-%d')
-        
-        # Check if a worksheet with today's date already exists.
-        try:
-            worksheet = workbook.worksheet(date_str)
-            worksheet.clear() # Clear existing data to overwrite with fresh data.
-        except gspread.exceptions.WorksheetNotFound:
-            # If not, create a new one.
-            worksheet = workbook.add_worksheet(title=date_str, rows="100", cols="10")
-        
-        # Define and add the header row.
-        header = ["First Name", "Last Name", "Status"]
-        worksheet.append_row(header, value_input_option='USER_ENTERED')
 
         # Fetch the list of all students for the given location.
         student_list = get_student_list(location)
         if 'error' in student_list:
-            print(f"Error fetching student list: {student_list['error']}")
-            return
+            logger.error(f"Error fetching student list: {student_list['error']}")
+            return {"error": f"Error fetching student list: {student_list['error']}"}
 
         # Fetch today's attendance data from Firestore.
         attendance_ref = db.collection('attendance').document(f"{location}_{date_str}")
         attendance_doc = attendance_ref.get()
         attendance_data = attendance_doc.to_dict().get('student', {}) if attendance_doc.exists else {}
 
-        # Prepare rows for batch update.
-        rows_to_append = []
-        for student in student_list:
-            student_id = student.get('id')
-            first_name = student.get('firstName', '')
-            last_name = student.get('lastName', '')
-            
-            # Determine student's attendance status.
-            status = attendance_data.get(student_id, {}).get('status', 'Unmarked')
-            
-            rows_to_append.append([first_name, last_name, status])
+        # Prepare the report rows.
+        rows_to_append = build_attendance_rows(student_list, attendance_data)
 
-        # Append all student attendance data to the worksheet.
-        if rows_to_append:
-            worksheet.append_rows(rows_to_append, value_input_option='USER_ENTERED')
+        # Write the header and all student rows to today's tab in one request,
+        # overwriting any earlier report for today.
+        header = ["First Name", "Last Name", "Status"]
+        try:
+            write_report(google_sheet_name, date_str, header, rows_to_append)
+        except gspread.exceptions.SpreadsheetNotFound:
+            logger.warning(f"Spreadsheet '{google_sheet_name}' not found. Please create it first.")
+            return {"error": f"Spreadsheet '{google_sheet_name}' not found."}
         
-        print(f"Successfully updated attendance for {location} in '{google_sheet_name}' for {date_str}.")
+        logger.info(f"Successfully updated attendance for {location} in '{google_sheet_name}' for {date_str}.")
+        return {"message": f"Micro attendance logged successfully for {location}."}
 
     except Exception as e:
-        print(f"An error occurred in micro_attendance: {e}")
+        logger.error(f"An error occurred in micro_attendance: {e}")
+        return {"error": str(e)}
 
-def macro_attendance():
+def macro_attendance(report_month=None):
     """
     Calculates and records the monthly average attendance for all locations.
     This function is intended to be run on the first day of a new month.
     It creates a new worksheet for each year.
+
+    Args:
+        report_month (str, optional): The month to report on, as "YYYY-MM". When it
+            is given the report runs on any day (e.g. to catch up on a missed month);
+            otherwise it covers the previous month and only runs on the 1st.
+
+    Returns:
+        dict: A message, or an error.
     """
-    # This function should run only on the first day of the month.
-    if datetime.now().day != 1:
-        print("Macro attendance report is only generated on the first day of the month.")
-        return
+    # Without an explicit month, this function should run only on the first day of the month.
+    if report_month is None and datetime.now().day != 1:
+        logger.warning("Macro attendance report is only generated on the first day of the month.")
+        return {"error": "Macro attendance report is only generated on the first day of the month."}
 
     try:
         # Authenticate with Google Sheets.
         client = get_gspread_client()
         if not client:
-            print("Failed to get Google Sheets client.")
-            return
+            logger.error("Failed to get Google Sheets client.")
+            return {"error": "Failed to get Google Sheets client."}
 
         # Open the summary workbook.
         workbook = client.open("HOW-Monthly-Attendance-Summary")
 
-        # Determine the date range and year for the *previous* month.
-        today = datetime.now()
-        last_month_end = today.replace(day=1) - timedelta(days=1)
-        last_month_start = last_month_end.replace(day=1)
+        # Determine the date range and year for the *previous* month (or the requested one).
+        if report_month:
+            last_month_start = datetime.strptime(report_month, "%Y-%m")
+            last_month_end = (last_month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        else:
+            today = datetime.now()
+            last_month_end = today.replace(day=1) - timedelta(days=1)
+            last_month_start = last_month_end.replace(day=1)
         report_year_str = str(last_month_start.year)
         _, num_days_in_month = monthrange(last_month_start.year, last_month_start.month)
         
@@ -108,14 +119,18 @@ def macro_attendance():
         try:
             worksheet = workbook.worksheet(report_year_str)
         except gspread.exceptions.WorksheetNotFound:
-            worksheet = workbook.add_worksheet(title=report_year_str, rows="100", cols="20")
+            worksheet = sheets_call(workbook.add_worksheet, title=report_year_str, rows="100", cols="20", priority=REPORT)
             # Create and append the header row for the new yearly sheet.
             header = ["Month/Year"] + locations + ["Total Average"]
-            worksheet.append_row(header, value_input_option='USER_ENTERED')
-            print(f"Created new worksheet for the year {report_year_str}.")
+            sheets_call(worksheet.append_row, header, value_input_option='USER_ENTERED', priority=REPORT)
+            logger.info(f"Created new worksheet for the year {report_year_str}.")
 
         # Prepare the row with the month and year as the first column.
         month_year_str = last_month_start.strftime("%-m/%y")
+        # A month is only recorded once, so a retried or caught-up run cannot add a duplicate row.
+        if month_year_str in sheets_call(worksheet.col_values, 1, priority=REPORT):
+            logger.info(f"Macro attendance for {month_year_str} is already in sheet '{report_year_str}'.")
+            return {"message": f"Macro attendance for {month_year_str} was already recorded."}
         new_row = [month_year_str]
         grand_total_present = 0
 
@@ -127,9 +142,7 @@ def macro_attendance():
 
             location_total_present = 0
             for doc in docs:
-                data = doc.to_dict().get('student', {})
-                present_count = sum(1 for s in data.values() if s.get('status') == 'present')
-                location_total_present += present_count
+                location_total_present += count_present(doc.to_dict().get('student', {}))
             
             # Calculate average and add to the row.
             avg_attendance = round(location_total_present / num_days_in_month, 2) if num_days_in_month > 0 else 0
@@ -141,9 +154,11 @@ def macro_attendance():
         new_row.append(total_avg)
 
         # Append the summary row to the correct yearly Google Sheet.
-        worksheet.append_row(new_row, value_input_option='USER_ENTERED')
+        sheets_call(worksheet.append_row, new_row, value_input_option='USER_ENTERED', priority=REPORT)
 
-        print(f"Successfully generated macro attendance summary for {month_year_str} in sheet '{report_year_str}'.")
+        logger.info(f"Successfully generated macro attendance summary for {month_year_str} in sheet '{report_year_str}'.")
+        return {"message": f"Macro attendance report generated for {month_year_str}."}
 
     except Exception as e:
-        print(f"An error occurred in macro_attendance: {e}")
\ No newline at end of file
+        logger.error(f"An error occurred in macro_attendance: {e}")
+        return {"error": str(e)}
\ No newline at end of file
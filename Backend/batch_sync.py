@@ -0,0 +1,304 @@
+# batch_sync.py
+
+"""
+This file handles batched event uploads from the Senior PM's kiosk device.
+
+When the tablet loses its connection it keeps clock-in/out events and attendance
+marks in a local buffer. Once it is back online it sends the whole buffer in one
+request. Every event carries a client-generated `event_id` and the
+`client_timestamp` of the moment it actually happened, so the server can:
+
+1. Validate each event and reject only the bad ones.
+2. Drop duplicates (inside the batch and from earlier, partially-acknowledged uploads).
+   An attendance mark is only written when the stored one for that student and day
+   is older (a re-sent mark never overwrites a later mark or edit), and a shift from
+   an earlier upload whose sheet row was never queued gets its row queued now.
+3. Put the events in the order they happened.
+4. Commit them to Firestore: shifts in batch chunks, and each attendance document
+   in one transaction.
+5. Update the Google Sheet once per affected location instead of once per event.
+"""
+
+from datetime import datetime
+from firebase_admin import firestore
+from firebase_config import db
+from locations import locations
+from logging_google_sheets import append_rows_to_spreadsheet, schedule_cleanup
+from workbook_routing import log_workbook
+
+# Firestore allows at most 500 writes in a single batch commit.
+BATCH_LIMIT = 500
+# Upper bound on how many events a single upload may contain.
+MAX_EVENTS_PER_REQUEST = 5000
+
+CLOCK_EVENTS = {'clock-in': 'clocked in', 'clock-out': 'clocked out'}
+ATTENDANCE_EVENT = 'attendance'
+ATTENDANCE_STATUSES = ['present', 'absent']
+
+
+def _parse_client_timestamp(value):
+    """
+    Parses an ISO 8601 client timestamp into a naive local datetime, matching the
+    format of the timestamps already stored in the 'shifts' collection.
+    """
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
+
+
+def validate_event(event):
+    """
+    Checks that a single buffered event is well formed.
+
+    Args:
+        event (dict): The raw event sent by the client.
+
+    Returns:
+        tuple: (normalized_event, None) if the event is valid, otherwise (None, error_message).
+    """
+    if not isinstance(event, dict):
+        return None, "event must be an object"
+
+    event_id = event.get('event_id')
+    event_type = event.get('type')
+    location = event.get('location')
+
+    if not event_id or not isinstance(event_id, str) or '/' in event_id:
+        return None, "event_id is required and may not contain '/'"
+    if event_type not in CLOCK_EVENTS and event_type != ATTENDANCE_EVENT:
+        return None, f"unknown event type '{event_type}'"
+    if location not in locations:
+        return None, f"unknown location '{location}'"
+
+    try:
+        timestamp = _parse_client_timestamp(event.get('client_timestamp') or '')
+    except (TypeError, ValueError):
+        return None, "client_timestamp must be an ISO 8601 timestamp"
+
+    normalized = {
+        'event_id': event_id,
+        'type': event_type,
+        'location': location,
+        'timestamp': timestamp,
+    }
+
+    if event_type in CLOCK_EVENTS:
+        if not event.get('user_id') or not event.get('role'):
+            return None, "user_id and role are required for clock events"
+        normalized['user_id'] = event['user_id']
+        normalized['role'] = event['role']
+    else:
+        if not event.get('student_id'):
+            return None, "student_id is required for attendance events"
+        if event.get('status') not in ATTENDANCE_STATUSES:
+            return None, "status must be 'present' or 'absent'"
+        normalized['student_id'] = event['student_id']
+        normalized['status'] = event['status']
+
+    return normalized, None
+
+
+def _commit_in_chunks(writes):
+    """
+    Commits (doc_ref, data, merge) writes using as few Firestore batches as possible.
+
+    Returns:
+        int: The number of writes committed.
+    """
+    committed = 0
+    for start in range(0, len(writes), BATCH_LIMIT):
+        batch = db.batch()
+        chunk = writes[start:start + BATCH_LIMIT]
+        for doc_ref, data, merge in chunk:
+            # updated_at lets the analytics mirror pick up only changed documents.
+            batch.set(doc_ref, {**data, 'updated_at': firestore.SERVER_TIMESTAMP}, merge=merge)
+        batch.commit()
+        committed += len(chunk)
+    return committed
+
+
+def _find_already_synced(clock_events):
+    """
+    Finds the events whose shift documents already exist in Firestore, i.e. events
+    from an earlier upload that the client never received an acknowledgement for.
+
+    Returns:
+        tuple: (synced_ids, sheet_pending_ids). A shift is written with sheet_pending
+               set, and the flag is removed once its sheet row is queued, so the second
+               set holds the shifts whose rows an earlier upload failed to queue.
+    """
+    if not clock_events:
+        return set(), set()
+    refs = [db.collection('shifts').document(e['event_id']) for e in clock_events]
+    synced, sheet_pending = set(), set()
+    for snapshot in db.get_all(refs):
+        if snapshot.exists:
+            synced.add(snapshot.id)
+            if (snapshot.to_dict() or {}).get('sheet_pending'):
+                sheet_pending.add(snapshot.id)
+    return synced, sheet_pending
+
+
+def _mark_time(mark):
+    """Returns when an attendance mark was last changed: its edit time, or when it was taken."""
+    changed = mark.get('last_edited') or mark.get('timestamp')
+    return datetime.fromisoformat(changed) if changed else datetime.min
+
+
+def _merge_attendance(doc_ref, data):
+    """
+    Merges attendance marks into a day/location document, skipping every student whose
+    stored mark was taken or edited at the same time or later. Runs in a transaction,
+    so an edit made meanwhile is not overwritten either.
+
+    Returns:
+        set: The student IDs whose marks were written.
+    """
+    @firestore.transactional
+    def merge(transaction):
+        snapshot = doc_ref.get(transaction=transaction)
+        stored = (snapshot.to_dict() or {}).get('student', {}) if snapshot.exists else {}
+        newer = {student_id: mark for student_id, mark in data['student'].items()
+                 if student_id not in stored or _mark_time(stored[student_id]) < _mark_time(mark)}
+        if newer:
+            transaction.set(doc_ref, {**data, 'student': newer, 'updated_at': firestore.SERVER_TIMESTAMP},
+                            merge=True)
+        return set(newer)
+
+    return merge(db.transaction())
+
+
+def _build_sheet_rows(clock_events):
+    """
+    Builds log sheet rows for the committed clock events, grouped by location.
+    Each user profile is read once, no matter how many events belong to it.
+    """
+    user_ids = {e['user_id'] for e in clock_events}
+    user_refs = [db.collection('users').document(uid) for uid in user_ids]
+    users_map = {snapshot.id: snapshot.to_dict() or {} for snapshot in db.get_all(user_refs) if snapshot.exists}
+
+    rows_by_location = {}
+    for event in clock_events:
+        user_info = users_map.get(event['user_id'], {})
+        rows_by_location.setdefault(event['location'], []).append([
+            event['location'],
+            event['role'],
+            user_info.get('firstName', ''),
+            user_info.get('lastName', ''),
+            event['timestamp'].isoformat(),
+            CLOCK_EVENTS[event['type']]
+        ])
+    return rows_by_location
+
+
+def process_event_batch(events):
+    """
+    Validates, deduplicates, orders and commits a buffered list of kiosk events.
+
+    Clock events are written to 'shifts' using their event_id as the document ID, so
+    re-sending an event can never create a second shift record. Attendance events are
+    merged into the same 'attendance/{location}_{date}' documents used by
+    attendance.take_attendance, keyed by the date the mark was actually taken, unless
+    the stored mark for that student is as recent or was edited later.
+
+    Args:
+        events (list): A list of event dictionaries. Clock events look like
+            {"event_id", "type": "clock-in"|"clock-out", "client_timestamp", "location", "user_id", "role"}
+            and attendance events look like
+            {"event_id", "type": "attendance", "client_timestamp", "location", "student_id", "status"}.
+
+    Returns:
+        dict: A summary listing which event IDs were committed, skipped as duplicates
+              (or superseded by a later mark) or rejected (with a reason), plus the
+              number of rows logged to Sheets.
+    """
+    if not isinstance(events, list):
+        return {'error': "events must be a list"}
+    if len(events) > MAX_EVENTS_PER_REQUEST:
+        return {'error': f"a batch may contain at most {MAX_EVENTS_PER_REQUEST} events"}
+
+    rejected = []
+    duplicates = []
+    accepted = {}
+
+    # 1. Validate and drop duplicates inside the batch.
+    for event in events:
+        normalized, error = validate_event(event)
+        if error:
+            event_id = event.get('event_id') if isinstance(event, dict) else None
+            rejected.append({'event_id': event_id, 'error': error})
+        elif normalized['event_id'] in accepted:
+            duplicates.append(normalized['event_id'])
+        else:
+            accepted[normalized['event_id']] = normalized
+
+    # 2. Replay the events in the order they happened on the device.
+    ordered = sorted(accepted.values(), key=lambda e: (e['timestamp'], e['event_id']))
+    clock_events = [e for e in ordered if e['type'] in CLOCK_EVENTS]
+    attendance_events = [e for e in ordered if e['type'] == ATTENDANCE_EVENT]
+
+    # 3. Skip clock events that an earlier upload already committed, but still log the
+    #    ones whose sheet rows it did not get to queue.
+    already_synced, sheet_pending = _find_already_synced(clock_events)
+    duplicates.extend(e['event_id'] for e in clock_events if e['event_id'] in already_synced)
+    unlogged_events = [e for e in clock_events if e['event_id'] in sheet_pending]
+    clock_events = [e for e in clock_events if e['event_id'] not in already_synced]
+
+    writes = []
+    for event in clock_events:
+        writes.append((db.collection('shifts').document(event['event_id']), {
+            'event': event['type'],
+            'user_id': event['user_id'],
+            'timestamp': event['timestamp'].isoformat(),
+            'location': event['location'],
+            'role': event['role'],
+            # Removed once the sheet row is queued; see _find_already_synced.
+            'sheet_pending': True
+        }, False))
+
+    # Attendance marks for the same student on the same day collapse into the latest one,
+    # and every day/location document is written once.
+    attendance_docs = {}
+    mark_events = {}
+    for event in attendance_events:
+        date_str = event['timestamp'].strftime('%Y-%m-%d')
+        doc_id = f"{event['location']}_{date_str}"
+        doc = attendance_docs.setdefault(doc_id, {
+            'location': event['location'],
+            'date': date_str,
+            'student': {}
+        })
+        doc['student'][event['student_id']] = {
+            'status': event['status'],
+            'timestamp': event['timestamp'].isoformat(),
+            'last_edited': None
+        }
+        mark_events.setdefault((doc_id, event['student_id']), []).append(event['event_id'])
+
+    # 4. Commit the shifts in batch chunks, and merge each attendance document.
+    _commit_in_chunks(writes)
+    committed_marks = []
+    for doc_id, data in attendance_docs.items():
+        written = _merge_attendance(db.collection('attendance').document(doc_id), data)
+        for student_id in data['student']:
+            event_ids = mark_events[(doc_id, student_id)]
+            (committed_marks if student_id in written else duplicates).extend(event_ids)
+
+    # 5. Fan out one Sheets update per affected location, then clear sheet_pending on the
+    #    shifts whose rows are queued (the scheduler has saved them, so they survive a restart).
+    rows_logged = 0
+    logged_events = sorted(unlogged_events + clock_events, key=lambda e: (e['timestamp'], e['event_id']))
+    if logged_events:
+        for location, rows in _build_sheet_rows(logged_events).items():
+            rows_logged += append_rows_to_spreadsheet(location, rows)
+            schedule_cleanup(log_workbook(location), sheet_type="log")
+        _commit_in_chunks([(db.collection('shifts').document(e['event_id']),
+                            {'sheet_pending': firestore.DELETE_FIELD}, True) for e in logged_events])
+
+    return {
+        'committed': [e['event_id'] for e in clock_events] + committed_marks,
+        'duplicates': duplicates,
+        'rejected': rejected,
+        'rows_logged': rows_logged
+    }
@@ -0,0 +1,95 @@
+# datasets.py
+
+"""
+Generates synthetic users, shifts and attendance documents for the benchmarks.
+
+The data has the same shape as the Firestore collections:
+- users: {uid: {"firstName", "lastName", "role", "tutoringLocation": [location]}}
+- shifts: [(doc_id, {"event", "user_id", "timestamp", "location", "role"})], sorted by timestamp
+- attendance: {"{location}_{date}": {"location", "date", "student": {uid: {"status", ...}}}}
+
+Each staff member works one shift a day (two events), and about 1 in 20 shifts is
+missing its clock-out, like a forgotten clock-out on the kiosk.
+"""
+
+import math
+import random
+from datetime import datetime, timedelta
+
+
+class Dataset:
+    def __init__(self, locations, users, shifts, attendance, start_date, days):
+        self.locations = locations
+        self.users = users
+        self.shifts = shifts
+        self.attendance = attendance
+        self.start_date = start_date
+        self.days = days
+
+    @property
+    def event_count(self):
+        return len(self.shifts)
+
+
+def generate_dataset(num_locations, users_per_location, days, seed=0, start_date=None):
+    """
+    Builds a dataset of N locations x M staff (and M students) per location x D days.
+
+    Args:
+        num_locations (int): Number of locations.
+        users_per_location (int): Staff members, and also students, per location.
+        days (int): Number of consecutive days of activity.
+        seed (int): Seeds the random generator so runs are repeatable.
+        start_date (date, optional): The first day. Defaults to the 1st of the current month.
+
+    Returns:
+        Dataset: The generated data.
+    """
+    rng = random.Random(seed)
+    start_date = start_date or datetime.now().date().replace(day=1)
+    locations = [f"Location {i}" for i in range(num_locations)]
+    users, shifts, attendance = {}, [], {}
+
+    for loc_index, location in enumerate(locations):
+        staff = []
+        students = []
+        for i in range(users_per_location):
+            uid = f"staff-{loc_index}-{i}"
+            users[uid] = {"firstName": f"Staff{i}", "lastName": f"Loc{loc_index}",
+                          "role": "tutor", "tutoringLocation": [location]}
+            staff.append(uid)
+            student_id = f"student-{loc_index}-{i}"
+            users[student_id] = {"firstName": f"Student{i}", "lastName": f"Loc{loc_index}",
+                                 "role": "student", "tutoringLocation": [location]}
+            students.append(student_id)
+
+        for day_offset in range(days):
+            day = start_date + timedelta(days=day_offset)
+            for uid in staff:
+                clock_in = datetime.combine(day, datetime.min.time()) + timedelta(hours=14, minutes=rng.randrange(120))
+                shifts.append((f"{uid}-{day_offset}-in", {"event": "clock-in", "user_id": uid, "timestamp": clock_in.isoformat(),
+                                                          "location": location, "role": "tutor"}))
+                if rng.random() >= 0.05:
+                    clock_out = clock_in + timedelta(minutes=rng.randrange(60, 240))
+                    shifts.append((f"{uid}-{day_offset}-out", {"event": "clock-out", "user_id": uid, "timestamp": clock_out.isoformat(),
+                                                               "location": location, "role": "tutor"}))
+
+            date_str = day.strftime('%Y-%m-%d')
+            marks = {}
+            for student_id in students:
+                if rng.random() < 0.8:
+                    marks[student_id] = {"status": "present" if rng.random() < 0.85 else "absent",
+                                         "timestamp": f"{date_str}T15:00:00", "last_edited": None}
+            attendance[f"{location}_{date_str}"] = {"location": location, "date": date_str, "student": marks}
+
+    shifts.sort(key=lambda s: s[1]["timestamp"])
+    return Dataset(locations, users, shifts, attendance, start_date, days)
+
+
+def dataset_for_events(target_events, num_locations=4, days=15, seed=0):
+    """
+    Builds a dataset with roughly target_events shift events, spread over one 15-day
+    pay period at num_locations locations.
+    """
+    users_per_location = max(1, math.ceil(target_events / (2 * num_locations * days)))
+    return generate_dataset(num_locations, users_per_location, days, seed)
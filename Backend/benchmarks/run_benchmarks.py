@@ -0,0 +1,200 @@
+# run_benchmarks.py
+
+"""
+Microbenchmarks for the pure computation behind the hours and attendance reports.
+
+Covered functions:
+- edit_work_hours.pair_shift_events            (shift pairing in find_shifts_for_user)
+- logging_google_sheets.sum_shift_durations    (hour totals in the 15-day summary and payroll CSVs)
+- attendance.count_present                     (attendance_count and macro_attendance)
+- attendance_google_sheet.build_attendance_rows (micro_attendance rows)
+- edit_work_hours.build_log_rows               (_regenerate_log_sheet rows)
+
+Each one runs at 10^3 to 10^6 shift events. The best of several timed runs and the
+peak memory (from tracemalloc, in a separate run) are compared with
+benchmarks/baseline.json, and the script exits with status 1 when a result is worse
+than the baseline by more than the allowed tolerance, or has no baseline entry. With
+no baseline file at all it exits with status 2: record one on the machine that runs
+the checks first.
+
+Run it from the Backend directory:
+    python -m benchmarks.run_benchmarks                     # compare with the baseline
+    python -m benchmarks.run_benchmarks --update-baseline   # record a new baseline
+    python -m benchmarks.run_benchmarks --max-events 100000 --only sum_shift_durations
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+import types
+from datetime import timedelta
+
+from benchmarks.datasets import dataset_for_events
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+
+def _load_backend():
+    """
+    Imports the backend modules with an in-memory Firestore client in place of
+    firebase_config, which would otherwise connect to production on import.
+    """
+    if "firebase_config" not in sys.modules:
+        from loadtest.fake_firestore import FakeFirestoreClient
+        firebase_config = types.ModuleType("firebase_config")
+        firebase_config.db = FakeFirestoreClient()
+        sys.modules["firebase_config"] = firebase_config
+
+    import attendance
+    import attendance_google_sheet
+    import edit_work_hours
+    import logging_google_sheets
+    return attendance, attendance_google_sheet, edit_work_hours, logging_google_sheets
+
+
+def build_benchmarks():
+    """
+    Returns {name: (setup, run)}. setup(dataset) prepares the inputs outside the timed
+    region and run(inputs) is the code being measured.
+    """
+    attendance, attendance_google_sheet, edit_work_hours, logging_google_sheets = _load_backend()
+
+    def by_user_day(dataset):
+        groups = {}
+        for doc_id, data in dataset.shifts:
+            groups.setdefault((data["user_id"], data["timestamp"][:10]), []).append((doc_id, data))
+        return list(groups.values())
+
+    def by_user(dataset):
+        groups = {}
+        for _, data in dataset.shifts:
+            groups.setdefault(data["user_id"], []).append(data)
+        start = dataset.start_date
+        return list(groups.values()), start, start + timedelta(days=14)
+
+    def by_location_day(dataset):
+        students_by_location = {}
+        for uid, user in dataset.users.items():
+            if user["role"] == "student":
+                students_by_location.setdefault(user["tutoringLocation"][0], []).append(dict(user, id=uid))
+        return [(students_by_location.get(doc["location"], []), doc["student"]) for doc in dataset.attendance.values()]
+
+    def by_location(dataset):
+        shifts_by_location = {}
+        for _, data in dataset.shifts:
+            shifts_by_location.setdefault(data["location"], []).append(data)
+        users_by_location = {}
+        for uid, user in dataset.users.items():
+            users_by_location.setdefault(user["tutoringLocation"][0], {})[uid] = user
+        return [(shifts, users_by_location.get(location, {})) for location, shifts in shifts_by_location.items()]
+
+    return {
+        "pair_shift_events": (
+            by_user_day,
+            lambda groups: [edit_work_hours.pair_shift_events(group) for group in groups]),
+        "sum_shift_durations": (
+            by_user,
+            lambda args: [logging_google_sheets.sum_shift_durations(events, args[1], args[2]) for events in args[0]]),
+        "count_present": (
+            lambda dataset: [doc["student"] for doc in dataset.attendance.values()],
+            lambda docs: sum(attendance.count_present(students) for students in docs)),
+        "build_attendance_rows": (
+            by_location_day,
+            lambda days: [attendance_google_sheet.build_attendance_rows(students, marks) for students, marks in days]),
+        "build_log_rows": (
+            by_location,
+            lambda locations: [edit_work_hours.build_log_rows(shifts, users) for shifts, users in locations]),
+    }
+
+
+def measure(run, inputs, repeats):
+    """Returns (best wall time in seconds, peak traced memory in bytes)."""
+    best = float("inf")
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        run(inputs)
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    run(inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """Returns a list of human-readable regressions against the baseline."""
+    regressions = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if not expected:
+            regressions.append(f"{key}: no baseline entry; run with --update-baseline to record one")
+            continue
+        if result["seconds"] > expected["seconds"] * (1 + time_tolerance):
+            regressions.append(f"{key}: {result['seconds'] * 1000:.2f} ms vs baseline {expected['seconds'] * 1000:.2f} ms")
+        if result["peak_bytes"] > expected["peak_bytes"] * (1 + memory_tolerance):
+            regressions.append(f"{key}: peak {result['peak_bytes'] / 1024:.0f} KiB vs baseline {expected['peak_bytes'] / 1024:.0f} KiB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hours and attendance computations.")
+    parser.add_argument("--sizes", type=lambda s: [int(float(x)) for x in s.split(",")], default=DEFAULT_SIZES,
+                        help="comma-separated event counts (default: 1e3,1e4,1e5,1e6)")
+    parser.add_argument("--max-events", type=int, help="skip sizes above this")
+    parser.add_argument("--only", action="append", help="run only the named benchmark (repeatable)")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--time-tolerance", type=float, default=0.30, help="allowed slowdown, as a fraction")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10, help="allowed peak memory growth, as a fraction")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    sizes = [s for s in args.sizes if args.max_events is None or s <= args.max_events]
+    benchmarks = build_benchmarks()
+    names = args.only or list(benchmarks)
+
+    results = {}
+    print(f"{'benchmark':<24} {'events':>9} {'time ms':>10} {'peak KiB':>10}")
+    for size in sizes:
+        dataset = dataset_for_events(size)
+        for name in names:
+            setup, run = benchmarks[name]
+            inputs = setup(dataset)
+            seconds, peak = measure(run, inputs, args.repeats)
+            key = f"{name}@{size}"
+            results[key] = {"events": dataset.event_count, "seconds": seconds, "peak_bytes": peak}
+            print(f"{name:<24} {dataset.event_count:>9} {seconds * 1000:>10.2f} {peak / 1024:>10.0f}")
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one.")
+        return 2
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 from datetime import datetime
 from firebase_config import db  
 from firebase_admin import firestore
+from ingest_journal import get_journal
 
 TIMESTAMP_FILE = "sheet_timestamps.json"
 DAYS_INTERVAL = 15
@@ -10,14 +11,22 @@ def get_current_timestamp():
     return datetime.pstnow().isoformat()
 
 def log_to_firestore(event_type, user_id, timestamp, role, location):
-    doc_ref = db.collection("shifts").document()
-    doc_ref.set({
+    data = {
         "event": event_type,
         "user_id": user_id,
         "timestamp": timestamp,
         "location": location,
         "role": role
-    })
+    }
+    #When the local journal is enabled the event is acknowledged as soon as it is on disk
+    #and written to Firestore in the background.
+    journal = get_journal()
+    if journal is not None:
+        journal.append(data)
+        return
+    doc_ref = db.collection("shifts").document()
+    #updated_at lets the analytics mirror pick up only changed shifts.
+    doc_ref.set({**data, "updated_at": firestore.SERVER_TIMESTAMP})
 #clock_in(user_id, location): This function will be called when a staff member clocks in. It will record 
 #the current timestamp and log the event in a new Firestore collection, for example, clock_events.
 def clock_in (user_id, location, role):
@@ -0,0 +1,397 @@
+# cold_storage.py
+
+"""
+This file moves old shifts and attendance out of Firestore into compressed archive
+files, and reads them back for historical queries.
+
+The 'shifts' and 'attendance' collections otherwise grow forever, and every query
+without a date bound gets slower. archive_closed_periods() takes each month that
+ended more than ARCHIVE_AFTER_DAYS ago (default 180, the same ~6 months the log
+sheets are kept for) and:
+
+1. reads the month's documents and merges them into the month's archive file,
+   <collection>/<YYYY-MM>.json.gz. The file is gzipped JSON stored column by column,
+   with repeated values (user IDs, locations, events) dictionary-encoded;
+2. records the file, its document count and checksum in manifest.json;
+3. deletes the archived documents in batches of BATCH_LIMIT, pausing
+   ARCHIVE_DELETE_PAUSE_SECONDS between batches.
+
+Every step can be repeated safely: a run that stopped half-way merges whatever is
+still in Firestore into the existing file and deletes it on the next run.
+
+Archives are kept in ARCHIVE_DIR (default archive/ next to this file), or in the
+Firebase Storage bucket ARCHIVE_BUCKET when it is set.
+
+shift_history() and archived_documents() combine archived and live documents, so
+callers do not need to know where a month is stored.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, date
+from dotenv import load_dotenv
+from firebase_config import db
+from metrics import inc
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"))
+ARCHIVE_BUCKET = os.getenv("ARCHIVE_BUCKET")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+DELETE_PAUSE_SECONDS = float(os.getenv("ARCHIVE_DELETE_PAUSE_SECONDS", "0.2"))
+BATCH_LIMIT = 500
+MANIFEST = "manifest.json"
+# Other processes may archive months too, so the cached manifest is re-read this often.
+MANIFEST_TTL_SECONDS = 60
+
+SHIFT_FIELDS = ("id", "event", "user_id", "timestamp", "location", "role")
+ATTENDANCE_FIELDS = ("id", "location", "date", "student_id", "status", "timestamp", "last_edited")
+
+
+class LocalArchiveStore:
+    """Archive files in a directory on local disk."""
+
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+
+    def read(self, name):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write a temporary file and rename it, so a crash never leaves half a file.
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+
+class BucketArchiveStore:
+    """Archive files in a Firebase Storage (Google Cloud Storage) bucket."""
+
+    def __init__(self, bucket_name=ARCHIVE_BUCKET):
+        from firebase_admin import storage
+        self._bucket = storage.bucket(bucket_name)
+
+    def read(self, name):
+        blob = self._bucket.blob(name)
+        return blob.download_as_bytes() if blob.exists() else None
+
+    def write(self, name, data):
+        self._bucket.blob(name).upload_from_string(data, content_type="application/gzip" if name.endswith(".gz") else "application/json")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = BucketArchiveStore() if ARCHIVE_BUCKET else LocalArchiveStore()
+        return _store
+
+
+# --- Columnar encoding ---
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+
+def _encode_column(values):
+    distinct = list(dict.fromkeys(values))
+    if len(distinct) * 2 <= len(values):
+        index = {value: i for i, value in enumerate(distinct)}
+        return {"dictionary": distinct, "codes": [index[value] for value in values]}
+    return {"values": values}
+
+
+def _decode_column(column):
+    if "dictionary" in column:
+        return [column["dictionary"][code] for code in column["codes"]]
+    return column["values"]
+
+
+def _encode(collection, month, rows, fields):
+    payload = {
+        "collection": collection,
+        "month": month,
+        "count": len(rows),
+        "columns": {field: _encode_column([_iso(row.get(field)) for row in rows]) for field in fields}
+    }
+    return gzip.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+
+def _decode(data):
+    payload = json.loads(gzip.decompress(data).decode("utf-8"))
+    columns = {field: _decode_column(column) for field, column in payload["columns"].items()}
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def _shift_rows(docs):
+    return [{"id": doc_id, **data} for doc_id, data in sorted(docs.items(), key=lambda d: d[1].get("timestamp") or "")]
+
+
+def _shift_docs(rows):
+    return {row.pop("id"): row for row in rows}
+
+
+def _attendance_rows(docs):
+    # One row per student mark; a day without marks keeps one row with no student.
+    rows = []
+    for doc_id, data in sorted(docs.items()):
+        students = {**(data.get("student_id") or {}), **(data.get("student") or {})}
+        base = {"id": doc_id, "location": data.get("location"), "date": data.get("date")}
+        if not students:
+            rows.append(base)
+        for student_id, mark in students.items():
+            rows.append({**base, "student_id": student_id, "status": mark.get("status"),
+                         "timestamp": mark.get("timestamp"), "last_edited": mark.get("last_edited")})
+    return rows
+
+
+def _attendance_docs(rows):
+    docs = {}
+    for row in rows:
+        doc = docs.setdefault(row["id"], {"location": row["location"], "date": row["date"], "student": {}})
+        if row.get("student_id") is not None:
+            doc["student"][row["student_id"]] = {"status": row.get("status"), "timestamp": row.get("timestamp"),
+                                                 "last_edited": row.get("last_edited")}
+    return docs
+
+
+def _month_range(month):
+    start = datetime.strptime(month, "%Y-%m").date()
+    end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return start, end
+
+
+def _shift_month_query(month):
+    start, end = _month_range(month)
+    return (db.collection("shifts")
+            .where("timestamp", ">=", datetime.combine(start, datetime.min.time()).isoformat())
+            .where("timestamp", "<=", datetime.combine(end, datetime.max.time()).isoformat()))
+
+
+def _attendance_month_query(month):
+    start, end = _month_range(month)
+    return db.collection("attendance").where("date", ">=", start.isoformat()).where("date", "<=", end.isoformat())
+
+
+def _oldest_shift_month():
+    docs = list(db.collection("shifts").order_by("timestamp").limit(1).stream())
+    return (docs[0].to_dict().get("timestamp") or "")[:7] if docs else None
+
+
+def _oldest_attendance_month():
+    docs = list(db.collection("attendance").order_by("date").limit(1).stream())
+    return (docs[0].to_dict().get("date") or "")[:7] if docs else None
+
+
+# collection: (fields, docs -> rows, rows -> docs, month -> query, oldest month with documents)
+COLLECTIONS = {
+    "shifts": (SHIFT_FIELDS, _shift_rows, _shift_docs, _shift_month_query, _oldest_shift_month),
+    "attendance": (ATTENDANCE_FIELDS, _attendance_rows, _attendance_docs, _attendance_month_query,
+                   _oldest_attendance_month),
+}
+
+
+# --- Manifest ---
+
+_manifest = None
+_manifest_loaded_at = 0.0
+_manifest_lock = threading.RLock()
+
+
+def get_manifest(refresh=False):
+    """
+    Returns the archive manifest: {"months": {"<collection>/<YYYY-MM>": entry}} where each
+    entry has the file name, document count, sha256 and when it was last written.
+    """
+    global _manifest, _manifest_loaded_at
+    with _manifest_lock:
+        if refresh or _manifest is None or time.time() - _manifest_loaded_at > MANIFEST_TTL_SECONDS:
+            data = get_store().read(MANIFEST)
+            _manifest = json.loads(data) if data else {"months": {}}
+            _manifest_loaded_at = time.time()
+        return _manifest
+
+
+def _save_manifest(manifest):
+    global _manifest, _manifest_loaded_at
+    with _manifest_lock:
+        manifest["updated_at"] = datetime.now().isoformat()
+        get_store().write(MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+        _manifest, _manifest_loaded_at = manifest, time.time()
+
+
+def read_month(collection, month):
+    """Returns the archived documents of one month as {doc_id: data} ({} if not archived)."""
+    entry = get_manifest()["months"].get(f"{collection}/{month}")
+    if entry is None:
+        return {}
+    data = get_store().read(entry["file"])
+    if data is None:
+        raise FileNotFoundError(f"Archive file {entry['file']} is listed in the manifest but missing")
+    _, _, to_docs, _, _ = COLLECTIONS[collection]
+    return to_docs(_decode(data))
+
+
+# --- Archival ---
+
+def _closed_months(oldest, cutoff):
+    """Months from oldest ("YYYY-MM") whose last day is before cutoff."""
+    months = []
+    month = oldest
+    while month and _month_range(month)[1] < cutoff:
+        months.append(month)
+        year, number = map(int, month.split("-"))
+        month = f"{year + number // 12}-{number % 12 + 1:02d}"
+    return months
+
+
+def _delete_in_batches(collection, doc_ids):
+    deleted = 0
+    for start in range(0, len(doc_ids), BATCH_LIMIT):
+        batch = db.batch()
+        chunk = doc_ids[start:start + BATCH_LIMIT]
+        for doc_id in chunk:
+            batch.delete(db.collection(collection).document(doc_id))
+        batch.commit()
+        deleted += len(chunk)
+        inc("archive_documents_deleted_total", {"collection": collection}, len(chunk))
+        if start + BATCH_LIMIT < len(doc_ids):
+            time.sleep(DELETE_PAUSE_SECONDS)
+    return deleted
+
+
+def archive_month(collection, month):
+    """
+    Archives and deletes one month of a collection. Safe to repeat.
+
+    Returns:
+        dict: The number of documents newly archived and the month's total in the archive.
+    """
+    fields, to_rows, _, month_query, _ = COLLECTIONS[collection]
+    live = {doc.id: doc.to_dict() or {} for doc in month_query(month).stream()}
+    if not live:
+        return {"archived": 0, "total": get_manifest(refresh=True)["months"].get(f"{collection}/{month}", {}).get("count", 0)}
+
+    # Documents archived by an earlier run are kept; live ones win over archived copies.
+    docs = {**read_month(collection, month), **live}
+    name = f"{collection}/{month}.json.gz"
+    data = _encode(collection, month, to_rows(docs), fields)
+    get_store().write(name, data)
+
+    # Read the file back before anything is deleted.
+    if len(COLLECTIONS[collection][2](_decode(get_store().read(name)))) != len(docs):
+        raise ValueError(f"Archive {name} did not read back with {len(docs)} documents")
+
+    manifest = get_manifest(refresh=True)
+    manifest["months"][f"{collection}/{month}"] = {
+        "collection": collection,
+        "month": month,
+        "file": name,
+        "count": len(docs),
+        "bytes": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "archived_at": datetime.now().isoformat()
+    }
+    _save_manifest(manifest)
+    inc("archive_documents_archived_total", {"collection": collection}, len(live))
+
+    _delete_in_batches(collection, list(live))
+    logger.info(f"Archived {len(live)} {collection} documents for {month} ({len(docs)} in {name})")
+    return {"archived": len(live), "total": len(docs)}
+
+
+def archive_closed_periods(progress=None, today=None):
+    """
+    Archives every month of shifts and attendance that ended more than
+    ARCHIVE_AFTER_DAYS ago.
+
+    Args:
+        progress (callable, optional): Called with (fraction, message) as months are done.
+        today (date, optional): Defaults to today.
+
+    Returns:
+        dict: {"archived": {"<collection>/<YYYY-MM>": documents archived}, "cutoff": ...}
+    """
+    cutoff = (today or datetime.now().date()) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    work = [(collection, month) for collection, (_, _, _, _, oldest) in COLLECTIONS.items()
+            for month in _closed_months(oldest(), cutoff)]
+    archived = {}
+    for i, (collection, month) in enumerate(work):
+        if progress:
+            progress(i / len(work), f"Archiving {collection} for {month}")
+        result = archive_month(collection, month)
+        if result["archived"]:
+            archived[f"{collection}/{month}"] = result["archived"]
+    return {"message": f"Archived {sum(archived.values())} documents.", "archived": archived,
+            "cutoff": cutoff.isoformat()}
+
+
+# --- Reading history ---
+
+def archived_documents(collection, start_date=None, end_date=None):
+    """
+    Returns every archived (doc_id, data) of a collection, optionally limited to the
+    months overlapping start_date..end_date.
+    """
+    docs = []
+    for key, entry in sorted(get_manifest()["months"].items()):
+        if entry["collection"] != collection:
+            continue
+        month_start, month_end = _month_range(entry["month"])
+        if (start_date and month_end < start_date) or (end_date and month_start > end_date):
+            continue
+        docs.extend(read_month(collection, entry["month"]).items())
+    return docs
+
+
+def shift_history(start_date, end_date, location=None, user_id=None):
+    """
+    Returns the (doc_id, shift) pairs between two dates from Firestore and the archive
+    together, sorted by timestamp.
+
+    Args:
+        start_date (date): First day.
+        end_date (date): Last day.
+        location (str, optional): Only shifts at this location.
+        user_id (str, optional): Only this user's shifts.
+    """
+    start_iso = datetime.combine(start_date, datetime.min.time()).isoformat()
+    end_iso = datetime.combine(end_date, datetime.max.time()).isoformat()
+
+    def wanted(shift):
+        return (start_iso <= (shift.get("timestamp") or "") <= end_iso
+                and (location is None or shift.get("location") == location)
+                and (user_id is None or shift.get("user_id") == user_id))
+
+    shifts = {doc_id: shift for doc_id, shift in archived_documents("shifts", start_date, end_date) if wanted(shift)}
+    query = db.collection("shifts").where("timestamp", ">=", start_iso).where("timestamp", "<=", end_iso)
+    if location:
+        query = query.where("location", "==", location)
+    if user_id:
+        query = query.where("user_id", "==", user_id)
+    shifts.update((doc.id, doc.to_dict()) for doc in query.stream())
+    return sorted(shifts.items(), key=lambda item: item[1].get("timestamp") or "")
+
+
+def is_archived(collection, day):
+    """Returns True if the month containing day has been (at least partly) archived."""
+    return f"{collection}/{day.strftime('%Y-%m')}" in get_manifest()["months"]
@@ -0,0 +1,199 @@
+# delta_sync.py
+
+"""
+This file lets the dashboards fetch only the users, attendance, shifts and online
+sessions that changed since their last refresh.
+
+The first call (without a token) returns the current data and a change token. Each
+later call sends the token back and gets:
+
+- "upserted": documents created or updated since the token, found through their
+  updated_at field (set to SERVER_TIMESTAMP by every writer), and
+- "deleted": IDs of documents deleted since the token, found through the
+  'tombstones' collection that deleting code writes to with record_deletions().
+
+So the Firestore reads and the payload grow with the number of changes, not with
+the size of the collections.
+
+The token is opaque to clients. It holds one watermark per collection, which is
+set a few seconds (COMMIT_SKEW) before the request, so a write that was being
+committed while the request ran is sent again next time rather than missed.
+Clients should therefore apply changes as idempotent upserts.
+
+Tombstones are kept for TOMBSTONE_RETENTION_DAYS. An older token gets "reset":
+true with a full snapshot, as does a token for a different location.
+
+Shifts and attendance moved to cold storage are not reported as deleted; they
+still exist in the archive.
+"""
+
+import base64
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from firebase_admin import firestore
+from firebase_config import db
+from logging_google_sheets import get_pay_period_dates
+from metrics import inc
+
+load_dotenv()
+
+TOMBSTONES = 'tombstones'
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+COMMIT_SKEW = timedelta(seconds=5)
+# Changes returned per collection per call; the rest come with "has_more".
+# Larger than a Firestore batch, so a batch that shares one commit timestamp
+# always fits in one page.
+MAX_CHANGES = 1000
+BATCH_LIMIT = 500
+
+COLLECTIONS = ('users', 'attendance', 'shifts', 'online_sessions')
+# Collections whose documents have a location field the sync can be scoped to.
+LOCATION_SCOPED = ('attendance', 'shifts')
+
+
+def record_deletions(collection, doc_ids, location=None, batch=None):
+    """
+    Writes a tombstone for each deleted document so dashboards learn about the deletion.
+
+    Args:
+        collection (str): The collection the documents were deleted from.
+        doc_ids (list): The deleted document IDs.
+        location (str, optional): The documents' location, for location-scoped syncs.
+        batch (WriteBatch, optional): Add the tombstones to this batch instead of
+            committing them straight away (at most BATCH_LIMIT per batch).
+    """
+    own_batch = batch is None
+    for start in range(0, len(doc_ids), BATCH_LIMIT):
+        current = db.batch() if own_batch else batch
+        for doc_id in doc_ids[start:start + BATCH_LIMIT]:
+            current.set(db.collection(TOMBSTONES).document(f"{collection}_{doc_id}"), {
+                'collection': collection,
+                'doc_id': doc_id,
+                'location': location,
+                'deleted_at': firestore.SERVER_TIMESTAMP
+            })
+        if own_batch:
+            current.commit()
+
+
+def purge_tombstones(now=None):
+    """Deletes tombstones older than TOMBSTONE_RETENTION_DAYS. Returns how many."""
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    purged = 0
+    while True:
+        docs = list(db.collection(TOMBSTONES).where('deleted_at', '<', cutoff).limit(BATCH_LIMIT).stream())
+        if not docs:
+            return {"message": f"Purged {purged} tombstones.", "purged": purged}
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        purged += len(docs)
+
+
+def encode_token(watermarks, location):
+    payload = {"v": 1, "location": location, "w": {name: mark.isoformat() for name, mark in watermarks.items()}}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_token(token):
+    """Returns ({collection: watermark datetime}, location). Raises ValueError for a malformed token."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        return {name: datetime.fromisoformat(mark) for name, mark in payload["w"].items()}, payload.get("location")
+    except Exception as e:
+        raise ValueError(f"Invalid change token: {e}")
+
+
+def _serialize(doc_id, data):
+    return {"id": doc_id, **{key: value.isoformat() if isinstance(value, datetime) else value
+                             for key, value in data.items()}}
+
+
+def _snapshot_query(collection, location):
+    """The query for a full snapshot of a collection, as the dashboards show it."""
+    query = db.collection(collection)
+    if collection == 'shifts':
+        # Dashboards show the open pay period; older shifts are reached through /reports.
+        start_date, _ = get_pay_period_dates()
+        query = query.where('timestamp', '>=', datetime.combine(start_date, datetime.min.time()).isoformat())
+    elif collection == 'attendance':
+        start_date, _ = get_pay_period_dates()
+        query = query.where('date', '>=', start_date.isoformat())
+    if location and collection in LOCATION_SCOPED:
+        query = query.where('location', '==', location)
+    return query
+
+
+def _changes_since(collection, since, location):
+    """Returns (upserted documents, deleted IDs, watermark for a next page or None)."""
+    query = db.collection(collection).where('updated_at', '>', since)
+    if location and collection in LOCATION_SCOPED:
+        query = query.where('location', '==', location)
+    docs = list(query.order_by('updated_at').limit(MAX_CHANGES + 1).stream())
+    next_page = None
+    if len(docs) > MAX_CHANGES:
+        docs = docs[:MAX_CHANGES]
+        # Documents committed in the same batch share a timestamp, so the next page
+        # starts just before the last one returned instead of after it.
+        next_page = docs[-1].to_dict()['updated_at'] - timedelta(microseconds=1)
+
+    tombstones = db.collection(TOMBSTONES).where('collection', '==', collection).where('deleted_at', '>', since)
+    deleted = [doc.to_dict() for doc in tombstones.stream()]
+    if location and collection in LOCATION_SCOPED:
+        deleted = [t for t in deleted if t.get('location') in (None, location)]
+    # A document that still exists was re-created after its tombstone was written.
+    upserted = [_serialize(doc.id, doc.to_dict() or {}) for doc in docs]
+    existing = {doc["id"] for doc in upserted}
+    return upserted, [t['doc_id'] for t in deleted if t['doc_id'] not in existing], next_page
+
+
+def changes(token=None, location=None, collections=COLLECTIONS, now=None):
+    """
+    Returns the changes since a token, or a full snapshot without one.
+
+    Args:
+        token (str, optional): The token from the previous call.
+        location (str, optional): Limit attendance and shifts to one location.
+        collections (tuple): The collections to include.
+        now (datetime, optional): The current UTC time.
+
+    Returns:
+        dict: {"token", "reset", "has_more", "changes": {collection: {"upserted": [...], "deleted": [...]}}}
+    """
+    now = now or datetime.now(timezone.utc)
+    watermarks, token_location = decode_token(token) if token else ({}, location)
+    retention_start = now - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    reset = bool(token) and (token_location != location
+                             or any(mark < retention_start for mark in watermarks.values()))
+    if reset:
+        watermarks = {}
+
+    result = {}
+    has_more = False
+    new_watermarks = dict(watermarks)
+    for collection in collections:
+        since = watermarks.get(collection)
+        if since is None:
+            upserted = [_serialize(doc.id, doc.to_dict() or {}) for doc in _snapshot_query(collection, location).stream()]
+            deleted, next_page = [], None
+        else:
+            upserted, deleted, next_page = _changes_since(collection, since, location)
+        result[collection] = {"upserted": upserted, "deleted": deleted}
+        if next_page is not None:
+            has_more = True
+            new_watermarks[collection] = next_page
+        else:
+            new_watermarks[collection] = max(since, now - COMMIT_SKEW) if since else now - COMMIT_SKEW
+        inc("delta_sync_documents_total", {"collection": collection, "mode": "full" if since is None else "delta"},
+            len(upserted) + len(deleted))
+
+    return {
+        "token": encode_token(new_watermarks, location),
+        "reset": reset,
+        "has_more": has_more,
+        "changes": result
+    }
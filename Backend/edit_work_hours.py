@@ -12,12 +12,24 @@ information, without exposing technical details like Firebase UIDs to the end-us
 
 # Import necessary tools for handling dates, connecting to the database, and Google Sheets
 from datetime import datetime, timedelta
+from firebase_admin import firestore
 from firebase_config import db
+import analytics_mirror
+import delta_sync
+import logging
+from cold_storage import is_archived, shift_history
 from clock_in_out import get_location_roster
-from logging_google_sheets import get_gspread_client
-import gspread
+from locations import locations
+from logging_google_sheets import LOG_HEADER
+from report_sheets import write_report
+from workbook_routing import log_workbook
+from sheet_sync import request_sync, sync_status, wait_for_sync
+from shift_ledger import running_ledger
+from name_index import get_name_index
 from flask import Flask, request, jsonify
 
+logger = logging.getLogger(__name__)
+
 
 def _regenerate_log_sheet(location):
     """
@@ -30,15 +42,6 @@ def _regenerate_log_sheet(location):
         location (str): The location for which to regenerate the sheet.
     """
     try:
-        # Get the authorized connection to the Google Sheets API
-        client = get_gspread_client()
-        if not client:
-            # If the connection fails, stop the function and report an error
-            raise Exception("Failed to connect to Google Sheets.")
-
-        # Open the specific Google Sheets workbook by its name
-        workbook = client.open("House of Wisdom Log")
-
         # Get today's date to figure out the current pay period
         today = datetime.now().date()
         # Check if the day is after the 15th to determine the pay period
@@ -54,20 +57,6 @@ def _regenerate_log_sheet(location):
         # Create the exact name for the worksheet, e.g., "Everett - 2025-08-01 to 2025-08-15"
         sheet_name = f"{location} - {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}"
 
-        try:
-            # Try to select the worksheet with that name
-            worksheet = workbook.worksheet(sheet_name)
-        except gspread.exceptions.WorksheetNotFound:
-            # If the worksheet doesn't exist, create a new one
-            worksheet = workbook.add_worksheet(title=sheet_name, rows="250", cols="10")
-
-        # Delete all data currently in the sheet
-        worksheet.clear()
-        # Define the header columns in order
-        header = ["Location", "Role", "First Name", "Last Name", "Timestamp", "Status"]
-        # Add the header as the first row in the now-empty sheet
-        worksheet.append_row(header, value_input_option='USER_ENTERED')
-
         # To work efficiently, first get all users at the location and store them in a map.
         # This avoids asking the database for a user's name every time we see their ID.
         users_ref = db.collection('users').where('tutoringLocation', 'array_contains', location).stream()
@@ -77,61 +66,85 @@ def _regenerate_log_sheet(location):
         start_datetime_iso = datetime.combine(start_date, datetime.min.time()).isoformat()
         end_datetime_iso = datetime.combine(end_date, datetime.max.time()).isoformat()
 
-        # Ask Firestore for all shifts at this location within the pay period, sorted by time
+        # Ask Firestore for all shifts at this location within the pay period, sorted by time.
+        # Not the in-memory ledger: its listener can lag the edit that asked for this rewrite.
         shifts_query = db.collection('shifts').where('location', '==', location).where('timestamp', '>=', start_datetime_iso).where('timestamp', '<=', end_datetime_iso).order_by('timestamp').stream()
+        shifts = (shift.to_dict() for shift in shifts_query)
         
-        # Create an empty list to hold all the rows we're about to create
-        rows_to_append = []
-        # Loop through every single shift record that the database returned
-        for shift in shifts_query:
-            # Convert the Firestore document object into a more usable Python dictionary
-            shift_data = shift.to_dict()
-            # Get the user's unique ID from the shift record
-            user_id = shift_data.get('user_id')
-            # Look up that user's info (name, role) in the map we created earlier
-            user_info = users_map.get(user_id)
-            
-            # Make sure we found the user's info before proceeding
-            if user_info:
-                # Assemble a list of values for the row in the correct order
-                row = [
-                    shift_data.get("location", ""),
-                    user_info.get("role", ""),
-                    user_info.get("firstName", ""),
-                    user_info.get("lastName", ""),
-                    shift_data.get("timestamp"),
-                    shift_data.get("event")  # This will be 'clock-in' or 'clock-out'
-                ]
-                # Add the newly created row to our list of rows to append
-                rows_to_append.append(row)
+        # Turn every shift record into a sheet row, using the user map for names and roles
+        rows_to_append = build_log_rows(shifts, users_map)
         
-        # If the list of rows is not empty...
-        if rows_to_append:
-            # ...add all the rows to the Google Sheet in a single, efficient operation
-            worksheet.append_rows(rows_to_append, value_input_option='USER_ENTERED')
+        # Replace the whole sheet (header and rows) in a single request; nothing is
+        # sent if the sheet already holds exactly these rows
+        write_report(log_workbook(location), sheet_name, LOG_HEADER, rows_to_append)
         
         # Return a success message
         return {"message": f"Sheet for {location} regenerated successfully."}
 
     except Exception as e:
         # If any part of the 'try' block fails, this code runs
-        print(f"Error regenerating sheet for {location}: {e}")
+        logger.error(f"Error regenerating sheet for {location}: {e}")
         return {"error": str(e)}
 
 
+def build_log_rows(shifts, users_map):
+    """
+    Builds the log sheet rows for a sequence of shift records.
+
+    Args:
+        shifts (iterable): Shift dictionaries from the 'shifts' collection, in time order.
+        users_map (dict): Maps user IDs to their profile dictionaries.
+
+    Returns:
+        list: One row per shift whose user is in users_map, in the log sheet column order.
+    """
+    # Create an empty list to hold all the rows we're about to create
+    rows = []
+    # Loop through every single shift record
+    for shift_data in shifts:
+        # Look up that user's info (name, role) in the map we were given
+        user_info = users_map.get(shift_data.get('user_id'))
+        
+        # Make sure we found the user's info before proceeding
+        if user_info:
+            # Assemble a list of values for the row in the correct order
+            rows.append([
+                shift_data.get("location", ""),
+                user_info.get("role", ""),
+                user_info.get("firstName", ""),
+                user_info.get("lastName", ""),
+                shift_data.get("timestamp"),
+                shift_data.get("event")  # This will be 'clock-in' or 'clock-out'
+            ])
+    return rows
+
+
 def find_user_by_name(location, first_name, last_name):
     """
     Helper function to find a user's ID and role by their name and location.
+    Names are matched ignoring case and accents when the location's name index is ready.
+    Returns None if no user matches, and {"error": ...} if several do.
     """
+    ambiguous = {"error": f"More than one user at {location} is named {first_name} {last_name}."}
     try:
+        # Answer from the in-memory name index when it is available
+        index = get_name_index(location)
+        if index is not None:
+            matches = index.lookup(first_name or '', last_name or '')
+            if len(matches) > 1:
+                return ambiguous
+            return {'id': matches[0]['uid'], 'role': matches[0]['role']} if matches else None
+
         # Point to the 'users' collection in the database
         users_ref = db.collection('users')
         # Build a query to find a user where location, first name, and last name all match
         query = users_ref.where('tutoringLocation', 'array_contains', location).where('firstName', '==', first_name).where('lastName', '==', last_name)
-        # Execute the query
-        docs = query.stream()
-        # Get the first result from the query, or None if no user was found
-        user = next(docs, None)
+        # Execute the query; two results are enough to tell that the name is ambiguous
+        users = list(query.limit(2).stream())
+        if len(users) > 1:
+            return ambiguous
+        # Get the result from the query, or None if no user was found
+        user = users[0] if users else None
         # If a user was found...
         if user:
             # ...return a dictionary with their unique ID and their role
@@ -139,16 +152,68 @@ def find_user_by_name(location, first_name, last_name):
         # If no user was found, return None
         return None
     except Exception as e:
-        print(f"Error finding user by name: {e}")
+        logger.error(f"Error finding user by name: {e}")
         return None
 
 
+def pair_shift_events(shifts):
+    """
+    Pairs each clock-in with the clock-out that directly follows it.
+
+    Args:
+        shifts (list): (document_id, shift_data) tuples for one user, sorted by timestamp.
+
+    Returns:
+        list: One dictionary per complete shift with the IDs and times of both events.
+    """
+    # Create an empty list to store the final, paired-up shifts
+    paired_shifts = []
+    
+    # A counter to keep track of our position in the list of shifts
+    i = 0
+    # Loop through the list of shifts as long as our counter is valid
+    while i < len(shifts):
+        # Get the current shift document ID and its data
+        shift_id, shift_data = shifts[i]
+        # Check if the current shift is a 'clock-in' AND the next item is a 'clock-out'
+        if shift_data.get('event') == 'clock-in' and i + 1 < len(shifts) and shifts[i+1][1].get('event') == 'clock-out':
+            # If so, we have found a complete pair
+            clock_out_id, clock_out_data = shifts[i+1]
+            # Create a dictionary holding all the info for this single shift
+            paired_shifts.append({
+                'clock_in_id': shift_id,
+                'clock_out_id': clock_out_id,
+                'start_time': shift_data['timestamp'],
+                'end_time': clock_out_data['timestamp']
+            })
+            # We've processed two items (in and out), so jump ahead by 2
+            i += 2
+        else:
+            # An unmatched clock-in is an incomplete shift, and anything else is skipped.
+            # Just move to the next item to keep searching.
+            i += 1
+    # Return the list of complete, paired shifts
+    return paired_shifts
+
+
 def find_shifts_for_user(user_id, date):
     """
     Helper function to retrieve all shifts for a specific user on a given date.
     Returns paired clock-in/out events.
     """
     try:
+        # Days in the open pay period are answered from the locations' in-memory ledgers
+        # when they are all already running; a look-up does not start or wait for them.
+        day = datetime.fromisoformat(f"{date}T00:00:00").date()
+        ledgers = [running_ledger(location, day) for location in locations]
+        if all(ledger is not None for ledger in ledgers):
+            events = [event for ledger in ledgers for event in ledger.shifts_for_user(user_id, day.isoformat())]
+            return pair_shift_events(sorted(events, key=lambda event: event[1]['timestamp']))
+
+        # Days in archived months are read from the archive and Firestore together
+        if is_archived('shifts', day):
+            return pair_shift_events(shift_history(day, day, user_id=user_id))
+
         # Get the exact start (midnight) and end (11:59:59 PM) of the given date
         start_dt = datetime.fromisoformat(f"{date}T00:00:00")
         end_dt = datetime.fromisoformat(f"{date}T23:59:59")
@@ -156,46 +221,10 @@ def find_shifts_for_user(user_id, date):
         # Ask the database for all shifts for this user on this day, sorted by time
         shifts_query = db.collection('shifts').where('user_id', '==', user_id).where('timestamp', '>=', start_dt.isoformat()).where('timestamp', '<=', end_dt.isoformat()).order_by('timestamp').stream()
         
-        # Get all the found shifts into a list to easily work with them
-        shifts = list(shifts_query)
-        # Create an empty list to store the final, paired-up shifts
-        paired_shifts = []
-        
-        # A counter to keep track of our position in the list of shifts
-        i = 0
-        # Loop through the list of shifts as long as our counter is valid
-        while i < len(shifts):
-            # Get the current shift document and its data
-            shift_doc = shifts[i]
-            shift_data = shift_doc.to_dict()
-            # Check if the current shift is a 'clock-in'
-            if shift_data.get('event') == 'clock-in':
-                # If it is, this is the start of a potential pair
-                clock_in_doc = shift_doc
-                # Check if there is a next item in the list AND if that item is a 'clock-out'
-                if i + 1 < len(shifts) and shifts[i+1].to_dict().get('event') == 'clock-out':
-                    # If so, we have found a complete pair
-                    clock_out_doc = shifts[i+1]
-                    # Create a dictionary holding all the info for this single shift
-                    paired_shifts.append({
-                        'clock_in_id': clock_in_doc.id,
-                        'clock_out_id': clock_out_doc.id,
-                        'start_time': clock_in_doc.to_dict()['timestamp'],
-                        'end_time': clock_out_doc.to_dict()['timestamp']
-                    })
-                    # We've processed two items (in and out), so jump ahead by 2
-                    i += 2
-                else:
-                    # If we found a clock-in but no matching clock-out, it's an incomplete shift.
-                    # Just move to the next item to keep searching.
-                    i += 1
-            else:
-                # If the current item is not a 'clock-in', just move to the next one
-                i += 1
-        # Return the list of complete, paired shifts
-        return paired_shifts
+        # Convert each document once and pair up the clock-in/out events
+        return pair_shift_events([(shift.id, shift.to_dict()) for shift in shifts_query])
     except Exception as e:
-        print(f"Error finding shifts for user: {e}")
+        logger.error(f"Error finding shifts for user: {e}")
         return []
 
 def edit_work_hours(location, clock_in_id, clock_out_id, new_start_time, new_end_time):
@@ -204,17 +233,18 @@ def edit_work_hours(location, clock_in_id, clock_out_id, new_start_time, new_end
     """
     try:
         # Find the clock-in document by its ID and update its timestamp
-        db.collection('shifts').document(clock_in_id).update({'timestamp': new_start_time})
+        db.collection('shifts').document(clock_in_id).update({'timestamp': new_start_time, 'updated_at': firestore.SERVER_TIMESTAMP})
         # Find the clock-out document by its ID and update its timestamp
-        db.collection('shifts').document(clock_out_id).update({'timestamp': new_end_time})
+        db.collection('shifts').document(clock_out_id).update({'timestamp': new_end_time, 'updated_at': firestore.SERVER_TIMESTAMP})
         
-        # Call our helper function to update the Google Sheet with the corrected data
-        _regenerate_log_sheet(location)
+        # Queue a background rewrite of the Google Sheet with the corrected data.
+        # Several edits in a row are combined into one rewrite.
+        sheet_sync = request_sync(location)
         
         # Return a success message
-        return {"message": "Shift updated successfully."}
+        return {"message": "Shift updated successfully.", "sheet_sync": sheet_sync}
     except Exception as e:
-        print(f"Error editing work hours: {e}")
+        logger.error(f"Error editing work hours: {e}")
         return {"error": str(e)}
 
 def remove_shift(location, clock_in_id, clock_out_id):
@@ -226,14 +256,19 @@ def remove_shift(location, clock_in_id, clock_out_id):
         db.collection('shifts').document(clock_in_id).delete()
         # Find the clock-out document by its ID and delete it
         db.collection('shifts').document(clock_out_id).delete()
-
-        # Call our helper function to update the Google Sheet so the shift is removed
-        _regenerate_log_sheet(location)
+        # Deletions carry no updated_at, so drop them from the local analytics mirror too
+        analytics_mirror.forget('shifts', [clock_in_id, clock_out_id])
+        # ...and leave tombstones so /sync/changes reports them as deleted
+        delta_sync.record_deletions('shifts', [clock_in_id, clock_out_id], location)
+
+        # Queue a background rewrite of the Google Sheet so the shift is removed.
+        # Several edits in a row are combined into one rewrite.
+        sheet_sync = request_sync(location)
         
         # Return a success message
-        return {"message": "Shift removed successfully."}
+        return {"message": "Shift removed successfully.", "sheet_sync": sheet_sync}
     except Exception as e:
-        print(f"Error removing shift: {e}")
+        logger.error(f"Error removing shift: {e}")
         return {"error": str(e)}
 
 
@@ -247,6 +282,8 @@ def add_shift(location, first_name, last_name, start_time, end_time):
         # If no user is found, stop and return an error
         if not user_info:
             return {"error": "User not found."}
+        if "error" in user_info:
+            return user_info
         
         # Get the user's unique ID and role from the info we found
         user_id = user_info['id']
@@ -258,7 +295,8 @@ def add_shift(location, first_name, last_name, start_time, end_time):
             'user_id': user_id,
             'timestamp': start_time,
             'location': location,
-            'role': role
+            'role': role,
+            'updated_at': firestore.SERVER_TIMESTAMP
         })
         
         # Create the 'clock-out' record in the database
@@ -267,16 +305,18 @@ def add_shift(location, first_name, last_name, start_time, end_time):
             'user_id': user_id,
             'timestamp': end_time,
             'location': location,
-            'role': role
+            'role': role,
+            'updated_at': firestore.SERVER_TIMESTAMP
         })
 
-        # Call our helper function to update the Google Sheet with the new shift included
-        _regenerate_log_sheet(location)
+        # Queue a background rewrite of the Google Sheet with the new shift included.
+        # Several edits in a row are combined into one rewrite.
+        sheet_sync = request_sync(location)
         
         # Return a success message
-        return {"message": "Shift added successfully."}
+        return {"message": "Shift added successfully.", "sheet_sync": sheet_sync}
     except Exception as e:
-        print(f"Error adding shift: {e}")
+        logger.error(f"Error adding shift: {e}")
         return {"error": str(e)}
 
 # Initialize Flask app
@@ -292,10 +332,31 @@ def get_shifts():
     user_info = find_user_by_name(location, first_name, last_name)
     if not user_info:
         return jsonify({"error": "User not found."}), 404
+    if "error" in user_info:
+        return jsonify(user_info), 409
 
     shifts = find_shifts_for_user(user_info['id'], date)
     return jsonify(shifts)
 
+@app.route('/users/search', methods=['GET'])
+def search_users():
+    """
+    Typeahead for the Senior PM's staff picker: returns up to ?limit= (default 10)
+    users at ?location= whose names start with the words of ?q=, ignoring case and accents.
+    """
+    location = request.args.get('location')
+    query = request.args.get('q', '')
+    if not location:
+        return jsonify({"error": "location is required"}), 400
+    try:
+        index = get_name_index(location)
+        if index is None:
+            return jsonify({"error": "The name index is not available right now."}), 503
+        limit = min(request.args.get('limit', 10, type=int), 50)
+        return jsonify(index.search(query, limit))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/edit_shift', methods=['POST'])
 def edit_shift():
     data = request.json
@@ -330,5 +391,21 @@ def add_shift():
     result = add_shift(location, first_name, last_name, start_time, end_time)
     return jsonify(result)
 
+@app.route('/sheet_sync/<location>', methods=['GET'])
+def get_sheet_sync_status(location):
+    """
+    Returns whether a location's log sheet has caught up with the shift edits.
+    With ?wait=<seconds> (up to 60), waits for the sync to finish before answering;
+    ?version=<n> waits for the version returned by a particular edit.
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), 60)
+        version = request.args.get('version', type=int)
+        if wait > 0:
+            return jsonify(wait_for_sync(location, version, wait))
+        return jsonify(sync_status(location))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 if __name__ == '__main__':
     app.run(debug=True)
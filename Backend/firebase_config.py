@@ -1,17 +1,21 @@
 # firebase_config.py
 import firebase_admin
 from firebase_admin import credentials, firestore
+from firestore_instrumentation import instrument_client
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 # Path to your downloaded service account key JSON file
 service_account_key_path = os.path.join(os.path.dirname(__file__), 'serviceAccountKey.json')
 
 try:
     cred = credentials.Certificate(service_account_key_path)
     firebase_admin.initialize_app(cred)
-    db = firestore.client() # Initialize Firestore client
-    print("Firebase Admin SDK initialized successfully.")
+    db = instrument_client(firestore.client()) # Initialize Firestore client (timed for /metrics)
+    logger.info("Firebase Admin SDK initialized successfully.")
 except Exception as e:
-    print(f"Error initializing Firebase Admin SDK: {e}")
+    logger.error(f"Error initializing Firebase Admin SDK: {e}")
     db = None
     exit(1)
\ No newline at end of file
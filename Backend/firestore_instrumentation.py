@@ -0,0 +1,416 @@
+# firestore_instrumentation.py
+
+"""
+This file wraps the Firestore client from firebase_config so that every database call
+is timed and counted, without changing any of the code that uses `db`.
+
+For every call it records:
+- the latency and count of the call in metrics.py,
+- how many documents were read or written, per route and per query shape
+  (e.g. "shifts where user_id == ? and location == ? order_by timestamp"),
+- a slow-query log line when a query is slower than FIRESTORE_SLOW_QUERY_MS or reads
+  more than FIRESTORE_SLOW_QUERY_READS documents,
+- a daily read/write cost report per endpoint, served at /metrics/firestore_cost.
+
+Every call also goes through the deadline and retry policy in firestore_retry.py,
+and is traced as a span with its query shape (see tracing.py).
+
+The wrappers behave like the objects they wrap: anything that is not a database call
+(for example `.id`, `.path` or `.on_snapshot`) is passed straight through.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from flask import g, jsonify, request
+import firestore_retry
+from metrics import current_route, describe, inc, track_call
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv("FIRESTORE_SLOW_QUERY_MS", "500"))
+SLOW_QUERY_READS = int(os.getenv("FIRESTORE_SLOW_QUERY_READS", "1000"))
+# Firestore list prices in USD, used to estimate the daily cost report.
+PRICE_PER_100K_READS = float(os.getenv("FIRESTORE_PRICE_PER_100K_READS", "0.06"))
+PRICE_PER_100K_WRITES = float(os.getenv("FIRESTORE_PRICE_PER_100K_WRITES", "0.18"))
+# How many days of cost reports are kept in memory.
+REPORT_RETENTION_DAYS = 31
+
+# Query methods that build a new query instead of running one.
+QUERY_BUILDERS = {
+    'limit', 'limit_to_last', 'offset', 'select',
+    'start_at', 'start_after', 'end_at', 'end_before'
+}
+
+# Document reads and writes made by the request currently being served.
+_request_usage = ContextVar("firestore_request_usage", default=None)
+
+_report_lock = threading.Lock()
+# {date: {route: {"requests": n, "reads": n, "writes": n, "shapes": {shape: {"calls", "reads", "writes"}}}}}
+_daily_reports = {}
+
+
+def _unwrap(value):
+    """Returns the real Firestore object behind a wrapper (or the value itself)."""
+    return getattr(value, '_wrapped', value)
+
+
+def _collection_shape(path):
+    """Turns a path like ('users', 'abc', 'sessions') into 'users/*/sessions'."""
+    return "/".join(path[::2])
+
+
+def _route_report(day, route):
+    report = _daily_reports.setdefault(day, {})
+    return report.setdefault(route, {"requests": 0, "reads": 0, "writes": 0, "shapes": {}})
+
+
+def _record(shape, reads=0, writes=0, seconds=0.0):
+    """Adds one call's document counts to the metrics, the request and the daily report."""
+    route = current_route.get()
+    labels = {"route": route, "shape": shape}
+    if reads:
+        inc("firestore_documents_read_total", labels, reads)
+    if writes:
+        inc("firestore_documents_written_total", labels, writes)
+
+    usage = _request_usage.get()
+    if usage is not None:
+        usage["reads"] += reads
+        usage["writes"] += writes
+
+    day = datetime.now().date().isoformat()
+    with _report_lock:
+        route_report = _route_report(day, route)
+        route_report["reads"] += reads
+        route_report["writes"] += writes
+        shape_report = route_report["shapes"].setdefault(shape, {"calls": 0, "reads": 0, "writes": 0})
+        shape_report["calls"] += 1
+        shape_report["reads"] += reads
+        shape_report["writes"] += writes
+
+    if seconds * 1000 >= SLOW_QUERY_MS or reads >= SLOW_QUERY_READS:
+        logger.warning(f"Slow Firestore query on {route}: {shape} read {reads} documents "
+                       f"in {seconds * 1000:.0f} ms")
+
+
+class _Wrapper:
+    def __init__(self, wrapped):
+        self._wrapped = wrapped
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def __eq__(self, other):
+        return self._wrapped == _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._wrapped)
+
+    def __repr__(self):
+        return f"Instrumented({self._wrapped!r})"
+
+
+class InstrumentedDocument(_Wrapper):
+    """Wraps a DocumentReference."""
+
+    def __init__(self, wrapped):
+        super().__init__(wrapped)
+        self._shape = f"doc {_collection_shape(wrapped._path[:-1])}"
+
+    def _write(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        # create() fails if an earlier attempt went through, and Increment would add twice.
+        idempotent = method != 'create' and not any(firestore_retry.has_increment(arg) for arg in args)
+        result = firestore_retry.call('write', lambda **options: getattr(self._wrapped, method)(*args, **options),
+                                      kwargs, idempotent, shape=f"{self._shape} {method}")
+        _record(f"{self._shape} {method}", writes=1, seconds=time.perf_counter() - start)
+        return result
+
+    def get(self, *args, **kwargs):
+        start = time.perf_counter()
+        snapshot = firestore_retry.call('read', lambda **options: self._wrapped.get(*args, **options), kwargs,
+                                        shape=f"{self._shape} get")
+        # A lookup is billed as one read even when the document does not exist.
+        _record(f"{self._shape} get", reads=1, seconds=time.perf_counter() - start)
+        return snapshot
+
+    def set(self, *args, **kwargs):
+        return self._write('set', *args, **kwargs)
+
+    def create(self, *args, **kwargs):
+        return self._write('create', *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self._write('update', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._write('delete', *args, **kwargs)
+
+    def collection(self, *args, **kwargs):
+        return InstrumentedQuery(self._wrapped.collection(*args, **kwargs))
+
+
+class InstrumentedQuery(_Wrapper):
+    """Wraps a CollectionReference or a Query and remembers the shape of the query."""
+
+    def __init__(self, wrapped, shape=None):
+        super().__init__(wrapped)
+        self._shape = shape or _collection_shape(wrapped._path)
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if name in QUERY_BUILDERS:
+            def build(*args, **kwargs):
+                shape = self._shape if name in ('select', 'start_at', 'start_after', 'end_at', 'end_before') else f"{self._shape} {name}"
+                return InstrumentedQuery(attr(*args, **kwargs), shape)
+            return build
+        return attr
+
+    def where(self, *args, **kwargs):
+        if len(args) >= 2:
+            field, op = args[0], args[1]
+        else:
+            field_filter = kwargs.get('filter')
+            field = getattr(field_filter, 'field_path', 'filter')
+            op = getattr(field_filter, 'op_string', '?')
+        separator = " and " if " where " in self._shape else " where "
+        return InstrumentedQuery(self._wrapped.where(*args, **kwargs), f"{self._shape}{separator}{field} {op} ?")
+
+    def order_by(self, field, *args, **kwargs):
+        return InstrumentedQuery(self._wrapped.order_by(field, *args, **kwargs), f"{self._shape} order_by {field}")
+
+    def document(self, *args, **kwargs):
+        return InstrumentedDocument(self._wrapped.document(*args, **kwargs))
+
+    def stream(self, *args, **kwargs):
+        # The read is only finished once the caller stops iterating, so the timer
+        # runs for as long as the generator is open. Its span is not made current,
+        # since the caller's own code runs between the snapshots.
+        start = time.perf_counter()
+        count = 0
+        try:
+            with track_call('firestore', 'read', activate=False, query=self._shape):
+                for snapshot in firestore_retry.stream('query', lambda **options: self._wrapped.stream(*args, **options),
+                                                       kwargs, self._resume_after(args)):
+                    count += 1
+                    yield snapshot
+        finally:
+            # A query that matches nothing is still billed as one read.
+            _record(self._shape, reads=max(count, 1), seconds=time.perf_counter() - start)
+
+    def _resume_after(self, args):
+        """
+        Returns how to resume the stream after a snapshot, or None if the query has a
+        limit or offset, which start_after() would apply a second time.
+        """
+        query = self._wrapped
+        if (getattr(query, '_limit', None) is not None or getattr(query, '_limit_to_last', False)
+                or getattr(query, '_offset', None)):
+            return None
+        return lambda last: (lambda **options: query.start_after(last).stream(*args, **options))
+
+    def get(self, *args, **kwargs):
+        start = time.perf_counter()
+        snapshots = firestore_retry.call('query', lambda **options: self._wrapped.get(*args, **options), kwargs,
+                                         shape=self._shape)
+        _record(self._shape, reads=max(len(snapshots), 1), seconds=time.perf_counter() - start)
+        return snapshots
+
+    def on_snapshot(self, callback):
+        # A listener is billed one read per document in the initial result set and
+        # one per document that changes afterwards.
+        shape = f"listen {self._shape}"
+
+        def counted(snapshots, changes, read_time):
+            _record(shape, reads=len(changes))
+            return callback(snapshots, changes, read_time)
+
+        return self._wrapped.on_snapshot(counted)
+
+    def add(self, *args, **kwargs):
+        start = time.perf_counter()
+        # add() picks a new document ID on each attempt, so a retry could create a duplicate.
+        update_time, doc_ref = firestore_retry.call('write', lambda **options: self._wrapped.add(*args, **options),
+                                                    kwargs, idempotent=False, shape=f"{self._shape} add")
+        _record(f"{self._shape} add", writes=1, seconds=time.perf_counter() - start)
+        return update_time, InstrumentedDocument(doc_ref)
+
+
+class InstrumentedBatch(_Wrapper):
+    """Wraps a WriteBatch. The writes are only sent (and counted) on commit."""
+
+    def __init__(self, wrapped):
+        super().__init__(wrapped)
+        self._collections = {}
+        self._idempotent = True
+
+    def _add(self, method, reference, *args, **kwargs):
+        reference = _unwrap(reference)
+        collection = _collection_shape(reference._path[:-1])
+        self._collections[collection] = self._collections.get(collection, 0) + 1
+        if method == 'create' or any(firestore_retry.has_increment(arg) for arg in args):
+            self._idempotent = False
+        return getattr(self._wrapped, method)(reference, *args, **kwargs)
+
+    def set(self, reference, *args, **kwargs):
+        return self._add('set', reference, *args, **kwargs)
+
+    def create(self, reference, *args, **kwargs):
+        return self._add('create', reference, *args, **kwargs)
+
+    def update(self, reference, *args, **kwargs):
+        return self._add('update', reference, *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        return self._add('delete', reference, *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = firestore_retry.call('write', lambda **options: self._wrapped.commit(*args, **options),
+                                      kwargs, self._idempotent, shape=f"batch {', '.join(self._collections)}")
+        seconds = time.perf_counter() - start
+        for collection, writes in self._collections.items():
+            _record(f"batch {collection}", writes=writes, seconds=seconds)
+        self._collections = {}
+        self._idempotent = True
+        return result
+
+
+class InstrumentedClient(_Wrapper):
+    """Wraps the Firestore Client returned by firestore.client()."""
+
+    def collection(self, *args, **kwargs):
+        return InstrumentedQuery(self._wrapped.collection(*args, **kwargs))
+
+    def collection_group(self, collection_id):
+        return InstrumentedQuery(self._wrapped.collection_group(collection_id), f"group {collection_id}")
+
+    def document(self, *args, **kwargs):
+        return InstrumentedDocument(self._wrapped.document(*args, **kwargs))
+
+    def batch(self, *args, **kwargs):
+        return InstrumentedBatch(self._wrapped.batch(*args, **kwargs))
+
+    def get_all(self, references, *args, **kwargs):
+        references = [_unwrap(ref) for ref in references]
+        if not references:
+            return
+        shape = f"get_all {_collection_shape(references[0]._path[:-1])}"
+        start = time.perf_counter()
+        # get_all returns documents in any order, so a resumed call asks for the rest by path.
+        received = set()
+
+        def resume_after(last):
+            remaining = [ref for ref in references if ref._path not in received]
+            return lambda **options: self._wrapped.get_all(remaining, *args, **options)
+
+        try:
+            with track_call('firestore', 'read', activate=False, query=shape):
+                for snapshot in firestore_retry.stream(
+                        'read', lambda **options: self._wrapped.get_all(references, *args, **options), kwargs, resume_after):
+                    received.add(snapshot.reference._path)
+                    yield snapshot
+        finally:
+            _record(shape, reads=len(references), seconds=time.perf_counter() - start)
+
+
+def instrument_client(client):
+    """Returns the Firestore client wrapped for metrics collection."""
+    return InstrumentedClient(client)
+
+
+def get_cost_report(day=None):
+    """
+    Builds the Firestore read/write cost report for one day, per endpoint. The
+    counts only cover the requests served by this worker process ("worker").
+
+    Args:
+        day (str, optional): The date in YYYY-MM-DD format. Defaults to today.
+
+    Returns:
+        dict: The per-endpoint totals, the most expensive query shapes of each endpoint,
+              and an estimated cost in USD, sorted from most to least reads.
+    """
+    day = day or datetime.now().date().isoformat()
+    with _report_lock:
+        report = {route: dict(stats, shapes=dict(stats["shapes"])) for route, stats in _daily_reports.get(day, {}).items()}
+
+    endpoints = []
+    for route, stats in report.items():
+        shapes = sorted(({"shape": shape, **counts} for shape, counts in stats["shapes"].items()),
+                        key=lambda s: s["reads"], reverse=True)
+        endpoints.append({
+            "route": route,
+            "requests": stats["requests"],
+            "reads": stats["reads"],
+            "writes": stats["writes"],
+            "reads_per_request": round(stats["reads"] / stats["requests"], 1) if stats["requests"] else None,
+            "estimated_cost_usd": round(stats["reads"] / 100000 * PRICE_PER_100K_READS
+                                        + stats["writes"] / 100000 * PRICE_PER_100K_WRITES, 4),
+            "top_shapes": shapes[:10]
+        })
+    endpoints.sort(key=lambda e: e["reads"], reverse=True)
+
+    return {
+        "date": day,
+        "worker": os.getpid(),
+        "total_reads": sum(e["reads"] for e in endpoints),
+        "total_writes": sum(e["writes"] for e in endpoints),
+        "estimated_cost_usd": round(sum(e["estimated_cost_usd"] for e in endpoints), 4),
+        "endpoints": endpoints
+    }
+
+
+describe("firestore_documents_read_total", "Firestore documents read, by route and query shape.")
+describe("firestore_documents_written_total", "Firestore documents written, by route and query shape.")
+
+
+def init_app(app):
+    """
+    Counts Firestore documents per request and adds the /metrics/firestore_cost report route.
+    Each response carries X-Firestore-Reads and X-Firestore-Writes headers.
+    """
+
+    @app.before_request
+    def _start_request_usage():
+        g.firestore_usage_token = _request_usage.set({"reads": 0, "writes": 0})
+        g.firestore_retry_token = firestore_retry.begin_request()
+
+    @app.after_request
+    def _finish_request_usage(response):
+        usage = _request_usage.get()
+        if usage is not None:
+            response.headers["X-Firestore-Reads"] = str(usage["reads"])
+            response.headers["X-Firestore-Writes"] = str(usage["writes"])
+            with _report_lock:
+                _route_report(datetime.now().date().isoformat(), current_route.get())["requests"] += 1
+                cutoff = (datetime.now().date() - timedelta(days=REPORT_RETENTION_DAYS)).isoformat()
+                for day in [d for d in _daily_reports if d < cutoff]:
+                    del _daily_reports[day]
+            if usage["reads"] >= SLOW_QUERY_READS:
+                logger.warning(f"Request to {current_route.get()} read {usage['reads']} Firestore documents")
+        return response
+
+    @app.teardown_request
+    def _reset_request_usage(exc):
+        token = g.pop("firestore_usage_token", None)
+        if token is not None:
+            _request_usage.reset(token)
+        retry_token = g.pop("firestore_retry_token", None)
+        if retry_token is not None:
+            firestore_retry.end_request(retry_token)
+
+    @app.route('/metrics/firestore_cost', methods=['GET'])
+    def firestore_cost_report():
+        """
+        Returns the Firestore read/write cost report for a day.
+        Query parameter: date (optional, YYYY-MM-DD) - defaults to today.
+        """
+        return jsonify(get_cost_report(request.args.get('date'))), 200
@@ -0,0 +1,241 @@
+# firestore_retry.py
+
+"""
+This file sets the deadline and retry policy for every Firestore call. The call
+sites do not change: firestore_instrumentation.py runs each call through call()
+or stream().
+
+Deadlines: each call gets a timeout for its class of operation, so a stalled
+backend cannot hold a request thread indefinitely:
+    read   (document get, get_all)         FIRESTORE_READ_DEADLINE_SECONDS   (10)
+    query  (query stream/get)              FIRESTORE_QUERY_DEADLINE_SECONDS  (30)
+    write  (set/update/delete, batch commit) FIRESTORE_WRITE_DEADLINE_SECONDS (15)
+
+Retries: a call that fails with Aborted, ResourceExhausted or ServiceUnavailable
+was not applied, so it is retried. DeadlineExceeded and InternalServerError leave
+the outcome unknown, so only idempotent calls are retried after them; create(),
+add() and writes containing Increment are not. The client library's own retries
+are turned off, so there is one policy instead of two stacked ones.
+
+Back-off is exponential with full jitter (a random sleep up to 0.1s, 0.2s,
+0.4s, ... capped at 2s) for at most FIRESTORE_MAX_ATTEMPTS attempts. Two limits
+keep a slowdown from turning into a retry storm:
+- per request: at most FIRESTORE_REQUEST_RETRIES retries in total, and none once
+  the request has been running for FIRESTORE_REQUEST_BUDGET_SECONDS;
+- per process: a retry token bucket (as in gRPC retry throttling). Each failure
+  takes a token and each success returns a tenth of one, and retries stop while
+  the bucket is below half full.
+
+A stream that fails before its first document is started again. One that fails
+after some documents were received (including when a long scan runs past its
+deadline, which covers the whole stream) is resumed after the last document
+received when the caller says how, with a fresh deadline for the rest; queries
+without a limit or offset are resumed with start_after(), and get_all() with the
+references not yet received. Otherwise the error is raised, since the caller may
+already have used the documents received so far. Reads inside a transaction are
+not retried here; @firestore.transactional retries the whole transaction.
+
+Each attempt is traced as its own span, with the query shape and attempt number.
+
+Metrics: firestore_retries_total{operation, error},
+firestore_retries_denied_total{operation, reason} and
+firestore_deadline_exceeded_total{operation}.
+"""
+
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from google.api_core import exceptions as gapi_exceptions
+from google.cloud.firestore_v1.transforms import Increment
+from metrics import describe, inc, track_call
+
+load_dotenv()
+
+DEADLINES = {
+    "read": float(os.getenv("FIRESTORE_READ_DEADLINE_SECONDS", "10")),
+    "query": float(os.getenv("FIRESTORE_QUERY_DEADLINE_SECONDS", "30")),
+    "write": float(os.getenv("FIRESTORE_WRITE_DEADLINE_SECONDS", "15")),
+}
+MAX_ATTEMPTS = int(os.getenv("FIRESTORE_MAX_ATTEMPTS", "4"))
+INITIAL_BACKOFF_SECONDS = 0.1
+MAX_BACKOFF_SECONDS = 2.0
+REQUEST_RETRIES = int(os.getenv("FIRESTORE_REQUEST_RETRIES", "3"))
+REQUEST_BUDGET_SECONDS = float(os.getenv("FIRESTORE_REQUEST_BUDGET_SECONDS", "20"))
+THROTTLE_TOKENS = 100
+THROTTLE_TOKEN_RATIO = 0.1
+
+# Errors meaning the call was not applied: safe to retry any call.
+NOT_APPLIED = (gapi_exceptions.Aborted, gapi_exceptions.ResourceExhausted, gapi_exceptions.ServiceUnavailable)
+# Errors with an unknown outcome: only idempotent calls are retried.
+UNKNOWN_OUTCOME = (gapi_exceptions.DeadlineExceeded, gapi_exceptions.InternalServerError)
+
+describe("firestore_retries_total", "Firestore calls retried, by operation class and error.")
+describe("firestore_retries_denied_total", "Failed Firestore calls not retried, by operation class and reason.")
+describe("firestore_deadline_exceeded_total", "Firestore calls that ran past their deadline.")
+
+# The retry budget of the request currently being served (None outside requests).
+_request_budget = ContextVar("firestore_request_budget", default=None)
+
+
+class RetryThrottle:
+    """Process-wide retry token bucket: retries are allowed while it is over half full."""
+
+    def __init__(self, max_tokens=THROTTLE_TOKENS, token_ratio=THROTTLE_TOKEN_RATIO):
+        self._max = max_tokens
+        self._ratio = token_ratio
+        self._tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    def success(self):
+        with self._lock:
+            self._tokens = min(self._max, self._tokens + self._ratio)
+
+    def failure(self):
+        """Records a failure. Returns whether a retry is allowed."""
+        with self._lock:
+            self._tokens = max(0.0, self._tokens - 1)
+            return self._tokens > self._max / 2
+
+
+_throttle = RetryThrottle()
+
+
+def begin_request():
+    """Gives the current request a fresh retry budget. Returns the token for end_request."""
+    return _request_budget.set({"retries": REQUEST_RETRIES, "deadline": time.monotonic() + REQUEST_BUDGET_SECONDS})
+
+
+def end_request(token):
+    _request_budget.reset(token)
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, INITIAL_BACKOFF_SECONDS * 2 ** attempt))
+
+
+def _retry_delay(operation, error, attempt, idempotent):
+    """Returns how long to sleep before retrying, or None if the error is final."""
+    if isinstance(error, gapi_exceptions.DeadlineExceeded):
+        inc("firestore_deadline_exceeded_total", {"operation": operation})
+    if not isinstance(error, NOT_APPLIED + UNKNOWN_OUTCOME):
+        return None
+    allowed = _throttle.failure()
+    reason = None
+    if isinstance(error, UNKNOWN_OUTCOME) and not idempotent:
+        reason = "not_idempotent"
+    elif attempt + 1 >= MAX_ATTEMPTS:
+        reason = "attempts"
+    elif not allowed:
+        reason = "throttled"
+    delay = _backoff(attempt)
+    budget = _request_budget.get()
+    if reason is None and budget is not None:
+        if budget["retries"] <= 0 or time.monotonic() + delay >= budget["deadline"]:
+            reason = "request_budget"
+        else:
+            budget["retries"] -= 1
+    if reason is not None:
+        inc("firestore_retries_denied_total", {"operation": operation, "reason": reason})
+        return None
+    inc("firestore_retries_total", {"operation": operation, "error": type(error).__name__})
+    return delay
+
+
+def _options(operation, kwargs):
+    # Explicit retry/timeout arguments from the caller win over the policy.
+    return {"retry": None, "timeout": DEADLINES[operation], **kwargs}
+
+
+def call(operation, fn, kwargs, idempotent=True, shape=None):
+    """
+    Runs one Firestore call under the policy.
+
+    Args:
+        operation (str): "read", "query" or "write".
+        fn (callable): Makes the call with the given keyword arguments.
+        kwargs (dict): The caller's keyword arguments.
+        idempotent (bool): Whether repeating the call is harmless.
+        shape (str, optional): The query shape, recorded on the call's span.
+    """
+    options = _options(operation, kwargs)
+    if kwargs.get('transaction') is not None:
+        return fn(**options)
+    attempt = 0
+    while True:
+        try:
+            with track_call('firestore', 'write' if operation == 'write' else 'read', query=shape, attempt=attempt + 1):
+                result = fn(**options)
+            _throttle.success()
+            return result
+        except Exception as e:
+            delay = _retry_delay(operation, e, attempt, idempotent)
+            if delay is None:
+                raise
+        time.sleep(delay)
+        attempt += 1
+
+
+def stream(operation, fn, kwargs, resume_after=None):
+    """
+    Like call(), for calls that return an iterator (stream, get_all).
+
+    Args:
+        operation (str): "read" or "query".
+        fn (callable): Starts the call with the given keyword arguments.
+        kwargs (dict): The caller's keyword arguments.
+        resume_after (callable, optional): Called with the last item received when
+            the call fails partway; returns a function like fn that fetches the
+            remaining items, or None if the call cannot be resumed. Without it, only
+            a failure before the first item is retried.
+    """
+    options = _options(operation, kwargs)
+    if kwargs.get('transaction') is not None:
+        yield from fn(**options)
+        return
+    attempt = 0
+    last = None
+    received = False
+    while True:
+        # Each call, including a resumed one, gets its own deadline.
+        iterator = fn(**options)
+        progressed = False
+        while True:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                if not progressed:
+                    _throttle.success()
+                return
+            except Exception as e:
+                error = e
+                break
+            if not progressed:
+                _throttle.success()
+                # MAX_ATTEMPTS counts failures in a row, so a resumed call that made
+                # progress starts counting again.
+                progressed, attempt = True, 0
+            received, last = True, item
+            yield item
+        if received:
+            resumed = resume_after(last) if resume_after else None
+            if resumed is None:
+                inc("firestore_retries_denied_total", {"operation": operation, "reason": "not_resumable"})
+                raise error
+            fn = resumed
+        delay = _retry_delay(operation, error, attempt, True)
+        if delay is None:
+            raise error
+        time.sleep(delay)
+        attempt += 1
+
+
+def has_increment(value):
+    """Whether a write's data contains an Increment transform (not idempotent)."""
+    if isinstance(value, Increment):
+        return True
+    if isinstance(value, dict):
+        return any(has_increment(v) for v in value.values())
+    return False
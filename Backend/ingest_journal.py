@@ -0,0 +1,358 @@
+# ingest_journal.py
+
+"""
+This file provides an optional, local append-only journal for clock-in/out events.
+
+Without the journal, clock_in_out.log_to_firestore waits for Firestore to acknowledge
+every event, so any Firestore slowdown is felt by the staff member at the kiosk. With
+the journal enabled (set CLOCK_JOURNAL_DIR in the .env file) each event is:
+
+1. Appended to a local journal file and fsync'd to disk.
+2. Acknowledged to the caller straight away.
+3. Written to the 'shifts' collection by a background worker in batched commits.
+
+Every journaled event gets a unique event_id that is also used as its 'shifts'
+document ID. If the server stops after a commit but before the checkpoint is saved,
+the replay on restart simply rewrites the same documents, so each event ends up in
+Firestore exactly once.
+
+Each process claims its own journal "slot" with a file lock, so several gunicorn
+workers can share one journal directory. A restarted worker picks up a free slot and
+replays whatever the previous owner left behind. At startup it also locks every other
+slot no live process holds (e.g. left by a worker count that went down) and moves
+their uncommitted events into its own journal.
+
+A commit that fails with an error Firestore would give again (e.g. InvalidArgument for
+a malformed document) is not retried forever: the batch is retried one event at a
+time, and an event that is rejected on its own is appended to
+clock_journal_dead_letter.jsonl with the error, logged, and skipped, so the events
+behind it are still written.
+
+Each record keeps the traceparent of the request that journaled it, and the span
+of the batched commit links to those requests' traces.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from dotenv import load_dotenv
+from firebase_admin import firestore
+from firebase_config import db
+from google.api_core import exceptions as gapi_exceptions
+from metrics import describe, inc, register_queue_depth
+from tracing import current_traceparent, parse_traceparent, span
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIR = os.getenv("CLOCK_JOURNAL_DIR")
+# Firestore allows at most 500 writes in a single batch commit.
+BATCH_LIMIT = 500
+# How long the worker waits for more events before flushing a partial batch.
+FLUSH_INTERVAL_SECONDS = 0.5
+# Longest wait between retries while Firestore is unavailable.
+MAX_RETRY_DELAY_SECONDS = 30
+# The journal file is truncated once everything is committed and it grows past this size.
+COMPACT_THRESHOLD_BYTES = 1024 * 1024
+MAX_SLOTS = 64
+DEAD_LETTER_FILE = "clock_journal_dead_letter.jsonl"
+# Errors that retrying the same write cannot fix: Firestore rejected the document, or
+# the client could not encode it.
+PERMANENT_ERRORS = (gapi_exceptions.InvalidArgument, ValueError, TypeError)
+
+describe("clock_journal_dead_letters_total", "Journaled clock events Firestore rejected, moved to the dead-letter file.")
+
+
+class ClockEventJournal:
+    """
+    A single process's journal file, its commit checkpoint and the worker that drains it.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.slot, self._lock_file = self._claim_slot()
+        self.journal_path = os.path.join(directory, f"clock_journal_{self.slot}.log")
+        self.checkpoint_path = os.path.join(directory, f"clock_journal_{self.slot}.checkpoint")
+
+        self._condition = threading.Condition()
+        self._pending = deque()
+        self._committed_seq = self._read_checkpoint()
+        self._next_seq = self._committed_seq + 1
+        self._last_flush_at = None
+        self._last_error = None
+
+        self._replay()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._adopt_orphans()
+
+        self._worker = threading.Thread(target=self._run, name=f"clock-journal-{self.slot}", daemon=True)
+        self._worker.start()
+        register_queue_depth("clock_journal", lambda: len(self._pending))
+
+    def _lock_slot(self, slot):
+        """Locks a journal slot and returns the lock file, or None if another process holds it."""
+        lock_file = open(os.path.join(self.directory, f"clock_journal_{slot}.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except OSError:
+            lock_file.close()
+            return None
+
+    def _claim_slot(self):
+        """Locks the first journal slot no other process is using."""
+        for slot in range(MAX_SLOTS):
+            lock_file = self._lock_slot(slot)
+            if lock_file is not None:
+                return slot, lock_file
+        raise RuntimeError(f"All {MAX_SLOTS} clock journal slots in {self.directory} are in use.")
+
+    def _read_checkpoint(self, path=None):
+        try:
+            with open(path or self.checkpoint_path, encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, seq, path=None):
+        """Atomically replaces the checkpoint with the highest committed sequence number."""
+        path = path or self.checkpoint_path
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _replay(self):
+        """Loads every journaled event that was not committed before the last shutdown."""
+        if not os.path.exists(self.journal_path):
+            return
+        damaged = False
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                record = _parse_record(line)
+                if record is None:
+                    # A torn line from a crash mid-write was never acknowledged.
+                    damaged = True
+                    continue
+                self._next_seq = max(self._next_seq, record["seq"] + 1)
+                if record["seq"] > self._committed_seq:
+                    self._pending.append(record)
+        if damaged:
+            # Appending after a torn line would glue the next record onto it, and
+            # that record would then be unreadable on the following restart.
+            self._rewrite_journal()
+        if self._pending:
+            logger.warning(f"Replaying {len(self._pending)} uncommitted clock events from {self.journal_path}")
+
+    def _adopt_orphans(self):
+        """
+        Moves the uncommitted events of every slot no live process holds into this
+        journal. They keep their event_ids, so if this process stops before the old
+        slot's checkpoint is moved past them, writing them twice is harmless.
+        """
+        for slot in range(MAX_SLOTS):
+            journal_path = os.path.join(self.directory, f"clock_journal_{slot}.log")
+            if slot == self.slot or not os.path.exists(journal_path):
+                continue
+            lock_file = self._lock_slot(slot)
+            if lock_file is None:
+                continue
+            try:
+                checkpoint_path = os.path.join(self.directory, f"clock_journal_{slot}.checkpoint")
+                committed_seq = self._read_checkpoint(checkpoint_path)
+                last_seq = committed_seq
+                adopted = []
+                with open(journal_path, "rb") as f:
+                    for line in f:
+                        record = _parse_record(line)
+                        if record is None:
+                            continue
+                        last_seq = max(last_seq, record["seq"])
+                        if record["seq"] > committed_seq:
+                            adopted.append({**record, "seq": self._next_seq})
+                            self._next_seq += 1
+                for record in adopted:
+                    self._journal.write(json.dumps(record) + "\n")
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self._pending.extend(adopted)
+                # Only now that they are in this journal may the old slot forget them.
+                self._write_checkpoint(last_seq, checkpoint_path)
+                os.remove(journal_path)
+                if adopted:
+                    logger.warning(f"Took over {len(adopted)} uncommitted clock events from {journal_path}")
+            finally:
+                lock_file.close()
+
+    def _rewrite_journal(self):
+        """Atomically replaces the journal file with just the uncommitted records."""
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self._pending:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        logger.warning(f"Removed a torn record from {self.journal_path}")
+
+    def append(self, data):
+        """
+        Durably records a clock event and returns once it is on disk.
+
+        Args:
+            data (dict): The 'shifts' document to write.
+
+        Returns:
+            str: The event_id, which will also be the 'shifts' document ID.
+        """
+        with self._condition:
+            record = {
+                "seq": self._next_seq,
+                "event_id": uuid.uuid4().hex,
+                "journaled_at": time.time(),
+                "traceparent": current_traceparent(),
+                "data": data
+            }
+            self._journal.write(json.dumps(record) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._next_seq += 1
+            self._pending.append(record)
+            self._condition.notify()
+        return record["event_id"]
+
+    def _run(self):
+        retry_delay = FLUSH_INTERVAL_SECONDS
+        # After a batch is rejected, its events are committed one at a time up to this
+        # sequence number, to find the ones Firestore rejects.
+        isolate_through_seq = 0
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                size = 1 if self._pending[0]["seq"] <= isolate_through_seq else BATCH_LIMIT
+                # Give a clock-in rush a moment to fill the batch. Every append wakes
+                # the worker, so keep waiting until the interval is over.
+                deadline = time.monotonic() + FLUSH_INTERVAL_SECONDS
+                while len(self._pending) < size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                chunk = [self._pending[i] for i in range(min(size, len(self._pending)))]
+
+            links = [parse_traceparent(record.get("traceparent")) for record in chunk]
+            try:
+                with span("clock_journal flush", links=links, attributes={"events": len(chunk)}):
+                    batch = db.batch()
+                    for record in chunk:
+                        batch.set(db.collection("shifts").document(record["event_id"]),
+                                  {**record["data"], "updated_at": firestore.SERVER_TIMESTAMP})
+                    batch.commit()
+            except Exception as e:
+                self._last_error = str(e)
+                if not isinstance(e, PERMANENT_ERRORS):
+                    logger.error(f"Error flushing clock journal to Firestore, retrying in {retry_delay}s: {e}")
+                    time.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY_SECONDS)
+                    continue
+                if len(chunk) > 1:
+                    logger.error(f"Firestore rejected a clock journal batch, retrying its events one at a time: {e}")
+                    isolate_through_seq = chunk[-1]["seq"]
+                    continue
+                self._dead_letter(chunk[0], e)
+
+            retry_delay = FLUSH_INTERVAL_SECONDS
+            with self._condition:
+                for _ in chunk:
+                    self._pending.popleft()
+                self._committed_seq = chunk[-1]["seq"]
+                self._write_checkpoint(self._committed_seq)
+                self._last_flush_at = time.time()
+                self._last_error = None
+                self._compact_if_drained()
+
+    def _dead_letter(self, record, error):
+        """Appends an event Firestore rejected to the dead-letter file, shared by every slot."""
+        path = os.path.join(self.directory, DEAD_LETTER_FILE)
+        with open(path, "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps({**record, "error": str(error), "failed_at": time.time()}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        inc("clock_journal_dead_letters_total", {})
+        logger.error(f"Firestore rejected clock event {record['event_id']}, moved it to {path}: {error}")
+
+    def _compact_if_drained(self):
+        """Truncates the journal file once every event in it has been committed."""
+        if self._pending or self._journal.tell() < COMPACT_THRESHOLD_BYTES:
+            return
+        self._journal.truncate(0)
+        self._journal.seek(0)
+        os.fsync(self._journal.fileno())
+
+    def status(self):
+        """Reports how far the Firestore writes are behind the journal."""
+        with self._condition:
+            oldest = self._pending[0]["journaled_at"] if self._pending else None
+            return {
+                "enabled": True,
+                "slot": self.slot,
+                "pending_events": len(self._pending),
+                "lag_seconds": round(time.time() - oldest, 3) if oldest else 0,
+                "appended_seq": self._next_seq - 1,
+                "committed_seq": self._committed_seq,
+                "last_flush_at": self._last_flush_at,
+                "last_error": self._last_error
+            }
+
+
+def _parse_record(line):
+    """Returns a journal line's record, or None if the line is torn."""
+    if not line.endswith(b"\n"):
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        # Journals written before torn lines were removed can have a record glued
+        # onto the end of a torn one.
+        start = line.rfind(b'{"seq"')
+        if start <= 0:
+            return None
+        return _parse_record(line[start:])
+    return record if isinstance(record, dict) and "seq" in record else None
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """
+    Returns this process's journal, or None if CLOCK_JOURNAL_DIR is not set. The
+    first call replays uncommitted events, so call it at startup.
+    """
+    global _journal
+    if not JOURNAL_DIR:
+        return None
+    with _journal_lock:
+        if _journal is None:
+            _journal = ClockEventJournal(JOURNAL_DIR)
+        return _journal
+
+
+def journal_status():
+    """Returns the journal lag report, or {"enabled": False} when journaling is off."""
+    journal = get_journal()
+    if journal is None:
+        return {"enabled": False}
+    return journal.status()
@@ -0,0 +1,357 @@
+# job_queue.py
+
+"""
+This file runs long admin operations (report generation, payroll approval, sheet
+cleanup) as background jobs instead of inside the HTTP request.
+
+Jobs are stored in a local SQLite database (JOB_DB_PATH, default jobs.sqlite3 next to
+this file), so their status and results survive a restart, and a job that was
+running when the server stopped is picked up again, unless its kind was registered
+with retry_interrupted=False (e.g. jobs that send emails, where running again after
+a crash could send them twice); those are marked failed instead. A pool of JOB_WORKERS threads
+(default 2) runs them.
+
+Submitting a job returns its ID straight away. If an identical job (same kind and
+parameters) is already queued or running, that job is returned instead of starting
+another one.
+
+Each job runs in a trace span whose parent is the request that submitted it (the
+submitter's traceparent is stored with the job). A job queued by a profiled request
+is profiled too (see profiling.py).
+
+Usage:
+    @job_queue.job("15_day_summary")
+    def run_summary(params, job):
+        job.progress(0.5, "Halfway")
+        return {"message": "done"}
+
+    job, created = job_queue.submit("15_day_summary", {"location": "Everett"})
+    job_queue.get_job(job["id"])
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from metrics import inc, register_queue_depth
+import profiling
+from tracing import current_traceparent, parse_traceparent, set_attribute, span
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3"))
+WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# A running job whose heartbeat is older than this is assumed to belong to a dead process.
+STALE_SECONDS = 120
+# A job interrupted this many times (e.g. it keeps crashing the process) is marked failed.
+MAX_ATTEMPTS = 3
+HEARTBEAT_SECONDS = 30
+# Finished jobs are kept this long for status look-ups.
+RETENTION_DAYS = 7
+# Workers also check the database this often, for jobs submitted by other processes.
+POLL_SECONDS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    dedupe_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    heartbeat_at REAL,
+    traceparent TEXT,
+    profile TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_dedupe ON jobs (dedupe_key) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+# Columns added since the table was first created, for upgrading existing databases.
+_ADDED_COLUMNS = {"traceparent": "TEXT", "profile": "TEXT"}
+
+_handlers = {}
+# Kinds of job that are not run again after being interrupted.
+_no_retry_kinds = set()
+
+
+def job(kind, retry_interrupted=True):
+    """
+    Registers a function as the handler for a kind of job.
+
+    Args:
+        kind (str): The job kind.
+        retry_interrupted (bool): Whether a job of this kind that was running when its
+            process died is run again. Pass False for jobs with side effects that must
+            not happen twice.
+    """
+    def register(fn):
+        _handlers[kind] = fn
+        if not retry_interrupted:
+            _no_retry_kinds.add(kind)
+        return fn
+    return register
+
+
+class JobContext:
+    """Passed to a job handler so it can report progress."""
+
+    def __init__(self, queue, job_id, params):
+        self._queue = queue
+        self.id = job_id
+        self.params = params
+
+    def progress(self, fraction, message=None):
+        """
+        Records how far the job has got.
+
+        Args:
+            fraction (float): Between 0 and 1.
+            message (str, optional): A short description of the current step.
+        """
+        self._queue._update(self.id, progress=max(0.0, min(1.0, fraction)), message=message, heartbeat_at=time.time())
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    job.pop("dedupe_key", None)
+    job.pop("heartbeat_at", None)
+    job.pop("traceparent", None)
+    job.pop("profile", None)
+    return job
+
+
+class JobQueue:
+    """A SQLite-backed job queue with a pool of worker threads."""
+
+    def __init__(self, db_path=DB_PATH, workers=WORKERS):
+        self._db_path = db_path
+        self._local = threading.local()
+        self._wake = threading.Condition()
+        self._running = set()
+        self._running_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+            existing = {column["name"] for column in conn.execute("PRAGMA table_info(jobs)")}
+            for name, column_type in _ADDED_COLUMNS.items():
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+        self._purge_old()
+        self._workers = [threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                         for i in range(max(1, workers))]
+        for worker in self._workers:
+            worker.start()
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+        register_queue_depth("jobs", self.depth)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so each thread has its own.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._connection().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def depth(self):
+        row = self._connection().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+        return row[0]
+
+    def submit(self, kind, params=None):
+        """
+        Queues a job, or returns the matching queued or running job.
+
+        Args:
+            kind (str): A registered job kind.
+            params (dict, optional): JSON-serializable parameters for the handler.
+
+        Returns:
+            tuple: (job dict, True if a new job was created)
+        """
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        params = params or {}
+        dedupe_key = f"{kind}:{json.dumps(params, sort_keys=True)}"
+        conn = self._connection()
+        job_id = uuid.uuid4().hex
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, dedupe_key, status, created_at, traceparent, profile) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(params), dedupe_key, _now(), current_traceparent(), profiling.job_settings()))
+        except sqlite3.IntegrityError:
+            # The partial unique index only allows one queued or running job per key.
+            row = conn.execute("SELECT * FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running')",
+                               (dedupe_key,)).fetchone()
+            if row is not None:
+                inc("jobs_deduplicated_total", {"kind": kind})
+                return _row_to_job(row), False
+            return self.submit(kind, params)
+
+        inc("jobs_submitted_total", {"kind": kind})
+        with self._wake:
+            self._wake.notify()
+        return self.get(job_id), True
+
+    def get(self, job_id):
+        """Returns a job as a dict, or None if there is no such job."""
+        return _row_to_job(self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def list(self, status=None, limit=50):
+        """Returns the most recent jobs, newest first."""
+        if status:
+            rows = self._connection().execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit))
+        else:
+            rows = self._connection().execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [_row_to_job(row) for row in rows]
+
+    def _claim(self):
+        """Marks the oldest queued job (or a stale running one) as running and returns it."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat_at < ?) "
+                "ORDER BY created_at LIMIT 1", (time.time() - STALE_SECONDS,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row["status"] == "running":
+                if row["kind"] in _no_retry_kinds:
+                    conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                                 ("Interrupted; this kind of job is not run again automatically", _now(), row["id"]))
+                    conn.execute("COMMIT")
+                    logger.warning(f"Job {row['id']} ({row['kind']}) was interrupted and is not retried.")
+                    return None
+                if row["attempts"] >= MAX_ATTEMPTS:
+                    conn.execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                                 (f"Interrupted {row['attempts']} times", _now(), row["id"]))
+                    conn.execute("COMMIT")
+                    logger.warning(f"Job {row['id']} ({row['kind']}) was interrupted {row['attempts']} times; giving up.")
+                    return None
+                logger.warning(f"Job {row['id']} ({row['kind']}) stopped sending heartbeats; running it again.")
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (_now(), time.time(), row["id"]))
+            conn.execute("COMMIT")
+            return row
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _work(self):
+        while True:
+            try:
+                row = self._claim()
+            except sqlite3.OperationalError as e:
+                logger.error(f"Error claiming a job: {e}")
+                row = None
+            if row is None:
+                with self._wake:
+                    self._wake.wait(POLL_SECONDS)
+                continue
+            self._execute(row)
+
+    def _execute(self, row):
+        job_id, kind = row["id"], row["kind"]
+        params = json.loads(row["params"])
+        with self._running_lock:
+            self._running.add(job_id)
+        # The job continues the trace of the request that submitted it.
+        with span(f"job {kind}", parent=parse_traceparent(row["traceparent"]), kind="consumer",
+                  attributes={"job.id": job_id, "job.kind": kind, "job.attempt": row["attempts"] + 1}):
+            with profiling.profile_job(row["profile"], job_id, kind):
+                start = time.perf_counter()
+                try:
+                    handler = _handlers.get(kind)
+                    if handler is None:
+                        raise ValueError(f"No handler registered for job kind '{kind}'")
+                    result = handler(params, JobContext(self, job_id, params))
+                    if isinstance(result, dict) and ("error" in result or result.get("status") == "error"):
+                        error = result.get("error") or result.get("message") or "Job failed"
+                        self._update(job_id, status="failed", error=str(error), result=json.dumps(result, default=str),
+                                     finished_at=_now())
+                        status = "failed"
+                    else:
+                        self._update(job_id, status="succeeded", progress=1.0, result=json.dumps(result, default=str),
+                                     finished_at=_now())
+                        status = "succeeded"
+                except Exception as e:
+                    logger.error(f"Job {job_id} ({kind}) failed: {e}")
+                    self._update(job_id, status="failed", error=str(e), finished_at=_now())
+                    status = "failed"
+                finally:
+                    with self._running_lock:
+                        self._running.discard(job_id)
+            set_attribute("job.status", status)
+            inc("jobs_finished_total", {"kind": kind, "status": status})
+            logger.info(f"Job {job_id} ({kind}) {status} in {time.perf_counter() - start:.1f}s")
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            with self._running_lock:
+                running = list(self._running)
+            for job_id in running:
+                try:
+                    self._update(job_id, heartbeat_at=time.time())
+                except sqlite3.OperationalError as e:
+                    logger.error(f"Error updating heartbeat for job {job_id}: {e}")
+
+    def _purge_old(self):
+        cutoff = (datetime.now() - timedelta(days=RETENTION_DAYS)).isoformat()
+        self._connection().execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?", (cutoff,))
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Returns the process-wide job queue, starting its workers on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
+
+
+def submit(kind, params=None):
+    return get_queue().submit(kind, params)
+
+
+def get_job(job_id):
+    return get_queue().get(job_id)
+
+
+def list_jobs(status=None, limit=50):
+    return get_queue().list(status, limit)
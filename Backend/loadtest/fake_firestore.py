@@ -0,0 +1,439 @@
+# fake_firestore.py
+
+"""
+An in-process, in-memory stand-in for the Firestore client, used by the load-test
+harness so the backend can be exercised without touching production data.
+
+It supports the parts of the client API the backend uses: collections, documents,
+where/order_by/limit queries, stream/get, set/update/delete/add, write batches,
+get_all and the field transforms (SERVER_TIMESTAMP, DELETE_FIELD, ArrayUnion,
+ArrayRemove, Increment). Every call can be slowed down and made to fail at a
+configurable rate, to see how the backend behaves when Firestore is slow or flaky.
+"""
+
+import copy
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from google.api_core import exceptions as gapi_exceptions
+from google.cloud.firestore_v1.transforms import (
+    DELETE_FIELD, SERVER_TIMESTAMP, ArrayRemove, ArrayUnion, Increment
+)
+
+# The same operators the real client accepts; anything else raises ValueError.
+VALID_OPERATORS = {'<', '<=', '==', '!=', '>=', '>', 'array_contains', 'array_contains_any', 'in', 'not-in'}
+
+
+class BackendBehavior:
+    """
+    Latency and error injection settings shared by the fake backends.
+
+    Args:
+        latency_ms (float): The average added latency per call.
+        jitter_ms (float): Latency varies uniformly by up to this much either way.
+        error_rate (float): The fraction of calls (0-1) that fail.
+        error_factory (callable): Builds the exception raised for an injected failure.
+        seed (int, optional): Seeds the random generator for repeatable runs.
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error_factory=None, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_factory = error_factory or (lambda op: gapi_exceptions.ServiceUnavailable(f"injected failure in {op}"))
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def before_call(self, op):
+        """Counts the call, sleeps for the configured latency and maybe raises an error."""
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+            delay = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise self.error_factory(op)
+
+
+def _get_field(data, field_path):
+    """Reads a dotted field path such as 'student.abc.status'; returns (found, value)."""
+    value = data
+    for part in str(field_path).split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+
+def _set_field(data, field_path, value):
+    parts = str(field_path).split('.')
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    if value is DELETE_FIELD:
+        data.pop(parts[-1], None)
+    else:
+        data[parts[-1]] = value
+
+
+def _apply_transform(current, value):
+    """Resolves Firestore sentinels and transforms against the current field value."""
+    if value is SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, ArrayUnion):
+        existing = list(current) if isinstance(current, list) else []
+        return existing + [v for v in value.values if v not in existing]
+    if isinstance(value, ArrayRemove):
+        existing = list(current) if isinstance(current, list) else []
+        return [v for v in existing if v not in value.values]
+    if isinstance(value, Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, dict):
+        current = current if isinstance(current, dict) else {}
+        return {k: _apply_transform(current.get(k), v) for k, v in value.items() if v is not DELETE_FIELD}
+    return copy.deepcopy(value)
+
+
+def _merge(current, value):
+    """Deep-merges a set(..., merge=True) payload into the stored document."""
+    for field, new_value in value.items():
+        if new_value is DELETE_FIELD:
+            current.pop(field, None)
+        elif isinstance(new_value, dict) and isinstance(current.get(field), dict):
+            current[field] = _merge(current[field], new_value)
+        else:
+            current[field] = _apply_transform(current.get(field), new_value)
+    return current
+
+
+def _matches(data, field, op, value):
+    found, actual = _get_field(data, field)
+    if op == '!=' or op == 'not-in':
+        if not found:
+            return False
+        return actual != value if op == '!=' else actual not in value
+    if not found:
+        return False
+    if op == '==':
+        return actual == value
+    if op == 'array_contains':
+        return isinstance(actual, list) and value in actual
+    if op == 'array_contains_any':
+        return isinstance(actual, list) and any(v in actual for v in value)
+    if op == 'in':
+        return actual in value
+    try:
+        return {'<': actual < value, '<=': actual <= value, '>': actual > value, '>=': actual >= value}[op]
+    except TypeError:
+        # Firestore only compares values of the same type.
+        return False
+
+
+class FakeSnapshot:
+    """Mimics a DocumentSnapshot."""
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = datetime.now(timezone.utc)
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return _get_field(self._data or {}, field_path)[1]
+
+
+class FakeDocumentReference:
+    """Mimics a DocumentReference."""
+
+    def __init__(self, client, path):
+        self._client = client
+        self._path = tuple(path)
+        self.id = self._path[-1]
+        self.path = "/".join(self._path)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other._path == self._path
+
+    def __hash__(self):
+        return hash(self._path)
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, self._path[:-1])
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self._client, self._path + (collection_id,))
+
+    def get(self, *args, **kwargs):
+        self._client.behavior.before_call('document.get')
+        return self._client._snapshot(self)
+
+    def set(self, data, merge=False, **kwargs):
+        self._client.behavior.before_call('document.set')
+        self._client._write('set', self, data, merge=merge)
+
+    def create(self, data, **kwargs):
+        self._client.behavior.before_call('document.create')
+        self._client._write('create', self, data)
+
+    def update(self, data, **kwargs):
+        self._client.behavior.before_call('document.update')
+        self._client._write('update', self, data)
+
+    def delete(self, **kwargs):
+        self._client.behavior.before_call('document.delete')
+        self._client._write('delete', self, None)
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class FakeQuery:
+    """Mimics a Query: filters, ordering and limits over one collection."""
+
+    def __init__(self, client, path, filters=(), orders=(), limit=None, start_after=None):
+        self._client = client
+        self._path = tuple(path)
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in VALID_OPERATORS:
+            raise ValueError(f"Operator string {op_string!r} is invalid. Valid choices are: {sorted(VALID_OPERATORS)}.")
+        return FakeQuery(self._client, self._path, self._filters + ((field_path, op_string, value),), self._orders, self._limit, self._start_after)
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return FakeQuery(self._client, self._path, self._filters, self._orders + ((field_path, direction),), self._limit, self._start_after)
+
+    def limit(self, count):
+        return FakeQuery(self._client, self._path, self._filters, self._orders, count, self._start_after)
+
+    def start_after(self, snapshot):
+        return FakeQuery(self._client, self._path, self._filters, self._orders, self._limit, snapshot.id)
+
+    def _run(self):
+        results = []
+        for doc_id, data in self._client._documents(self._path):
+            if all(_matches(data, field, op, value) for field, op, value in self._filters):
+                results.append((doc_id, data))
+        for field, direction in reversed(self._orders):
+            # Firestore leaves out documents that do not have the ordered field.
+            results = [r for r in results if _get_field(r[1], field)[0]]
+            results.sort(key=lambda r: _get_field(r[1], field)[1], reverse=str(direction).upper().startswith('DESC'))
+        if self._start_after is not None:
+            ids = [doc_id for doc_id, _ in results]
+            results = results[ids.index(self._start_after) + 1:] if self._start_after in ids else results
+        if self._limit is not None:
+            results = results[:self._limit]
+        return [FakeSnapshot(FakeDocumentReference(self._client, self._path + (doc_id,)), data) for doc_id, data in results]
+
+    def stream(self, *args, **kwargs):
+        self._client.behavior.before_call('query.stream')
+        for snapshot in self._run():
+            yield snapshot
+
+    def get(self, *args, **kwargs):
+        self._client.behavior.before_call('query.get')
+        return self._run()
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class FakeCollectionReference(FakeQuery):
+    """Mimics a CollectionReference."""
+
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = self._path[-1]
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, self._path + (document_id or uuid.uuid4().hex[:20],))
+
+    def add(self, data, document_id=None, **kwargs):
+        self._client.behavior.before_call('collection.add')
+        ref = self.document(document_id)
+        self._client._write('create', ref, data)
+        return datetime.now(timezone.utc), ref
+
+    def list_documents(self):
+        return [FakeDocumentReference(self._client, self._path + (doc_id,)) for doc_id, _ in self._client._documents(self._path)]
+
+
+class FakeWriteBatch:
+    """Mimics a WriteBatch: writes are applied together on commit."""
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(('set', reference, data, merge))
+
+    def create(self, reference, data):
+        self._writes.append(('create', reference, data, False))
+
+    def update(self, reference, data):
+        self._writes.append(('update', reference, data, False))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, False))
+
+    def commit(self, **kwargs):
+        if len(self._writes) > 500:
+            raise gapi_exceptions.InvalidArgument("maximum 500 writes allowed per request")
+        self._client.behavior.before_call('batch.commit')
+        with self._client._lock:
+            for kind, reference, data, merge in self._writes:
+                self._client._write(kind, reference, data, merge=merge)
+        self._writes = []
+        return []
+
+
+class FakeFirestoreClient:
+    """
+    Mimics firestore.Client, holding every collection in memory.
+
+    Args:
+        behavior (BackendBehavior, optional): Latency/error injection settings.
+    """
+
+    def __init__(self, behavior=None):
+        self.behavior = behavior or BackendBehavior()
+        self._lock = threading.RLock()
+        self._data = {}
+        self._watches = []
+
+    # --- Public client API ---
+
+    def collection(self, *path):
+        return FakeCollectionReference(self, path)
+
+    def document(self, *path):
+        parts = tuple("/".join(path).split("/"))
+        return FakeDocumentReference(self, parts)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, references, *args, **kwargs):
+        self.behavior.before_call('client.get_all')
+        for reference in references:
+            yield self._snapshot(reference)
+
+    def seed(self, collection, documents):
+        """Loads {doc_id: data} into a collection without going through the fake latency."""
+        with self._lock:
+            self._data.setdefault((collection,), {}).update(copy.deepcopy(documents))
+
+    # --- Internal storage ---
+
+    def _documents(self, path):
+        with self._lock:
+            return [(doc_id, copy.deepcopy(data)) for doc_id, data in self._data.get(tuple(path), {}).items()]
+
+    def _snapshot(self, reference):
+        with self._lock:
+            data = self._data.get(reference._path[:-1], {}).get(reference.id)
+            return FakeSnapshot(reference, copy.deepcopy(data))
+
+    def _write(self, kind, reference, data, merge=False):
+        with self._lock:
+            collection = self._data.setdefault(reference._path[:-1], {})
+            current = collection.get(reference.id)
+            if kind == 'delete':
+                collection.pop(reference.id, None)
+            elif kind == 'create':
+                if current is not None:
+                    raise gapi_exceptions.AlreadyExists(f"Document already exists: {reference.path}")
+                collection[reference.id] = _apply_transform({}, data)
+            elif kind == 'update':
+                if current is None:
+                    raise gapi_exceptions.NotFound(f"No document to update: {reference.path}")
+                updated = copy.deepcopy(current)
+                for field_path, value in data.items():
+                    _, existing = _get_field(updated, field_path)
+                    _set_field(updated, field_path, value if value is DELETE_FIELD else _apply_transform(existing, value))
+                collection[reference.id] = updated
+            elif merge and current is not None:
+                collection[reference.id] = _merge(copy.deepcopy(current), data)
+            else:
+                collection[reference.id] = _apply_transform({}, data)
+            self._notify(reference)
+
+    # --- Listeners ---
+
+    def _watch(self, target, callback):
+        watch = _FakeWatch(self, target, callback)
+        with self._lock:
+            self._watches.append(watch)
+        watch.fire([])
+        return watch
+
+    def _notify(self, reference):
+        for watch in list(self._watches):
+            watch.fire([reference])
+
+
+class _ChangeType:
+    def __init__(self, name):
+        self.name = name
+
+
+class _FakeChange:
+    """Mimics a DocumentChange passed to on_snapshot callbacks."""
+
+    def __init__(self, type_name, document):
+        self.type = _ChangeType(type_name)
+        self.document = document
+
+
+class _FakeWatch:
+    """Calls an on_snapshot callback with the result set and the changes after every matching write."""
+
+    def __init__(self, client, target, callback):
+        self._client = client
+        self._target = target
+        self._callback = callback
+        self._previous = {}
+
+    def fire(self, changed_refs):
+        target_path = self._target._path if isinstance(self._target, FakeQuery) else self._target._path[:-1]
+        if changed_refs and all(ref._path[:-1] != target_path for ref in changed_refs):
+            return
+        if isinstance(self._target, FakeQuery):
+            snapshots = self._target._run()
+        else:
+            snapshots = [s for s in [self._client._snapshot(self._target)] if s.exists]
+
+        current = {s.id: s for s in snapshots}
+        changes = []
+        for doc_id, snapshot in current.items():
+            previous = self._previous.get(doc_id)
+            if previous is None:
+                changes.append(_FakeChange('ADDED', snapshot))
+            elif previous.to_dict() != snapshot.to_dict():
+                changes.append(_FakeChange('MODIFIED', snapshot))
+        for doc_id, snapshot in self._previous.items():
+            if doc_id not in current:
+                changes.append(_FakeChange('REMOVED', snapshot))
+        self._previous = current
+
+        if changes or not changed_refs:
+            self._callback(snapshots, changes, datetime.now(timezone.utc))
+
+    def unsubscribe(self):
+        with self._client._lock:
+            if self in self._client._watches:
+                self._client._watches.remove(self)
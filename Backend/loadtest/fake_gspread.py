@@ -0,0 +1,239 @@
+# fake_gspread.py
+
+"""
+An in-process, in-memory stand-in for the gspread client, used by the load-test
+harness instead of the real Google Sheets API.
+
+Workbooks are created on first open, worksheets hold plain lists of rows, and every
+API call is counted in metrics.py under the "sheets" backend just like the real
+client's HTTP requests. Latency and errors are injected through the same
+BackendBehavior as the fake Firestore client; injected errors are HTTP 429
+"quota exceeded" responses by default.
+"""
+
+import itertools
+import re
+import threading
+from contextlib import contextmanager
+import gspread
+from metrics import track_call
+from loadtest.fake_firestore import BackendBehavior
+
+_sheet_ids = itertools.count(1)
+
+
+class _FakeResponse:
+    """The minimal response object gspread.exceptions.APIError needs."""
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+        self._body = {"error": {"code": status_code, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._body
+
+
+def quota_exceeded(op):
+    return gspread.exceptions.APIError(_FakeResponse(429, f"Quota exceeded (injected) in {op}"))
+
+
+class FakeWorksheet:
+    """Mimics gspread.Worksheet."""
+
+    def __init__(self, spreadsheet, title, rows, cols):
+        self.spreadsheet = spreadsheet
+        self.id = next(_sheet_ids)
+        self.title = title
+        self.row_count = int(rows)
+        self.col_count = int(cols)
+        self._rows = []
+
+    def _call(self, op):
+        return self.spreadsheet._client._call(op)
+
+    def append_row(self, values, value_input_option='RAW', **kwargs):
+        with self._call('values.append'):
+            self._append([list(values)])
+
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        with self._call('values.append'):
+            self._append([list(row) for row in values])
+
+    def _append(self, rows):
+        self._rows.extend(rows)
+        # Like the real API, appending past the end of the grid grows it.
+        self.row_count = max(self.row_count, len(self._rows))
+
+    def clear(self):
+        with self._call('values.clear'):
+            self._rows = []
+
+    def update(self, range_name=None, values=None, **kwargs):
+        # gspread accepts update(values, range_name) as well as update(range_name, values).
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        with self._call('values.update'):
+            start_row = 1
+            match = re.match(r"^(?:.*!)?([A-Z]+)(\d+)", range_name or "A1")
+            if match:
+                start_row = int(match.group(2))
+            for offset, row in enumerate(values or []):
+                index = start_row - 1 + offset
+                while len(self._rows) <= index:
+                    self._rows.append([])
+                self._rows[index] = list(row)
+            self.row_count = max(self.row_count, len(self._rows))
+
+    def resize(self, rows=None, cols=None):
+        with self._call('batchUpdate'):
+            if rows is not None:
+                self.row_count = int(rows)
+                self._rows = self._rows[:self.row_count]
+            if cols is not None:
+                self.col_count = int(cols)
+
+    def get_all_values(self, **kwargs):
+        with self._call('values.get'):
+            return [list(row) for row in self._rows]
+
+    def col_values(self, col, **kwargs):
+        with self._call('values.get'):
+            return [row[col - 1] for row in self._rows if len(row) >= col]
+
+    def copy_to(self, destination_spreadsheet_id):
+        with self._call('spreadsheet.post'):
+            destination = self.spreadsheet._client._by_id[destination_spreadsheet_id]
+            copy = destination._add(f"Copy of {self.title}", self.row_count, self.col_count)
+            copy._rows = [list(row) for row in self._rows]
+            return {"sheetId": copy.id, "title": copy.title}
+
+    def update_title(self, title):
+        with self._call('batchUpdate'):
+            self.title = title
+
+
+class FakeSpreadsheet:
+    """Mimics gspread.Spreadsheet."""
+
+    def __init__(self, client, title):
+        self._client = client
+        self.title = title
+        self.id = f"fake-{title.replace(' ', '-').lower()}"
+        self._worksheets = []
+
+    def _add(self, title, rows, cols, sheet_id=None):
+        if any(ws.title == title for ws in self._worksheets):
+            raise gspread.exceptions.APIError(_FakeResponse(400, f"A sheet with the name \"{title}\" already exists."))
+        worksheet = FakeWorksheet(self, title, rows, cols)
+        if sheet_id is not None:
+            worksheet.id = sheet_id
+        self._worksheets.append(worksheet)
+        return worksheet
+
+    def worksheet(self, title):
+        with self._client._call('spreadsheet.get'):
+            for worksheet in self._worksheets:
+                if worksheet.title == title:
+                    return worksheet
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self, **kwargs):
+        with self._client._call('spreadsheet.get'):
+            return list(self._worksheets)
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        with self._client._call('batchUpdate'):
+            return self._add(title, rows, cols)
+
+    def del_worksheet(self, worksheet):
+        with self._client._call('batchUpdate'):
+            self._worksheets = [ws for ws in self._worksheets if ws.id != worksheet.id]
+
+    def batch_update(self, body):
+        """
+        Applies the addSheet, updateSheetProperties (grid size), updateCells (whole
+        sheet) and appendCells requests in a batchUpdate body as one counted call.
+        """
+        def target(sheet_id):
+            for ws in self._worksheets:
+                if ws.id == sheet_id:
+                    return ws
+            raise gspread.exceptions.APIError(_FakeResponse(400, f"No grid with id: {sheet_id}"))
+
+        def values(rows):
+            return [[next(iter(cell.get("userEnteredValue", {"stringValue": ""}).values())) for cell in row.get("values", [])]
+                    for row in rows]
+
+        with self._client._call('batchUpdate'):
+            for req in body.get("requests", []):
+                if "addSheet" in req:
+                    props = req["addSheet"]["properties"]
+                    grid = props.get("gridProperties", {})
+                    self._add(props["title"], grid.get("rowCount", 1000), grid.get("columnCount", 26), props.get("sheetId"))
+                elif "updateSheetProperties" in req:
+                    props = req["updateSheetProperties"]["properties"]
+                    worksheet = target(props["sheetId"])
+                    grid = props.get("gridProperties", {})
+                    worksheet.row_count = grid.get("rowCount", worksheet.row_count)
+                    worksheet.col_count = grid.get("columnCount", worksheet.col_count)
+                    worksheet._rows = worksheet._rows[:worksheet.row_count]
+                elif "updateCells" in req:
+                    worksheet = target(req["updateCells"]["range"]["sheetId"])
+                    worksheet._rows = values(req["updateCells"].get("rows", []))
+                elif "appendCells" in req:
+                    target(req["appendCells"]["sheetId"])._append(values(req["appendCells"].get("rows", [])))
+            return {"replies": [{} for _ in body.get("requests", [])]}
+
+    def values_batch_update(self, body):
+        with self._client._call('values.batchUpdate'):
+            for data in body.get("data", []):
+                sheet_title = data["range"].split("!")[0].strip("'")
+                target = next(ws for ws in self._worksheets if ws.title == sheet_title)
+                start_row = int(re.search(r"(\d+)", data["range"].split("!")[-1]).group(1))
+                for offset, row in enumerate(data["values"]):
+                    index = start_row - 1 + offset
+                    while len(target._rows) <= index:
+                        target._rows.append([])
+                    target._rows[index] = list(row)
+            return {}
+
+
+class FakeGspreadClient:
+    """
+    Mimics gspread.Client. Workbooks are created the first time they are opened.
+
+    Args:
+        behavior (BackendBehavior, optional): Latency/error injection settings.
+    """
+
+    def __init__(self, behavior=None):
+        self.behavior = behavior or BackendBehavior(error_factory=quota_exceeded)
+        self._lock = threading.Lock()
+        self._by_title = {}
+        self._by_id = {}
+
+    @contextmanager
+    def _call(self, op):
+        with track_call("sheets", op):
+            self.behavior.before_call(op)
+            yield
+
+    def open(self, title, **kwargs):
+        with self._call('drive.get'):
+            with self._lock:
+                if title not in self._by_title:
+                    spreadsheet = FakeSpreadsheet(self, title)
+                    self._by_title[title] = spreadsheet
+                    self._by_id[spreadsheet.id] = spreadsheet
+                return self._by_title[title]
+
+    def open_by_key(self, key):
+        with self._call('spreadsheet.get'):
+            try:
+                return self._by_id[key]
+            except KeyError:
+                raise gspread.exceptions.SpreadsheetNotFound(key)
+
+    def create(self, title, **kwargs):
+        return self.open(title)
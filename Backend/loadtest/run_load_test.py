@@ -0,0 +1,344 @@
+# run_load_test.py
+
+"""
+Replays a synthetic tutoring day against the real Flask routes in app.py, with
+Firestore, Google Sheets and SMTP replaced by in-memory fakes.
+
+The day is made up of these phases, each run with the configured concurrency:
+1. A staff clock-in rush at every location in locations.py.
+2. Attendance marking (take, a few corrections, and live counts).
+3. Shift look-ups and edits by the Senior PMs.
+4. The clock-out rush.
+5. 15-day summaries and payroll approval for every location.
+
+Routes that queue a background job are followed up: the runner polls /jobs/<id>
+until the job finishes, and a failed job (or one still unfinished after
+--job-timeout seconds) counts as an error for the route that queued it.
+
+For every route it reports p50/p95/p99 latency, error counts and the number of
+Firestore, Sheets and SMTP calls per request, so performance changes can be checked
+in CI without touching production.
+
+Run it from the Backend directory:
+    python -m loadtest.run_load_test --staff 20 --students 60 --firestore-latency-ms 15
+    python -m loadtest.run_load_test --json report.json --max-p95-ms 800
+"""
+
+import argparse
+import json
+import math
+import os
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from loadtest.fake_firestore import BackendBehavior, FakeFirestoreClient
+from loadtest.fake_gspread import FakeGspreadClient, quota_exceeded
+
+
+class FakeSMTP:
+    """Stands in for smtplib.SMTP_SSL, taking a configurable time to 'send' each message."""
+
+    latency_seconds = 0.0
+    sent = 0
+    _lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def login(self, *args):
+        pass
+
+    def _send(self):
+        time.sleep(self.latency_seconds)
+        with FakeSMTP._lock:
+            FakeSMTP.sent += 1
+
+    def send_message(self, *args, **kwargs):
+        self._send()
+
+    def sendmail(self, *args, **kwargs):
+        self._send()
+
+
+def install_fakes(args):
+    """
+    Replaces the Firestore client, the gspread client and SMTP before app.py is imported.
+
+    Returns:
+        tuple: (fake Firestore client, fake gspread client)
+    """
+    from firestore_instrumentation import instrument_client
+
+    fake_db = FakeFirestoreClient(BackendBehavior(args.firestore_latency_ms, args.firestore_latency_ms / 2,
+                                                  args.firestore_error_rate, seed=args.seed))
+    # firebase_config initializes the real Admin SDK on import, so it is replaced outright.
+    firebase_config = types.ModuleType("firebase_config")
+    firebase_config.db = instrument_client(fake_db)
+    sys.modules["firebase_config"] = firebase_config
+
+    from firebase_admin import firestore
+    firestore.client = lambda *a, **kw: firebase_config.db
+
+    # The other sheet modules import get_gspread_client by name, so it is patched before they load.
+    import logging_google_sheets
+    fake_sheets = FakeGspreadClient(BackendBehavior(args.sheets_latency_ms, args.sheets_latency_ms / 2,
+                                                    args.sheets_error_rate, quota_exceeded, seed=args.seed))
+    logging_google_sheets.get_gspread_client = lambda: fake_sheets
+
+    FakeSMTP.latency_seconds = args.smtp_latency_ms / 1000
+    smtplib.SMTP_SSL = FakeSMTP
+
+    # The periodic task scheduler would submit real report jobs during the run.
+    os.environ["SCHEDULER_ENABLED"] = "false"
+    # Keep background jobs from this run out of the real job database.
+    os.environ["JOB_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="loadtest-jobs-"), "jobs.sqlite3")
+
+    return fake_db, fake_sheets
+
+
+def seed_users(fake_db, locations, staff_per_location, students_per_location):
+    """
+    Creates an admin plus staff and students for every location.
+
+    Returns:
+        dict: {location: {"staff": [(uid, first, last, role)], "students": [uid]}}
+    """
+    users = {"admin-0": {"email": "admin@example.com", "firstName": "Ada", "lastName": "Admin",
+                         "role": "admin", "tutoringLocation": []}}
+    roster = {}
+    for loc_index, location in enumerate(locations):
+        roster[location] = {"staff": [], "students": []}
+        for i in range(staff_per_location):
+            uid = f"staff-{loc_index}-{i}"
+            role = "seniorProjectManager" if i == 0 else "tutor"
+            users[uid] = {"email": f"{uid}@example.com", "firstName": f"Staff{i}", "lastName": f"Loc{loc_index}",
+                          "role": role, "tutoringLocation": [location]}
+            roster[location]["staff"].append((uid, f"Staff{i}", f"Loc{loc_index}", role))
+        for i in range(students_per_location):
+            uid = f"student-{loc_index}-{i}"
+            users[uid] = {"email": f"{uid}@example.com", "firstName": f"Student{i}", "lastName": f"Loc{loc_index}",
+                          "role": "student", "tutoringLocation": [location], "gradeLevel": 5}
+            roster[location]["students"].append(uid)
+    fake_db.seed("users", users)
+    return roster
+
+
+class LoadRunner:
+    """Sends requests through Flask's test client from a thread pool and records their latency."""
+
+    def __init__(self, app, concurrency):
+        self.app = app
+        self.concurrency = concurrency
+        self.results = {}
+        self.jobs = []  # (route, job_id) of every job queued by a request.
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def request(self, route, method, url, body=None):
+        start = time.perf_counter()
+        try:
+            response = self._client().open(url, method=method, json=body)
+            status = response.status_code
+            payload = response.get_json(silent=True)
+        except Exception as e:
+            status, payload = 599, {"error": str(e)}
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            entry = self.results.setdefault(route, {"latencies": [], "statuses": {}, "failed_jobs": 0})
+            entry["latencies"].append(elapsed)
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            if status == 202 and payload and payload.get("job_id"):
+                self.jobs.append((route, payload["job_id"]))
+        return status, payload
+
+    def wait_for_jobs(self, timeout):
+        """Polls /jobs/<id> until every queued job has finished, and counts the failed ones."""
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        client = self.app.test_client()
+        pending = list(self.jobs)
+        failed = 0
+        while pending:
+            still_running = []
+            for route, job_id in pending:
+                job = client.get(f"/jobs/{job_id}").get_json(silent=True) or {}
+                if job.get("status") in ("queued", "running"):
+                    still_running.append((route, job_id))
+                elif job.get("status") != "succeeded":
+                    print(f"job {job_id} from {route} failed: {job.get('error')}")
+                    self.results[route]["failed_jobs"] += 1
+                    failed += 1
+            pending = still_running
+            if pending and time.monotonic() >= deadline:
+                for route, job_id in pending:
+                    print(f"job {job_id} from {route} did not finish within {timeout}s")
+                    self.results[route]["failed_jobs"] += 1
+                failed += len(pending)
+                break
+            if pending:
+                time.sleep(0.1)
+        print(f"background jobs: {len(self.jobs)} finished or timed out in {time.perf_counter() - start:.2f}s, "
+              f"{failed} failed")
+
+    def phase(self, name, calls):
+        """Runs a list of (route, method, url, body) calls concurrently."""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(lambda call: self.request(*call), calls))
+        print(f"{name}: {len(calls)} requests in {time.perf_counter() - start:.2f}s")
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile.
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def build_report(runner):
+    """Combines client-side latencies with the backend call counters from metrics.py."""
+    from metrics import counter_values
+
+    backend_calls = {}
+    for labels, value in counter_values("backend_calls_total").items():
+        labels = dict(labels)
+        route_calls = backend_calls.setdefault(labels["route"], {})
+        route_calls[labels["backend"]] = route_calls.get(labels["backend"], 0) + value
+
+    routes = {}
+    for route, entry in sorted(runner.results.items()):
+        latencies = sorted(entry["latencies"])
+        count = len(latencies)
+        routes[route] = {
+            "requests": count,
+            "errors": sum(n for status, n in entry["statuses"].items() if status >= 500) + entry["failed_jobs"],
+            "failed_jobs": entry["failed_jobs"],
+            "statuses": {str(k): v for k, v in sorted(entry["statuses"].items())},
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+            "backend_calls_per_request": {backend: round(n / count, 2)
+                                          for backend, n in sorted(backend_calls.get(route, {}).items())}
+        }
+    return {"routes": routes, "background_backend_calls": backend_calls.get("background", {}),
+            "emails_sent": FakeSMTP.sent}
+
+
+def print_report(report):
+    print()
+    print(f"{'route':<36} {'reqs':>6} {'errs':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  backend calls/request")
+    for route, stats in report["routes"].items():
+        calls = ", ".join(f"{k}={v}" for k, v in stats["backend_calls_per_request"].items())
+        print(f"{route:<36} {stats['requests']:>6} {stats['errors']:>5} {stats['p50_ms']:>8} "
+              f"{stats['p95_ms']:>8} {stats['p99_ms']:>8}  {calls}")
+    if report["background_backend_calls"]:
+        print(f"background worker calls: {report['background_backend_calls']}")
+
+
+def run_day(args):
+    fake_db, _ = install_fakes(args)
+
+    from locations import locations
+    from app import app
+
+    roster = seed_users(fake_db, locations, args.staff, args.students)
+    runner = LoadRunner(app, args.concurrency)
+
+    clock_in_calls = [("/clock_in", "POST", "/clock_in", {"user_id": uid, "location": loc, "role": role})
+                      for loc, people in roster.items() for uid, _, _, role in people["staff"]]
+    runner.phase("clock-in rush", clock_in_calls)
+
+    attendance_calls = []
+    for loc, people in roster.items():
+        for i, student in enumerate(people["students"]):
+            attendance_calls.append(("/attendance/take", "POST", "/attendance/take",
+                                     {"location": loc, "student_id": student, "status": "present" if i % 5 else "absent"}))
+            if i % 10 == 0:
+                attendance_calls.append(("/attendance/count/<location>", "GET", f"/attendance/count/{loc}", None))
+        for student in people["students"][::7]:
+            attendance_calls.append(("/attendance/edit", "PUT", "/attendance/edit",
+                                     {"location": loc, "student_id": student, "status": "present"}))
+    runner.phase("attendance", attendance_calls)
+
+    runner.phase("clock-out rush", [("/clock_out", "POST", "/clock_out", {"user_id": uid, "location": loc, "role": role})
+                                    for loc, people in roster.items() for uid, _, _, role in people["staff"]])
+
+    today = datetime.now().date().isoformat()
+    lookup_calls, edit_calls = [], []
+    shifts = {}
+    for doc in fake_db.collection("shifts").get():
+        shifts.setdefault(doc.to_dict()["user_id"], []).append((doc.to_dict()["event"], doc.id))
+    for loc, people in roster.items():
+        for uid, first, last, _ in people["staff"][::args.edit_every]:
+            lookup_calls.append(("/work_hours/get_shifts", "GET",
+                                 f"/work_hours/get_shifts?location={loc}&first_name={first}&last_name={last}&date={today}", None))
+            events = dict(shifts.get(uid, []))
+            if "clock-in" in events and "clock-out" in events:
+                start = datetime.now().replace(hour=15, minute=0, second=0, microsecond=0)
+                edit_calls.append(("/work_hours/edit_shift", "POST", "/work_hours/edit_shift", {
+                    "location": loc, "clock_in_id": events["clock-in"], "clock_out_id": events["clock-out"],
+                    "new_start_time": start.isoformat(), "new_end_time": (start + timedelta(hours=2)).isoformat()}))
+    runner.phase("shift lookups", lookup_calls)
+    runner.phase("shift edits", edit_calls)
+
+    runner.phase("15-day summaries", [("/15_day_summary/<location>", "POST", f"/15_day_summary/{loc}", None) for loc in roster])
+    runner.phase("payroll approval", [("/payroll/approval", "POST", "/payroll/approval",
+                                       {"location": loc, "role": "admin", "locations": []}) for loc in roster])
+
+    runner.wait_for_jobs(args.job_timeout)
+    return build_report(runner)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a synthetic tutoring day against the backend with in-memory fakes.")
+    parser.add_argument("--staff", type=int, default=15, help="staff members per location")
+    parser.add_argument("--students", type=int, default=50, help="students per location")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--edit-every", type=int, default=4, help="edit the shift of every Nth staff member")
+    parser.add_argument("--firestore-latency-ms", type=float, default=10.0)
+    parser.add_argument("--firestore-error-rate", type=float, default=0.0)
+    parser.add_argument("--sheets-latency-ms", type=float, default=80.0)
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0)
+    parser.add_argument("--smtp-latency-ms", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--job-timeout", type=float, default=120.0,
+                        help="seconds to wait for queued background jobs before counting them as errors")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="exit with status 1 if any route's p95 is above this")
+    args = parser.parse_args(argv)
+
+    report = run_day(args)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.max_p95_ms is not None:
+        slow = [route for route, stats in report["routes"].items() if stats["p95_ms"] > args.max_p95_ms]
+        if slow:
+            print(f"p95 above {args.max_p95_ms} ms on: {', '.join(slow)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,17 +4,35 @@
 #update_spreadsheet(location, data): This function will take the location and the clock-in/out
 #data as input and update the corresponding Google Sheet. It will be responsible for authenticating
 #with the Google Sheets API, selecting the correct sheet, and appending the new data.
+import logging
 import os
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv  # Import dotenv
 from datetime import datetime, timedelta
 from locations import locations
+from metrics import track_call
+import sheets_scheduler
+from report_sheets import ensure_tab, forget_report, write_report
+from workbook_routing import log_workbook, summary_workbook
 import json
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+# One line per clock event: sampled by structured_logging (LOG_SAMPLING).
+row_logger = logging.getLogger(__name__ + ".rows")
 
 # Load environment variables from .env file
 load_dotenv()
 
+LOG_HEADER = ["Location", "Role", "First Name", "Last Name", "Timestamp", "Status"]
+SUMMARY_HEADER = ["First Name", "Last Name", "Role", "Total Hours (15-day Period)"]
+# Old-sheet cleanup lists every tab in a workbook, so it runs at most this often per workbook.
+CLEANUP_INTERVAL_SECONDS = 60 * 60
+_last_cleanup = {}
+_cleanup_lock = threading.Lock()
+
 #Function to authenticate with Google Sheets API
 def get_gspread_client():
     """Authenticates with Google and returns a gspread client."""
@@ -23,17 +41,47 @@ def get_gspread_client():
     #Get the credetnials path from the environment variable
     creds_path = os.getenv("GOOGLE_CREDENTIALS_PATH")
     if not creds_path:
-        print("Google credentials path not set. Please set the GOOGLE_CREDENTIALS_PATH environment variable.")
+        logger.warning("Google credentials path not set. Please set the GOOGLE_CREDENTIALS_PATH environment variable.")
         return None
 
     try:
         creds = ServiceAccountCredentials.from_json_keyfile_name(creds_path, scope)
         client = gspread.authorize(creds)
+        _instrument_session(client)
         return client
     except Exception as e:
-        print(f"Authentication failed: {e}")
+        logger.error(f"Authentication failed: {e}")
         return None
 
+def _sheets_operation(method, url):
+    """Names a Sheets/Drive API call for metrics, e.g. 'values.append' or 'batchUpdate'."""
+    path = url.split("?")[0]
+    if "googleapis.com/drive" in path:
+        return f"drive.{method.lower()}"
+    if "/values" in path:
+        for action in ("append", "clear", "batchGet", "batchUpdate", "batchClear"):
+            if path.endswith(f":{action}"):
+                return f"values.{action}"
+        return "values.get" if method.upper() == "GET" else "values.update"
+    if path.endswith(":batchUpdate"):
+        return "batchUpdate"
+    return f"spreadsheet.{method.lower()}"
+
+def _instrument_session(client):
+    """Times every HTTP request the gspread client sends, for /metrics."""
+    # gspread 6 keeps its session on client.http_client, older versions on client.session.
+    session = getattr(getattr(client, "http_client", None), "session", None) or getattr(client, "session", None)
+    if session is None or getattr(session, "_instrumented", False):
+        return
+    send = session.request
+
+    def timed_request(method, url, *args, **kwargs):
+        with track_call("sheets", _sheets_operation(method, url), **{"http.method": method, "http.url": url.split("?")[0]}):
+            return send(method, url, *args, **kwargs)
+
+    session.request = timed_request
+    session._instrumented = True
+
 def update_spreadsheet(location, data):
     """Upadtes the Google Sheet for the specified location with the provided data.
     
@@ -41,10 +89,7 @@ def update_spreadsheet(location, data):
         Location (str): the name of the location sheet to update.
         data (list): a list containing the clock-in/out data to append.
     """
-    client = get_gspread_client()
-
     try:
-        workbook = client.open("House of Wisdom Log")
         #Today's date
         today = datetime.now().date()
         
@@ -60,14 +105,6 @@ def update_spreadsheet(location, data):
         # --- CHANGE END ---
 
         sheet_name = f"{location} - {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}"
-        
-        try:
-            worksheet = workbook.worksheet(sheet_name)
-        
-        except gspread.exceptions.WorksheetNotFound:
-            worksheet = workbook.add_worksheet(title = sheet_name, rows = "250", cols = "10")
-            header = ["Location", "Role", "First Name", "Last Name", "Timestamp", "Status"]
-            worksheet.append_row(header, value_input_option='USER_ENTERED')
             
         row = [
             location,
@@ -78,16 +115,88 @@ def update_spreadsheet(location, data):
             data.get("status")
         ]
 
-        worksheet.append_row(row)
-        print(f"Appended row to {sheet_name}: {row}")
+        # The scheduler creates the tab if needed and merges this row with any other
+        # queued rows for the workbook; it retries instead of dropping the row on a 429.
+        workbook_name = log_workbook(location)
+        sheets_scheduler.append_rows(workbook_name, sheet_name, [row], header=LOG_HEADER)
+        forget_report(workbook_name, sheet_name)
+        row_logger.info(f"Queued row for {sheet_name}: {row}")
 
         # --- CHANGE START ---
         # Added cleanup call to ensure old log sheets are deleted after an update.
-        cleanup_old_sheets("House of Wisdom Log", sheet_type="log")
+        schedule_cleanup(workbook_name, sheet_type="log")
         # --- CHANGE END ---
     
     except Exception as e:
-        print(f"Error updating spreadsheet for location '{location}': {e}")
+        logger.error(f"Error updating spreadsheet for location '{location}': {e}")
+
+def get_pay_period_dates(day=None):
+    """
+    Returns the (start_date, end_date) of the pay period containing the given day.
+    Pay periods run from the 1st to the 15th and from the 16th to the end of the month.
+
+    Args:
+        day (date, optional): The day to look up. Defaults to today.
+    """
+    day = day or datetime.now().date()
+    if day.day > 15:
+        start_date = day.replace(day=16)
+        end_date = (day.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    else:
+        start_date = day.replace(day=1)
+        end_date = day.replace(day=15)
+    return start_date, end_date
+
+def precreate_period_tabs(period_start):
+    """
+    Creates every location's log tab and 15-day summary tab for the pay period that
+    starts on period_start, so the first clock-in of the period does not have to.
+
+    Args:
+        period_start (date): The first day of the pay period (the 1st or the 16th).
+
+    Returns:
+        dict: {"created": [tab names]}
+    """
+    start_date, end_date = get_pay_period_dates(period_start)
+    period = f"{start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}"
+    created = []
+    for location in locations:
+        log_tab = f"{location} - {period}"
+        if ensure_tab(log_workbook(location), log_tab, LOG_HEADER):
+            created.append(log_tab)
+        summary_tab = f"{location} Summary - {period}"
+        if ensure_tab(summary_workbook(location), summary_tab, SUMMARY_HEADER, size=(100, 10)):
+            created.append(summary_tab)
+    return {"created": created}
+
+def append_rows_to_spreadsheet(location, rows):
+    """Queues several clock-in/out rows for one location as one append per period sheet.
+
+    Rows are grouped by the pay period of their timestamp, so a batch that spans a
+    period boundary still lands in the correct tabs.
+
+    Args:
+        location (str): the name of the location sheet to update.
+        rows (list): rows in the log sheet column order (Location, Role, First Name,
+            Last Name, Timestamp, Status).
+
+    Returns:
+        int: the number of rows queued.
+    """
+    rows_by_sheet = {}
+    for row in rows:
+        start_date, end_date = get_pay_period_dates(datetime.fromisoformat(row[4]).date())
+        sheet_name = f"{location} - {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}"
+        rows_by_sheet.setdefault(sheet_name, []).append(row)
+
+    workbook_name = log_workbook(location)
+    for sheet_name, sheet_rows in rows_by_sheet.items():
+        sheets_scheduler.append_rows(workbook_name, sheet_name, sheet_rows, header=LOG_HEADER)
+        forget_report(workbook_name, sheet_name)
+        logger.info(f"Queued {len(sheet_rows)} rows for {sheet_name}")
+
+    return len(rows)
 
 def create_new_sheet(workbook, sheet_name):
     """
@@ -101,7 +210,7 @@ def create_new_sheet(workbook, sheet_name):
         gspread.Worksheet: The newly created worksheet object, or None if creation fails.
     """
     try:
-        print(f"Worksheet '{sheet_name}' not found. Creating it now...")
+        logger.warning(f"Worksheet '{sheet_name}' not found. Creating it now...")
         # Add a new worksheet with the specified title.
         worksheet = workbook.add_worksheet(title=sheet_name, rows="250", cols="10")
         
@@ -109,19 +218,46 @@ def create_new_sheet(workbook, sheet_name):
         header = ["Location", "Role", "First Name", "Last Name", "Timestamp", "Status"]
         worksheet.append_row(header, value_input_option='USER_ENTERED')
         
-        print(f"Successfully created worksheet '{sheet_name}' and added header.")
+        logger.info(f"Successfully created worksheet '{sheet_name}' and added header.")
         return worksheet
     except Exception as e:
-        print(f"Failed to create new worksheet '{sheet_name}': {e}")
+        logger.error(f"Failed to create new worksheet '{sheet_name}': {e}")
         return None
 
+def sum_shift_durations(shifts, start_date, end_date):
+    """
+    Adds up the time between each clock-in and the next clock-out within a pay period.
+
+    Args:
+        shifts (iterable): One user's shift dictionaries, sorted by timestamp.
+        start_date (date): The first day of the period.
+        end_date (date): The last day of the period.
+
+    Returns:
+        timedelta: The total time worked in the period.
+    """
+    total_duration = timedelta()
+    clock_in_time = None
+    for shift_data in shifts:
+        event_time = datetime.fromisoformat(shift_data.get("timestamp"))
+
+        if not (start_date <= event_time.date() <= end_date):
+            continue
+
+        if shift_data.get("event") == 'clock-in':
+            clock_in_time = event_time
+        elif shift_data.get("event") == 'clock-out' and clock_in_time:
+            total_duration += event_time - clock_in_time
+            clock_in_time = None
+    return total_duration
+
 # In google_sheets.py
 def generate_15_day_location_summary(location):
     """
     Calculates total work hours for each user at a specific location over the
     last 15 days and writes a summary report to a new Google Sheet.
     """
-    print(f"Generating 15-day summary report for {location}...")
+    logger.info(f"Generating 15-day summary report for {location}...")
     
     # --- CHANGE START ---
     # This logic was also updated to mirror the payroll validation logic, ensuring
@@ -138,32 +274,25 @@ def generate_15_day_location_summary(location):
     
     try:
         from firebase_config import db 
+        # Imported here because shift_ledger itself uses this module.
+        from shift_ledger import period_hours_by_user
 
         users_query = db.collection('users').where('tutoringLocation', 'array-contains', location).stream()
         location_users = {user.id: user.to_dict() for user in users_query}
         report_data = []
+        # The period's running hours per user from the in-memory ledger, or None to query each user
+        ledger_hours = period_hours_by_user(location, start_date, end_date)
 
         for user_id, user_data in location_users.items():
-            total_duration = timedelta()
-            shifts_ref = db.collection('shifts').where('user_id', '==', user_id).where('location', '==', location).order_by('timestamp').stream()
-            
-            clock_in_time = None
-            for shift in shifts_ref:
-                shift_data = shift.to_dict()
-                event_time = datetime.fromisoformat(shift_data.get("timestamp"))
-
-                if not (start_date <= event_time.date() <= end_date):
-                    continue
-
-                if shift_data.get("event") == 'clock-in':
-                    clock_in_time = event_time
-                elif shift_data.get("event") == 'clock-out' and clock_in_time:
-                    duration = event_time - clock_in_time
-                    total_duration += duration
-                    clock_in_time = None 
-
-            if total_duration.total_seconds() > 0:
-                total_hours = round(total_duration.total_seconds() / 3600, 2)
+            if ledger_hours is not None:
+                hours = ledger_hours.get(user_id, 0)
+            else:
+                shifts_ref = db.collection('shifts').where('user_id', '==', user_id).where('location', '==', location).order_by('timestamp').stream()
+                shifts = (shift.to_dict() for shift in shifts_ref)
+                hours = sum_shift_durations(shifts, start_date, end_date).total_seconds() / 3600
+
+            if hours > 0:
+                total_hours = round(hours, 2)
                 report_data.append([
                     user_data.get('firstName', ''),
                     user_data.get('lastName', ''),
@@ -172,44 +301,44 @@ def generate_15_day_location_summary(location):
                 ])
 
         if not report_data:
-            print(f"No work hour data found for {location} in the period starting {start_date}.")
+            logger.info(f"No work hour data found for {location} in the period starting {start_date}.")
             return {"message": f"No work hour data found for {location} in the period."}
 
-        client = get_gspread_client()
-        if not client:
-            raise Exception("Could not connect to Google Sheets.")
-            
-        workbook = client.open("HOW-15-Day-Summary")
         # Updated sheet name to be consistent with payroll CSVs
         sheet_name = f"{location} Summary - {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}"
         
-        try:
-            worksheet = workbook.worksheet(sheet_name)
-            worksheet.clear() 
-        except gspread.exceptions.WorksheetNotFound:
-            worksheet = workbook.add_worksheet(title=sheet_name, rows="100", cols="10")
-        
-        header = ["First Name", "Last Name", "Role", "Total Hours (15-day Period)"]
-        worksheet.append_row(header)
-        worksheet.append_rows(report_data)
+        write_report(summary_workbook(location), sheet_name, SUMMARY_HEADER, report_data)
 
-        print(f"Successfully generated summary for {location} in sheet: {sheet_name}")
+        logger.info(f"Successfully generated summary for {location} in sheet: {sheet_name}")
         
         # --- CHANGE START ---
         # Added cleanup call for summary sheets after a new one is generated.
-        cleanup_old_sheets("HOW-15-Day-Summary", sheet_type="summary")
+        schedule_cleanup(summary_workbook(location), sheet_type="summary")
         # --- CHANGE END ---
 
         return {"message": f"Report successfully generated for {location}."}
 
     except Exception as e:
-        print(f"An error occurred during report generation for {location}: {e}")
+        logger.error(f"An error occurred during report generation for {location}: {e}")
         raise
 
+def schedule_cleanup(workbook_name, sheet_type="log"):
+    """
+    Queues cleanup_old_sheets as low-priority background work, at most once per
+    CLEANUP_INTERVAL_SECONDS for each workbook.
+    """
+    with _cleanup_lock:
+        now = time.monotonic()
+        last = _last_cleanup.get(workbook_name)
+        if last is not None and now - last < CLEANUP_INTERVAL_SECONDS:
+            return
+        _last_cleanup[workbook_name] = now
+    sheets_scheduler.submit(cleanup_old_sheets, workbook_name, sheet_type=sheet_type)
+
 def cleanup_old_sheets (workbook_name, sheet_type = "log"):
     client = get_gspread_client()
     if not client:
-        print ("Failed to authenticate with Google Sheets")
+        logger.error("Failed to authenticate with Google Sheets")
         return
     
     workbook = client.open(workbook_name)
@@ -217,20 +346,21 @@ def cleanup_old_sheets (workbook_name, sheet_type = "log"):
     # Keep sheets for approximately 6 months
     cutoff_date = today - timedelta(days = 6 * 30)
 
-    for sheet in workbook.worksheets():
+    for sheet in sheets_scheduler.call(workbook.worksheets):
         try: 
             if sheet_type == "log" or sheet_type == "summary":
                  # Extracts the start date from titles like "Location - YYYY-MM-DD to YYYY-MM-DD"
                  # or "Location Summary - YYYY-MM-DD to YYYY-MM-DD"
                 date_part = sheet.title.split(" - ")[1].split(" to ")[0]
             else: 
-                print(f"Unknown sheet_type: {sheet_type}")
+                logger.warning(f"Unknown sheet_type: {sheet_type}")
                 continue
 
             sheet_start_date = datetime.strptime(date_part, "%Y-%m-%d").date()
             
             if sheet_start_date < cutoff_date:
-                print(f"Deleting old sheet: {sheet.title}")
-                workbook.del_worksheet(sheet)
+                logger.info(f"Deleting old sheet: {sheet.title}")
+                sheets_scheduler.call(workbook.del_worksheet, sheet)
+                sheets_scheduler.forget_workbook(workbook_name)
         except Exception as e:
-            print(f"Skipping sheet '{sheet.title}', could not parse date: {e}")
+            logger.warning(f"Skipping sheet '{sheet.title}', could not parse date: {e}")
@@ -0,0 +1,216 @@
+# metrics.py
+
+"""
+This file collects request and backend-call metrics and serves them at /metrics in
+the Prometheus text format.
+
+It records:
+- the number and latency of requests for each Flask route,
+- the number and latency of Firestore, Google Sheets and SMTP calls, labelled with
+  the route that caused them (calls made by background workers are labelled
+  "background"),
+- the queue depth of every registered background worker.
+
+Every track_call() is also recorded as a client span (see tracing.py).
+
+All of this lives in the memory of one process. Under gunicorn each worker keeps
+its own counters, and a /metrics scrape is answered by whichever worker gets it, so
+every series carries a "worker" label (the process ID) and dashboards must sum over
+it. The same goes for the per-route Firestore cost report and the single-flight
+coalescing counters, which only see the requests their worker served.
+
+Usage:
+    metrics.init_app(app)                      # once, in app.py
+    with metrics.track_call("smtp", "send"):   # around any external call
+        ...
+    metrics.register_queue_depth("clock_journal", lambda: journal_size)
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import Response, g, request
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The route currently being served, used to attribute backend calls to a request.
+current_route = ContextVar("current_route", default="background")
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_queue_depths = {}
+_help = {}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def describe(name, text):
+    """Sets the HELP text shown for a metric."""
+    _help[name] = text
+
+
+def inc(name, labels, value=1):
+    """Adds value to a counter."""
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[_key(labels)] = series.get(_key(labels), 0) + value
+
+
+def observe(name, labels, value):
+    """Records one observation (in seconds) in a latency histogram."""
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        entry = series.get(_key(labels))
+        if entry is None:
+            entry = series[_key(labels)] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                entry["buckets"][i] += 1
+        entry["sum"] += value
+        entry["count"] += 1
+
+
+def counter_values(name):
+    """Returns {sorted label tuple: value} for every series of a counter."""
+    with _lock:
+        return dict(_counters.get(name, {}))
+
+
+def register_queue_depth(name, depth_fn):
+    """
+    Registers a background worker queue whose current depth is reported on /metrics.
+
+    Args:
+        name (str): The worker's name, used as the "queue" label.
+        depth_fn (callable): Returns the number of items currently waiting.
+    """
+    with _lock:
+        _queue_depths[name] = depth_fn
+
+
+@contextmanager
+def track_call(backend, operation, activate=True, **attributes):
+    """
+    Times an external call, records it against the current route and traces it.
+
+    Args:
+        backend (str): "firestore", "sheets", "smtp" or "identity_toolkit".
+        operation (str): What kind of call it is, e.g. "read", "write", "values.append".
+        activate (bool): Whether the call's span is current inside the block; pass
+            False from generators that yield inside it (see tracing.span).
+        **attributes: Extra span attributes, e.g. the query or the URL path.
+    """
+    labels = {"backend": backend, "operation": operation, "route": current_route.get()}
+    start = time.perf_counter()
+    with span(f"{backend} {operation}", kind="client", attributes={"backend": backend, **attributes},
+              activate=activate):
+        try:
+            yield labels
+        except Exception:
+            inc("backend_call_errors_total", labels)
+            raise
+        finally:
+            inc("backend_calls_total", labels)
+            observe("backend_call_duration_seconds", labels, time.perf_counter() - start)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_prometheus():
+    """Returns every metric in the Prometheus text exposition format."""
+    # Each worker process has its own numbers; the label keeps their series apart.
+    worker = (("worker", os.getpid()),)
+    with _lock:
+        counters = {name: dict(series) for name, series in _counters.items()}
+        histograms = {name: {k: dict(v, buckets=list(v["buckets"])) for k, v in series.items()}
+                      for name, series in _histograms.items()}
+        queue_depths = dict(_queue_depths)
+
+    lines = []
+    for name in sorted(counters):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(counters[name].items()):
+            labels = worker + labels
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for name in sorted(histograms):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, entry in sorted(histograms[name].items()):
+            labels = worker + labels
+            for bound, count in zip(LATENCY_BUCKETS, entry["buckets"]):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {entry['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {entry['sum']:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {entry['count']}")
+
+    lines.append("# HELP background_queue_depth Items waiting in each background worker queue.")
+    lines.append("# TYPE background_queue_depth gauge")
+    for name, depth_fn in sorted(queue_depths.items()):
+        try:
+            depth = depth_fn()
+        except Exception as e:
+            logger.error(f"Error reading queue depth for '{name}': {e}")
+            continue
+        lines.append(f"background_queue_depth{_format_labels(worker + (('queue', name),))} {depth}")
+
+    return "\n".join(lines) + "\n"
+
+
+describe("http_requests_total", "Requests served, by Flask route, method and status code.")
+describe("http_request_duration_seconds", "Request latency by Flask route.")
+describe("backend_calls_total", "Firestore, Google Sheets and SMTP calls, by the route that caused them.")
+describe("backend_call_errors_total", "Firestore, Google Sheets and SMTP calls that raised an error.")
+describe("backend_call_duration_seconds", "Latency of Firestore, Google Sheets and SMTP calls.")
+
+
+def init_app(app):
+    """
+    Installs the request timing hooks and the /metrics route on the Flask app.
+    """
+
+    @app.before_request
+    def _start_request_timer():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.metrics_start = time.perf_counter()
+        g.metrics_route_token = current_route.set(route)
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            labels = {"route": current_route.get(), "method": request.method}
+            observe("http_request_duration_seconds", labels, time.perf_counter() - start)
+            inc("http_requests_total", dict(labels, status=response.status_code))
+        return response
+
+    @app.teardown_request
+    def _reset_route(exc):
+        token = g.pop("metrics_route_token", None)
+        if token is not None:
+            current_route.reset(token)
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
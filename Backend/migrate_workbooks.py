@@ -0,0 +1,107 @@
+# migrate_workbooks.py
+
+"""
+Moves existing period tabs into the workbooks chosen by workbook_routing.py.
+
+For every location, each log tab ("<location> - <start> to <end>") and summary tab
+("<location> Summary - <start> to <end>") found in the shared workbooks is copied
+to the location's routed workbook, renamed back to its original title and then
+deleted from the shared workbook. Tabs whose routed workbook is the shared one are
+left alone, and a tab that already exists in the destination is skipped (and kept
+in the source) so the migration can be re-run safely.
+
+The destination workbooks must already exist and be shared with the service account.
+
+Run it from the Backend directory:
+    python migrate_workbooks.py --dry-run
+    python migrate_workbooks.py --location Everett
+"""
+
+import argparse
+import sys
+import gspread
+from locations import locations
+from logging_google_sheets import get_gspread_client
+from sheets_scheduler import REPORT, call, forget_workbook
+from workbook_routing import DEFAULT_WORKBOOKS, workbook_for
+
+TAB_PREFIXES = {"log": "{location} - ", "summary": "{location} Summary - "}
+
+
+def migrate_location(client, location, sheet_type, dry_run=False):
+    """
+    Moves one location's tabs of one type out of the shared workbook.
+
+    Returns:
+        dict: {"moved": [titles], "skipped": [titles]}
+    """
+    result = {"moved": [], "skipped": []}
+    source_name = DEFAULT_WORKBOOKS[sheet_type]
+    destination_name = workbook_for(location, sheet_type)
+    if destination_name == source_name:
+        return result
+
+    source = call(client.open, source_name, priority=REPORT)
+    destination = call(client.open, destination_name, priority=REPORT)
+    existing = {ws.title for ws in call(destination.worksheets, priority=REPORT)}
+    prefix = TAB_PREFIXES[sheet_type].format(location=location)
+
+    for worksheet in call(source.worksheets, priority=REPORT):
+        # "Everett - ..." must not also match a location named "Everett North".
+        if not worksheet.title.startswith(prefix):
+            continue
+        if worksheet.title in existing:
+            print(f"'{worksheet.title}' already exists in '{destination_name}'; leaving the original in place.")
+            result["skipped"].append(worksheet.title)
+            continue
+        if dry_run:
+            print(f"Would move '{worksheet.title}' from '{source_name}' to '{destination_name}'.")
+            result["moved"].append(worksheet.title)
+            continue
+
+        copied = call(worksheet.copy_to, destination.id, priority=REPORT)
+        copy = call(destination.get_worksheet_by_id, copied["sheetId"], priority=REPORT)
+        call(copy.update_title, worksheet.title, priority=REPORT)
+        call(source.del_worksheet, worksheet, priority=REPORT)
+        print(f"Moved '{worksheet.title}' from '{source_name}' to '{destination_name}'.")
+        result["moved"].append(worksheet.title)
+
+    if not dry_run and result["moved"]:
+        forget_workbook(source_name)
+        forget_workbook(destination_name)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move period tabs into the per-location workbooks.")
+    parser.add_argument("--location", action="append", help="only migrate this location (repeatable)")
+    parser.add_argument("--type", choices=["log", "summary"], action="append", dest="types",
+                        help="only migrate this kind of tab (default: both)")
+    parser.add_argument("--dry-run", action="store_true", help="list the tabs that would move")
+    args = parser.parse_args(argv)
+
+    client = get_gspread_client()
+    if not client:
+        print("Could not connect to Google Sheets.")
+        return 1
+
+    failed = False
+    for location in args.location or locations:
+        for sheet_type in args.types or ["log", "summary"]:
+            try:
+                result = migrate_location(client, location, sheet_type, args.dry_run)
+            except gspread.exceptions.SpreadsheetNotFound as e:
+                print(f"Workbook not found for {location} ({sheet_type}): {e}. Create it and share it with the service account.")
+                failed = True
+                continue
+            except Exception as e:
+                print(f"Error migrating {sheet_type} tabs for {location}: {e}")
+                failed = True
+                continue
+            if result["moved"] or result["skipped"]:
+                print(f"{location} ({sheet_type}): {len(result['moved'])} moved, {len(result['skipped'])} skipped")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
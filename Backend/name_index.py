@@ -0,0 +1,188 @@
+# name_index.py
+
+"""
+This file keeps an in-memory index of user names per location for staff look-ups.
+
+find_user_by_name used to run a Firestore query that needed the exact,
+case-sensitive first and last name on every look-up. A LocationNameIndex holds
+the users of one location, loaded once through an on_snapshot listener on
+
+    users where tutoringLocation array_contains L
+
+and kept current by it. Names are normalized (accents removed, case folded,
+spaces collapsed), so "jose", "José" and "JOSE " all match. Every word of every
+name goes into a sorted list, and prefix searches bisect into it.
+
+Indexes are only built for the locations in locations.py, so a request cannot
+start a listener for an arbitrary location string. When the index is not ready,
+get_name_index() returns None and callers fall back to querying Firestore. As in
+shift_ledger.py, an index whose listener failed, stopped streaming, or has sent
+nothing for NAME_INDEX_MAX_STALENESS_SECONDS (default 600) is rebuilt on the next
+look-up. Set NAME_INDEX_ENABLED=false to turn it off.
+"""
+
+import logging
+import os
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from dotenv import load_dotenv
+from firebase_config import db
+from locations import locations
+from metrics import inc
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("NAME_INDEX_ENABLED", "true").lower() != "false"
+READY_TIMEOUT_SECONDS = float(os.getenv("NAME_INDEX_READY_TIMEOUT_SECONDS", "5"))
+MAX_STALENESS_SECONDS = float(os.getenv("NAME_INDEX_MAX_STALENESS_SECONDS", "600"))
+
+
+def normalize(name):
+    """Folds case and accents and collapses whitespace: " José  Núñez" -> "jose nunez"."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+class LocationNameIndex:
+    """The names of one location's users, kept current by a Firestore listener."""
+
+    def __init__(self, location):
+        self.location = location
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.failed = False
+        self._received_at = None  # When the latest snapshot arrived (time.monotonic()).
+        self._users = {}         # uid -> {"uid", "firstName", "lastName", "role", "name"}
+        self._words = []         # sorted (word, uid) pairs
+        self._keys = []          # the words alone, for bisect
+        self._by_name = {}       # normalized "first last" -> [uid, ...]
+        query = db.collection('users').where('tutoringLocation', 'array_contains', location)
+        self._watch = query.on_snapshot(self._on_snapshot)
+
+    def _rebuild(self):
+        # Locations have a few hundred users, so re-sorting on each change is cheap
+        # and keeps lookups to a bisect.
+        words, by_name = [], {}
+        for uid, user in self._users.items():
+            for word in set(user["name"].split()):
+                words.append((word, uid))
+            by_name.setdefault(user["name"], []).append(uid)
+        words.sort()
+        self._words, self._keys, self._by_name = words, [word for word, _ in words], by_name
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        try:
+            with self._lock:
+                for change in changes:
+                    uid = change.document.id
+                    if change.type.name == 'REMOVED':
+                        self._users.pop(uid, None)
+                        continue
+                    data = change.document.to_dict() or {}
+                    self._users[uid] = {
+                        "uid": uid,
+                        "firstName": data.get("firstName", ""),
+                        "lastName": data.get("lastName", ""),
+                        "role": data.get("role"),
+                        "name": normalize(f"{data.get('firstName', '')} {data.get('lastName', '')}")
+                    }
+                self._rebuild()
+                self._received_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error applying user changes to the {self.location} name index: {e}")
+            self.failed = True
+        self._ready.set()
+
+    def healthy(self):
+        """
+        Returns False if the index can no longer be trusted: a snapshot failed to apply,
+        the listener stopped, or no snapshot has arrived for MAX_STALENESS_SECONDS.
+        """
+        if self.failed:
+            return False
+        # Firestore's Watch closes itself on an unrecoverable stream error without
+        # telling the callback, so its state is checked directly.
+        if getattr(self._watch, "_closed", False) or not getattr(self._watch, "is_active", True):
+            logger.warning(f"The {self.location} name index listener has stopped.")
+            self.failed = True
+            return False
+        if self._received_at is not None and time.monotonic() - self._received_at > MAX_STALENESS_SECONDS:
+            logger.info(f"The {self.location} name index is stale.")
+            self.failed = True
+            return False
+        return True
+
+    def wait_ready(self, timeout=READY_TIMEOUT_SECONDS):
+        return self._ready.wait(timeout) and self.healthy()
+
+    def close(self):
+        try:
+            self._watch.unsubscribe()
+        except Exception as e:
+            logger.error(f"Error closing the {self.location} name index listener: {e}")
+
+    @staticmethod
+    def _public(user):
+        return {key: user[key] for key in ("uid", "firstName", "lastName", "role")}
+
+    def lookup(self, first_name, last_name):
+        """Returns the users whose normalized first and last name match exactly."""
+        with self._lock:
+            uids = self._by_name.get(normalize(f"{first_name} {last_name}"), [])
+            return [self._public(self._users[uid]) for uid in uids]
+
+    def search(self, query, limit=10):
+        """
+        Returns up to limit users with a name word starting with each word of the
+        query, e.g. "jo sm" finds "John Smith". Full-name prefix matches come first.
+        """
+        terms = normalize(query).split()
+        if not terms:
+            return []
+        with self._lock:
+            # Candidates come from the longest term, which narrows the range the most.
+            first = max(terms, key=len)
+            candidates = set()
+            i = bisect_left(self._keys, first)
+            while i < len(self._keys) and self._keys[i].startswith(first):
+                candidates.add(self._words[i][1])
+                i += 1
+            matches = [self._users[uid] for uid in candidates
+                       if all(any(word.startswith(term) for word in self._users[uid]["name"].split()) for term in terms)]
+        full = normalize(query)
+        matches.sort(key=lambda user: (not user["name"].startswith(full), user["name"]))
+        return [self._public(user) for user in matches[:limit]]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_name_index(location):
+    """
+    Returns the ready name index for a location, or None if it is not available or
+    the location is not one of ours.
+    """
+    if not ENABLED or location not in locations:
+        return None
+    with _indexes_lock:
+        index = _indexes.get(location)
+        if index is not None and not index.healthy():
+            # The listener broke or went stale: start over.
+            index.close()
+            index = None
+        if index is None:
+            try:
+                index = _indexes[location] = LocationNameIndex(location)
+            except Exception as e:
+                logger.warning(f"Could not start the name index for {location}: {e}")
+                return None
+    if not index.wait_ready():
+        inc("name_index_misses_total", {"location": location})
+        return None
+    return index
@@ -9,6 +9,7 @@ database to store session details and tutor assignments.
 from firebase_config import db
 from datetime import time
 from firebase_admin import firestore
+import delta_sync
 import re
 
 # --- Firestore Data Model ---
@@ -89,7 +90,8 @@ def create_online_session(day_of_week, start_time, end_time):
         "day_of_week": day_of_week,
         "start_time": start_time,
         "end_time": end_time,
-        "tutors": []
+        "tutors": [],
+        "updated_at": firestore.SERVER_TIMESTAMP
     })
     session_id = session_ref[1].id if isinstance(session_ref, tuple) else session_ref.id
     return {"message": "Session created successfully.", "session_id": session_id}
@@ -111,6 +113,7 @@ def delete_online_session(session_id):
     session_ref = db.collection("online_sessions").document(session_id)
     if session_ref.get().exists:
         session_ref.delete()
+        delta_sync.record_deletions("online_sessions", [session_id])
         return {"message": f"Session {session_id} deleted."}
     return {"error": "Session not found."}
 
@@ -151,6 +154,7 @@ def edit_online_session(session_id, new_day=None, new_start_time=None, new_end_t
     if not updates:
         return {"message": "No valid updates provided"}
 
+    updates["updated_at"] = firestore.SERVER_TIMESTAMP
     session_ref.update(updates)
     return {"message": "Session updated successfully"}
     
@@ -189,7 +193,7 @@ def add_tutor_to_session(session_id, tutor_id):
             "googleMeetsLink": tutor_info.get("googleMeetsLink")
         }
 
-        session_ref.update({"tutors": firestore.ArrayUnion([tutor_data])})
+        session_ref.update({"tutors": firestore.ArrayUnion([tutor_data]), "updated_at": firestore.SERVER_TIMESTAMP})
         return {"message": f"Tutor {tutor_id} added to session {session_id}."}
     except Exception as e:
         return {"error": f"An error occurred: {e}"}
@@ -227,7 +231,8 @@ def remove_tutor_from_session(session_id, tutor_id):
     
         if tutor_to_remove:
             session_ref.update({
-                "tutors": firestore.ArrayRemove([tutor_to_remove])
+                "tutors": firestore.ArrayRemove([tutor_to_remove]),
+                "updated_at": firestore.SERVER_TIMESTAMP
             })
             return {"message": f"Tutor {tutor_id} removed from session {session_id}."}
         else:
@@ -7,6 +7,7 @@
 
 # --- Imports ---
 # Standard library imports for email, CSV creation, and date/time handling.
+import logging
 import smtplib
 import ssl
 from email.mime.multipart import MIMEMultipart
@@ -23,6 +24,12 @@ from firebase_config import db # Assumes 'db' is the initialized Firestore clien
 
 # Imports from other project files.
 from locations import locations # List of all tutoring locations.
+from metrics import track_call
+from logging_google_sheets import sum_shift_durations
+from shift_ledger import period_hours_by_user
+
+logger = logging.getLogger(__name__)
+
 # We will need a function similar to generate_15_day_location_summary from logging_google_sheets.py
 # For this example, we'll assume a helper function exists to fetch this data.
 
@@ -50,12 +57,12 @@ def handle_payroll_approval(location, user_role, user_locations):
     if user_role.lower() == 'senior_pm' and location not in user_locations:
         return {"status": "error", "message": "You do not have permission to approve this location."}
 
-    print(f"Starting payroll approval process for {location}...")
+    logger.info(f"Starting payroll approval process for {location}...")
     try:
         # 1. Generate the 15-day payroll summary CSV data in memory.
         csv_data, start_date, end_date = generate_payroll_data_for_location(location)
         if not csv_data or len(csv_data) <= 1: # Header only or empty
-            print(f"No payroll data found for {location}. Aborting.")
+            logger.warning(f"No payroll data found for {location}. Aborting.")
             return {"status": "error", "message": f"No payroll data to approve for {location}."}
 
         # Create a filename for the CSV attachment using the pay period dates.
@@ -64,7 +71,7 @@ def handle_payroll_approval(location, user_role, user_locations):
         # 2. Fetch the list of all admin users from Firestore.
         admin_emails = get_admin_emails()
         if not admin_emails:
-            print("No admin emails found. Cannot send approval email.")
+            logger.warning("No admin emails found. Cannot send approval email.")
             return {"status": "error", "message": "Could not find any admin users to notify."}
 
         # 3. Send the location-specific payroll CSV to all admins.
@@ -77,11 +84,11 @@ def handle_payroll_approval(location, user_role, user_locations):
         if check_all_locations_approved():
             send_final_approval_email()
 
-        print(f"Payroll approval process for {location} completed successfully.")
+        logger.info(f"Payroll approval process for {location} completed successfully.")
         return {"status": "success", "message": f"Payroll for {location} approved and email sent."}
 
     except Exception as e:
-        print(f"An error occurred during payroll approval for {location}: {e}")
+        logger.error(f"An error occurred during payroll approval for {location}: {e}")
         return {"status": "error", "message": str(e)}
 
 # --- Helper Functions ---
@@ -106,29 +113,20 @@ def generate_payroll_data_for_location(location):
     users_query = db.collection('users').where('tutoringLocation', 'array_contains', location).stream()
     location_users = {user.id: user.to_dict() for user in users_query}
     report_data = [['First Name', 'Last Name', 'Role', 'Total Hours']]
+    # The period's running hours per user from the in-memory ledger, or None to query each user
+    ledger_hours = period_hours_by_user(location, start_date, end_date)
 
     for user_id, user_data in location_users.items():
-        total_duration = timedelta()
-        shifts_ref = db.collection('shifts').where('user_id', '==', user_id).where('location', '==', location).order_by('timestamp').stream()
-        
-        clock_in_time = None
-        for shift in shifts_ref:
-            shift_data = shift.to_dict()
-            # Timestamps are stored as ISO format strings, convert them to datetime objects
-            event_time = datetime.fromisoformat(shift_data.get("timestamp"))
-
-            if not (start_date <= event_time.date() <= end_date):
-                continue
-
-            if shift_data.get("event") == 'clock-in':
-                clock_in_time = event_time
-            elif shift_data.get("event") == 'clock-out' and clock_in_time:
-                duration = event_time - clock_in_time
-                total_duration += duration
-                clock_in_time = None 
-
-        if total_duration.total_seconds() > 0:
-            total_hours = round(total_duration.total_seconds() / 3600, 2)
+        if ledger_hours is not None:
+            hours = ledger_hours.get(user_id, 0)
+        else:
+            shifts_ref = db.collection('shifts').where('user_id', '==', user_id).where('location', '==', location).order_by('timestamp').stream()
+            shifts = (shift.to_dict() for shift in shifts_ref)
+            # Same pairing rules as the 15-day summary sheet
+            hours = sum_shift_durations(shifts, start_date, end_date).total_seconds() / 3600
+
+        if hours > 0:
+            total_hours = round(hours, 2)
             report_data.append([
                 user_data.get('firstName', ''),
                 user_data.get('lastName', ''),
@@ -154,7 +152,7 @@ def get_admin_emails():
         emails = [user.to_dict().get('email') for user in users_ref if user.to_dict().get('email')]
         return emails
     except Exception as e:
-        print(f"Error fetching admin emails: {e}")
+        logger.error(f"Error fetching admin emails: {e}")
         return []
 
 def send_location_approval_email(recipient_emails, location, csv_data, filename):
@@ -192,7 +190,7 @@ def send_location_approval_email(recipient_emails, location, csv_data, filename)
 
     # Send the email
     context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
+    with track_call('smtp', 'send'), smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
         server.login(SENDER_EMAIL, SENDER_PASSWORD)
         server.send_message(message)
     
@@ -224,12 +222,13 @@ def record_location_approval(location):
             'location': location,
             'pay_period_id': pay_period_id,
             'approved_at': firestore.SERVER_TIMESTAMP,
-            'status': 'approved'
+            'status': 'approved',
+            'updated_at': firestore.SERVER_TIMESTAMP
         })
 
-        print(f"recorded payroll approved for {location} in pay period {pay_period_id}")
+        logger.info(f"recorded payroll approved for {location} in pay period {pay_period_id}")
     except Exception as e:
-        print(f"Error recording payroll approval for {location}: {e}")
+        logger.error(f"Error recording payroll approval for {location}: {e}")
         return {"status": "error", "message": str(e)}
 
 def check_all_locations_approved():
@@ -261,12 +260,12 @@ def check_all_locations_approved():
         
         all_approved = set(locations).issubset(approved_locations)
         
-        print(f"Approved locations for {pay_period_id}: {approved_locations}")
-        print(f"All locations approve? {all_approved}")
+        logger.info(f"Approved locations for {pay_period_id}: {approved_locations}")
+        logger.info(f"All locations approve? {all_approved}")
         
         return all_approved
     except Exception as e:
-        print(f"Error checking approvals: {e}")
+        logger.error(f"Error checking approvals: {e}")
         return False
         
         
@@ -276,14 +275,17 @@ def send_final_approval_email():
     Sends a final confirmation email to all admins, stating that payroll
     for all locations has been verified. This email contains all the
     individual location CSVs as attachments.
+
+    Returns:
+        dict: The status ("success" or "error") and a message.
     """
-    print("All locations approved. Sending final payroll summary email.")
+    logger.info("All locations approved. Sending final payroll summary email.")
     
     # 1. Get admin emails.
     admin_emails = get_admin_emails()
     if not admin_emails:
-        print("No admin emails found. Cannot send final approval email")
-        return
+        logger.warning("No admin emails found. Cannot send final approval email")
+        return {"status": "error", "message": "Could not find any admin users to notify."}
     
     # 2. Create the email message.
     msg = MIMEMultipart()
@@ -306,7 +308,7 @@ def send_final_approval_email():
         try:
             csv_data, _, _ = generate_payroll_data_for_location(location)
             if not csv_data or len(csv_data) <= 1:
-                print(f"No data for {location}; skipping attachment.")
+                logger.warning(f"No data for {location}; skipping attachment.")
                 continue
 
             filename = f"{location}_payroll_{datetime.now().strftime('%Y-%m-%d')}.csv"
@@ -320,7 +322,7 @@ def send_final_approval_email():
             part.add_header("Content-Disposition", f"attachment; filename={filename}")
             msg.attach(part)
         except Exception as e:
-            print(f"Error generating CSV for {location}: {e}")
+            logger.error(f"Error generating CSV for {location}: {e}")
 
 
     #     # Logic to attach each CSV file to the email.
@@ -331,14 +333,14 @@ def send_final_approval_email():
     #     server.sendmail(SENDER_EMAIL, admin_emails, msg.as_string())
     try:
         context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
+        with track_call('smtp', 'send'), smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
             server.login(SENDER_EMAIL, SENDER_PASSWORD)
             server.send_message(msg)
-        print("Final approval email sent successfully.")
+        logger.info("Final approval email sent successfully.")
+        return {"status": "success", "message": "Final payroll email sent."}
     except Exception as e:
-        print(f"Failed to send final approval email: {e}")
-    
-    print("Final approval email sent successfully.")
+        logger.error(f"Failed to send final approval email: {e}")
+        return {"status": "error", "message": f"Failed to send final approval email: {e}"}
 
 # --- Flask Route Integration ---
 # In your app.py, you would add a route like this:
@@ -370,7 +372,7 @@ def list_payroll_approvals():
                  .stream()
         return {doc.id: doc.to_dict() for doc in docs}
     except Exception as e:
-        print(f"Error fetching approvals: {e}")
+        logger.error(f"Error fetching approvals: {e}")
         return {}
 
 def list_payroll_approvals():
@@ -386,5 +388,5 @@ def list_payroll_approvals():
                  .stream()
         return {doc.id: doc.to_dict() for doc in docs}
     except Exception as e:
-        print(f"Error fetching approvals: {e}")
+        logger.error(f"Error fetching approvals: {e}")
         return {}
@@ -0,0 +1,232 @@
+# periodic_tasks.py
+
+"""
+This file runs the recurring admin work on a schedule inside the backend process:
+
+- macro_attendance:    the monthly attendance summary, for the previous month, from
+                       00:30 on the 1st.
+- period_tabs:         each location's log and summary tabs for the next pay period,
+                       PRECREATE_HOURS_AHEAD (default 36) hours before it starts, so
+                       the first clock-in of a period does not have to create them.
+- overnight_summaries: every location's 15-day summary, at 01:00 each night.
+- sheet_cleanup:       removal of old log and summary tabs, at 02:00 each night.
+- analytics_sync:      an incremental sync of the analytics mirror every
+                       ANALYTICS_SYNC_MINUTES (default 15).
+- analytics_full_sync: a full resync of the analytics mirror, at 03:00 each night.
+- archival:            moving old months of shifts and attendance to cold storage, at
+                       04:00 each night.
+- tombstone_purge:     removal of delta-sync tombstones older than
+                       TOMBSTONE_RETENTION_DAYS, at 05:00 each night.
+
+The tasks themselves are submitted to job_queue, so they show up on /jobs like a
+manual run and an identical manual run already in progress is reused.
+
+Catch-up: the last run of every task is stored in the Firestore "scheduler_runs"
+collection. After downtime every missed run is submitted (the latest one for
+nightly tasks, every missed month for the macro report).
+
+Leader election: when several worker processes run the app, only the holder of the
+lease document scheduler_runs/_leader runs tasks. The lease is taken and renewed in
+a Firestore transaction and expires LEASE_SECONDS after the holder stops renewing it.
+
+Set SCHEDULER_ENABLED=false to turn the scheduler off, e.g. on a development machine.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from firebase_admin import firestore
+from firebase_config import db
+from locations import locations
+import job_queue
+from logging_google_sheets import get_pay_period_dates
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() != "false"
+TICK_SECONDS = 60
+LEASE_SECONDS = 3 * TICK_SECONDS
+PRECREATE_HOURS_AHEAD = float(os.getenv("PRECREATE_HOURS_AHEAD", "36"))
+ANALYTICS_SYNC_MINUTES = int(os.getenv("ANALYTICS_SYNC_MINUTES", "15"))
+# At most this many missed months of the macro report are caught up.
+MAX_CATCH_UP_MONTHS = 12
+
+RUNS_COLLECTION = "scheduler_runs"
+LEASE_DOCUMENT = "_leader"
+
+
+def previous_month(day):
+    """Returns the month before the one containing day, as "YYYY-MM"."""
+    return (day.replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+
+
+def _next_month(month):
+    year, month = map(int, month.split("-"))
+    return f"{year + month // 12}-{month % 12 + 1:02d}"
+
+
+def _last_daily_run(now, hour):
+    """Returns the date of the latest hour:00 that has already passed."""
+    return now.date() if now.hour >= hour else now.date() - timedelta(days=1)
+
+
+def _macro_attendance_due(now, last_key):
+    # The report for month M is due from 00:30 on the 1st of the month after M.
+    started = now >= datetime.combine(now.date().replace(day=1), datetime.min.time()) + timedelta(minutes=30)
+    latest = previous_month(now.date()) if started else previous_month(now.date().replace(day=1) - timedelta(days=1))
+    if not last_key:
+        return [latest]
+    months = []
+    month = _next_month(last_key)
+    while month <= latest and len(months) < MAX_CATCH_UP_MONTHS:
+        months.append(month)
+        month = _next_month(month)
+    return months
+
+
+def _period_tabs_due(now, last_key):
+    current_start, current_end = get_pay_period_dates(now.date())
+    next_start = current_end + timedelta(days=1)
+    due = [current_start]
+    if now >= datetime.combine(next_start, datetime.min.time()) - timedelta(hours=PRECREATE_HOURS_AHEAD):
+        due.append(next_start)
+    return [d.isoformat() for d in due if not last_key or d.isoformat() > last_key]
+
+
+def _nightly(hour):
+    def due(now, last_key):
+        key = _last_daily_run(now, hour).isoformat()
+        return [key] if not last_key or key > last_key else []
+    return due
+
+
+def _every(minutes):
+    def due(now, last_key):
+        slot = now.replace(minute=now.minute - now.minute % minutes if minutes < 60 else 0, second=0, microsecond=0)
+        key = slot.isoformat(timespec="minutes")
+        return [key] if not last_key or key > last_key else []
+    return due
+
+
+def _submit_macro_attendance(key):
+    return [job_queue.submit("macro_attendance", {"report_month": key})[0]["id"]]
+
+
+def _submit_period_tabs(key):
+    return [job_queue.submit("precreate_period_tabs", {"period_start": key})[0]["id"]]
+
+
+def _submit_summaries(key):
+    return [job_queue.submit("15_day_summary", {"location": location})[0]["id"] for location in locations]
+
+
+def _submit_cleanup(key):
+    return [job_queue.submit("sheet_cleanup")[0]["id"]]
+
+
+def _submit_analytics_sync(key):
+    return [job_queue.submit("analytics_sync", {"full": False})[0]["id"]]
+
+
+def _submit_analytics_full_sync(key):
+    return [job_queue.submit("analytics_sync", {"full": True})[0]["id"]]
+
+
+def _submit_archival(key):
+    return [job_queue.submit("archive_closed_periods")[0]["id"]]
+
+
+def _submit_tombstone_purge(key):
+    return [job_queue.submit("purge_tombstones")[0]["id"]]
+
+
+# name: (function returning the keys of the runs that are due, function submitting one run)
+TASKS = {
+    "macro_attendance": (_macro_attendance_due, _submit_macro_attendance),
+    "period_tabs": (_period_tabs_due, _submit_period_tabs),
+    "overnight_summaries": (_nightly(1), _submit_summaries),
+    "sheet_cleanup": (_nightly(2), _submit_cleanup),
+    "analytics_sync": (_every(ANALYTICS_SYNC_MINUTES), _submit_analytics_sync),
+    "analytics_full_sync": (_nightly(3), _submit_analytics_full_sync),
+    "archival": (_nightly(4), _submit_archival),
+    "tombstone_purge": (_nightly(5), _submit_tombstone_purge),
+}
+
+
+class PeriodicTaskRunner:
+    """Checks every TICK_SECONDS whether this process is the leader and, if so, runs due tasks."""
+
+    def __init__(self, tasks=TASKS):
+        self._tasks = tasks
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._runs = db.collection(RUNS_COLLECTION)
+        self._thread = threading.Thread(target=self._loop, name="periodic-tasks", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _acquire_lease(self):
+        """Takes or renews the leader lease. Returns True if this process holds it."""
+        ref = self._runs.document(LEASE_DOCUMENT)
+
+        @firestore.transactional
+        def acquire(transaction):
+            snapshot = ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            now = time.time()
+            if lease.get("holder") not in (None, self.holder) and lease.get("expires_at", 0) > now:
+                return False
+            transaction.set(ref, {"holder": self.holder, "expires_at": now + LEASE_SECONDS})
+            return True
+
+        return acquire(db.transaction())
+
+    def run_due_tasks(self, now=None):
+        """Submits every run that is due and records it. Returns {task: [keys submitted]}."""
+        now = now or datetime.now()
+        submitted = {}
+        for name, (due, submit) in self._tasks.items():
+            try:
+                snapshot = self._runs.document(name).get()
+                last_key = snapshot.to_dict().get("last_key") if snapshot.exists else None
+                for key in due(now, last_key):
+                    job_ids = submit(key)
+                    self._runs.document(name).set({
+                        "last_key": key,
+                        "last_run_at": datetime.now().isoformat(),
+                        "job_ids": job_ids,
+                        "holder": self.holder
+                    })
+                    submitted.setdefault(name, []).append(key)
+                    logger.info(f"Scheduled task '{name}' submitted for {key}")
+            except Exception as e:
+                logger.error(f"Error running scheduled task '{name}': {e}")
+        return submitted
+
+    def _loop(self):
+        while True:
+            try:
+                if self._acquire_lease():
+                    self.run_due_tasks()
+            except Exception as e:
+                logger.error(f"Error in periodic task scheduler: {e}")
+            time.sleep(TICK_SECONDS)
+
+
+_runner = None
+
+
+def start():
+    """Starts the scheduler thread once per process, unless SCHEDULER_ENABLED is false."""
+    global _runner
+    if not ENABLED or _runner is not None:
+        return
+    _runner = PeriodicTaskRunner()
+    _runner.start()
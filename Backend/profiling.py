@@ -0,0 +1,355 @@
+# profiling.py
+
+"""
+This file lets an admin profile a single request on the production server, without
+attaching a debugger to a worker.
+
+Add the header "X-Profile: sample" (or the query parameter ?profile=sample) to any
+request, signed in as an admin ("Authorization: Bearer <Firebase ID token>", for a
+user whose role is admin). The response carries an X-Profile-Id header. Modes:
+- sample: a background thread samples the request thread's stack every
+  PROFILE_SAMPLE_INTERVAL_MS (default 5) ms. Cheap enough for production.
+- cprofile: also runs cProfile (deterministic, slower) and keeps its stats.
+
+The heavy admin endpoints (/payroll/approval, /15_day_summary/<location>, ...) only
+queue a job, so a job queued by a profiled request is profiled too. Its profile ID
+is the job ID. A request that is deduplicated onto an existing job does not profile
+that job.
+
+Profiles are stored in PROFILE_DIR (default profiles/ next to this file); the newest
+PROFILE_KEEP (default 50) are kept. Admin-only endpoints:
+    GET /profiles                         the stored profiles, newest first
+    GET /profiles/<id>                    one profile, with its hottest functions
+    GET /profiles/<id>/collapsed          collapsed stacks ("a;b;c 42" per line), for
+                                          flamegraph.pl, speedscope or inferno
+    GET /profiles/<id>/pstats             the cProfile stats (cprofile mode only), for
+                                          pstats or snakeviz
+
+At most PROFILE_MAX_CONCURRENT (default 2) profiles run at once, and sampling stops
+after PROFILE_MAX_SECONDS (default 600).
+"""
+
+import cProfile
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from dotenv import load_dotenv
+from flask import g, jsonify, request, send_file
+from metrics import describe, inc
+from request_auth import admin_uid
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000
+MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "600"))
+MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", "2"))
+KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# How many functions the profile summary lists.
+TOP_FUNCTIONS = 25
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+describe("profiles_recorded_total", "Profiles recorded, by type (request or job) and mode.")
+
+# The profile of the request currently being served, if it is profiled.
+_active_profile = ContextVar("active_profile", default=None)
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+
+
+def _module_name(filename):
+    # site-packages code is named by package (google.cloud.firestore_v1.query),
+    # the app's own modules by file name (payroll_validation).
+    parts = filename.replace("\\", "/").split("/")
+    if "site-packages" in parts:
+        parts = parts[parts.index("site-packages") + 1:]
+    else:
+        parts = parts[-1:]
+    name = ".".join(parts)
+    return name[:-3] if name.endswith(".py") else name
+
+
+class Profile:
+    """Profiles the thread that calls start() until stop() is called."""
+
+    def __init__(self, mode, subject, admin_uid=None, parent_id=None, profile_id=None):
+        self.id = profile_id or uuid.uuid4().hex
+        self.mode = mode
+        self.subject = subject
+        self.admin_uid = admin_uid
+        self.parent_id = parent_id
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = None
+        self._profiler = None
+        self._start = None
+        self.started_at = None
+
+    def start(self):
+        self.started_at = datetime.now().isoformat()
+        self._start = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{self.id[:8]}", daemon=True)
+        self._sampler.start()
+        if self.mode == "cprofile":
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # Another profiler is already active in this thread.
+                self._profiler = None
+
+    def _sample(self):
+        labels = {}
+        deadline = time.monotonic() + MAX_SECONDS
+        while not self._stopped.wait(SAMPLE_INTERVAL_SECONDS) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f"{_module_name(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+                stack.append(label)
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, error=None):
+        """Stops profiling and stores the profile."""
+        try:
+            if self._profiler is not None:
+                self._profiler.disable()
+            self._stopped.set()
+            self._sampler.join()
+            _save(self, round((time.perf_counter() - self._start) * 1000, 1), error)
+        except Exception as e:
+            logger.error(f"Error saving profile {self.id}: {e}")
+        finally:
+            _slots.release()
+
+
+def begin(mode, subject, admin_uid=None, parent_id=None, profile_id=None):
+    """
+    Starts profiling the calling thread.
+
+    Args:
+        mode (str): "sample" or "cprofile".
+        subject (dict): What is profiled, e.g. {"type": "request", "path": "/attendance/macro"}.
+        admin_uid (str, optional): The admin who asked for the profile.
+        parent_id (str, optional): The profile of the request that queued this job.
+        profile_id (str, optional): Defaults to a new ID.
+
+    Returns:
+        Profile: The running profile; call stop() on it. None if too many profiles
+                 are already running.
+    """
+    if not _slots.acquire(blocking=False):
+        logger.warning(f"Not profiling {subject}: {MAX_CONCURRENT} profiles are already running")
+        return None
+    profile = Profile(mode, subject, admin_uid, parent_id, profile_id)
+    profile.start()
+    return profile
+
+
+def summarize(stacks, limit=TOP_FUNCTIONS):
+    """
+    Finds the hottest functions in a set of collapsed stacks.
+
+    Returns:
+        dict: {"self": [...], "inclusive": [...]}, each a list of
+              {"function", "samples", "percent"}, hottest first.
+    """
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    samples = sum(stacks.values()) or 1
+    return {name: [{"function": function, "samples": count, "percent": round(100 * count / samples, 1)}
+                   for function, count in counter.most_common(limit)]
+            for name, counter in (("self", own), ("inclusive", total))}
+
+
+def _path(profile_id, suffix):
+    return os.path.join(PROFILE_DIR, profile_id + suffix)
+
+
+def _save(profile, duration_ms, error):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(_path(profile.id, ".collapsed"), "w", encoding="utf-8") as f:
+        for stack, count in profile.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    if profile._profiler is not None:
+        profile._profiler.dump_stats(_path(profile.id, ".prof"))
+    metadata = {
+        "id": profile.id,
+        "mode": profile.mode,
+        **profile.subject,
+        "admin_uid": profile.admin_uid,
+        "parent_id": profile.parent_id,
+        "started_at": profile.started_at,
+        "duration_ms": duration_ms,
+        "samples": sum(profile.stacks.values()),
+        "sample_interval_ms": SAMPLE_INTERVAL_SECONDS * 1000,
+        "error": str(error) if error else None,
+        "has_pstats": profile._profiler is not None,
+        "top": summarize(profile.stacks)
+    }
+    # The metadata is written last, so a listed profile is always complete.
+    with open(_path(profile.id, ".json"), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, default=str)
+    inc("profiles_recorded_total", {"type": profile.subject.get("type"), "mode": profile.mode})
+    logger.info(f"Saved profile {profile.id} of {profile.subject} ({metadata['samples']} samples)")
+    _prune()
+
+
+def _prune():
+    """Deletes all but the KEEP newest profiles."""
+    stored = sorted((name[:-5] for name in os.listdir(PROFILE_DIR) if name.endswith(".json")),
+                    key=lambda profile_id: os.path.getmtime(_path(profile_id, ".json")), reverse=True)
+    for profile_id in stored[KEEP:]:
+        for suffix in (".json", ".collapsed", ".prof"):
+            if os.path.exists(_path(profile_id, suffix)):
+                os.remove(_path(profile_id, suffix))
+
+
+def get_profile(profile_id):
+    """Returns a stored profile's metadata, or None if there is no such profile."""
+    if not _PROFILE_ID.match(profile_id) or not os.path.exists(_path(profile_id, ".json")):
+        return None
+    with open(_path(profile_id, ".json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def list_profiles():
+    """Returns the stored profiles' metadata (without the function lists), newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        if name.endswith(".json"):
+            profile = get_profile(name[:-5])
+            if profile is not None:
+                profile.pop("top", None)
+                profiles.append(profile)
+    return sorted(profiles, key=lambda profile: profile["started_at"] or "", reverse=True)
+
+
+def requested_mode():
+    """The profiling mode the current request asks for, or None."""
+    value = (request.headers.get("X-Profile") or request.args.get("profile") or "").strip().lower()
+    if value in ("", "0", "false", "off"):
+        return None
+    return "cprofile" if value == "cprofile" else "sample"
+
+
+def job_settings():
+    """
+    Returns the profiling settings to store with a job queued by the current request
+    (as JSON), or None if the request is not profiled.
+    """
+    profile = _active_profile.get()
+    if profile is None:
+        return None
+    return json.dumps({"mode": profile.mode, "admin_uid": profile.admin_uid, "parent_id": profile.id})
+
+
+@contextmanager
+def profile_job(settings, job_id, kind):
+    """Profiles a job under the profile ID job_id if settings (from job_settings()) are given."""
+    profile = None
+    if settings:
+        settings = json.loads(settings)
+        profile = begin(settings["mode"], {"type": "job", "job_id": job_id, "job_kind": kind},
+                        settings.get("admin_uid"), settings.get("parent_id"), job_id)
+    if profile is None:
+        yield
+        return
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        profile.stop(error)
+
+
+def init_app(app):
+    """Profiles requests that ask for it and adds the /profiles routes."""
+
+    @app.before_request
+    def _start_request_profile():
+        mode = requested_mode()
+        if mode is None:
+            return
+        uid = admin_uid()
+        if uid is None:
+            logger.warning(f"Ignoring a profiling request for {request.path}: not signed in as an admin")
+            return
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        profile = begin(mode, {"type": "request", "method": request.method, "route": route, "path": request.path}, uid)
+        if profile is not None:
+            g.profile = profile
+            g.profile_token = _active_profile.set(profile)
+
+    @app.after_request
+    def _add_profile_id(response):
+        profile = g.get("profile")
+        if profile is not None:
+            response.headers["X-Profile-Id"] = profile.id
+        return response
+
+    @app.teardown_request
+    def _finish_request_profile(exc):
+        profile = g.pop("profile", None)
+        if profile is not None:
+            _active_profile.reset(g.pop("profile_token"))
+            profile.stop(exc)
+
+    @app.route('/profiles', methods=['GET'])
+    def list_stored_profiles():
+        """Lists the stored profiles, newest first. Admins only."""
+        if admin_uid() is None:
+            return jsonify({"error": "Admin sign-in required."}), 403
+        try:
+            return jsonify(list_profiles()), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/profiles/<profile_id>', methods=['GET'])
+    def get_stored_profile(profile_id):
+        """Returns a profile with its hottest functions. Admins only."""
+        if admin_uid() is None:
+            return jsonify({"error": "Admin sign-in required."}), 403
+        profile = get_profile(profile_id)
+        if profile is None:
+            return jsonify({"error": "Profile not found."}), 404
+        return jsonify(profile), 200
+
+    @app.route('/profiles/<profile_id>/<export>', methods=['GET'])
+    def download_profile(profile_id, export):
+        """Downloads a profile as collapsed stacks or cProfile stats. Admins only."""
+        if admin_uid() is None:
+            return jsonify({"error": "Admin sign-in required."}), 403
+        suffix, mimetype = {"collapsed": (".collapsed", "text/plain"),
+                            "pstats": (".prof", "application/octet-stream")}.get(export, (None, None))
+        if suffix is None:
+            return jsonify({"error": "Export must be 'collapsed' or 'pstats'."}), 400
+        if get_profile(profile_id) is None or not os.path.exists(_path(profile_id, suffix)):
+            return jsonify({"error": "Profile not found."}), 404
+        return send_file(_path(profile_id, suffix), mimetype=mimetype, as_attachment=True,
+                         download_name=f"profile-{profile_id}{suffix}")
@@ -0,0 +1,180 @@
+# report_sheets.py
+
+"""
+This file writes generated report tabs (daily attendance, 15-day summaries and the
+regenerated log sheets) to Google Sheets.
+
+Every report used to be written with clear(), append_row(header) and
+append_rows(body) on a tab created at a fixed size, which is three or more write
+calls plus automatic resizes. write_report() instead sends one batchUpdate that
+sizes the tab to fit and replaces all of its cells, and it skips the write
+entirely when the rendered report is the same as the last one it wrote.
+
+The hashes of the last writes are kept in memory, and also in the JSON file named
+by REPORT_HASH_FILE when that is set, so they survive restarts.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import gspread
+from dotenv import load_dotenv
+from sheets_scheduler import REPORT, call, cell_data, forget_workbook, open_workbook, status_code
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+HASH_FILE = os.getenv("REPORT_HASH_FILE")
+
+_hashes = None
+_hashes_lock = threading.Lock()
+
+
+def _load_hashes():
+    global _hashes
+    if _hashes is None:
+        _hashes = {}
+        if HASH_FILE and os.path.exists(HASH_FILE):
+            try:
+                with open(HASH_FILE, encoding="utf-8") as f:
+                    _hashes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read report hashes from {HASH_FILE}: {e}")
+    return _hashes
+
+
+def _save_hashes():
+    with _hashes_lock:
+        hashes = _load_hashes()
+        if HASH_FILE:
+            tmp_path = f"{HASH_FILE}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(hashes, f)
+                os.replace(tmp_path, HASH_FILE)
+            except OSError as e:
+                logger.warning(f"Could not save report hashes to {HASH_FILE}: {e}")
+
+
+def _remember(key, digest):
+    with _hashes_lock:
+        _load_hashes()[key] = digest
+    _save_hashes()
+
+
+def forget_report(workbook_name, sheet_name):
+    """
+    Forgets the last write to a tab, so the next write_report() always writes. Call
+    this when anything else changes the tab, such as rows appended to a log sheet.
+    """
+    with _hashes_lock:
+        if _load_hashes().pop(f"{workbook_name}/{sheet_name}", None) is None:
+            return
+    _save_hashes()
+
+
+def _digest(values):
+    return hashlib.sha256(json.dumps(values, default=str).encode("utf-8")).hexdigest()
+
+
+def write_report(workbook_name, sheet_name, header, rows, priority=REPORT, force=False):
+    """
+    Replaces the contents of a report tab with a header and rows, creating the tab
+    if needed, in a single Sheets API call.
+
+    Args:
+        workbook_name (str): The spreadsheet name, e.g. "HOW-15-Day-Summary".
+        sheet_name (str): The worksheet (tab) name.
+        header (list): The first row.
+        rows (list): The report rows.
+        priority (int): sheets_scheduler.INTERACTIVE or sheets_scheduler.REPORT.
+        force (bool): Write even if the content matches the last write.
+
+    Returns:
+        bool: True if the tab was written, False if it was already up to date.
+    """
+    values = [list(header)] + [list(row) for row in rows]
+    key = f"{workbook_name}/{sheet_name}"
+    digest = _digest(values)
+    with _hashes_lock:
+        unchanged = _load_hashes().get(key) == digest
+    if unchanged and not force:
+        logger.info(f"Report '{sheet_name}' in '{workbook_name}' is unchanged; skipping the write.")
+        return False
+
+    grid = {"rowCount": len(values), "columnCount": max(len(row) for row in values)}
+    for attempt in range(2):
+        spreadsheet, sheet_ids = open_workbook(workbook_name, priority)
+        sheet_id = sheet_ids.get(sheet_name)
+        if sheet_id is None:
+            # Choosing the sheet ID ourselves lets the new tab be filled in the same request.
+            sheet_id = random.randrange(1, 2 ** 31 - 1)
+            requests = [{"addSheet": {"properties": {"sheetId": sheet_id, "title": sheet_name, "gridProperties": grid}}}]
+        else:
+            requests = [{"updateSheetProperties": {
+                "properties": {"sheetId": sheet_id, "gridProperties": grid},
+                "fields": "gridProperties(rowCount,columnCount)"
+            }}]
+        # With a whole-sheet range, cells not covered by the rows are cleared too.
+        requests.append({"updateCells": {
+            "range": {"sheetId": sheet_id},
+            "rows": [{"values": [cell_data(v) for v in row]} for row in values],
+            "fields": "userEnteredValue"
+        }})
+
+        try:
+            call(spreadsheet.batch_update, {"requests": requests}, priority=priority)
+            break
+        except gspread.exceptions.APIError as e:
+            # A 400 usually means the cached tab list is out of date; reload it once.
+            forget_workbook(workbook_name)
+            if attempt or status_code(e) != 400:
+                raise
+
+    sheet_ids[sheet_name] = sheet_id
+    _remember(key, digest)
+    logger.info(f"Wrote {len(rows)} rows to report '{sheet_name}' in '{workbook_name}' with one request")
+    return True
+
+
+def ensure_tab(workbook_name, sheet_name, header, size=(250, 10), priority=REPORT):
+    """
+    Creates a tab with a header row if the workbook does not have it yet, in one
+    request. An existing tab is left untouched.
+
+    Returns:
+        bool: True if the tab was created.
+    """
+    for attempt in range(2):
+        spreadsheet, sheet_ids = open_workbook(workbook_name, priority)
+        if sheet_name in sheet_ids:
+            return False
+        sheet_id = random.randrange(1, 2 ** 31 - 1)
+        requests = [
+            {"addSheet": {"properties": {
+                "sheetId": sheet_id,
+                "title": sheet_name,
+                "gridProperties": {"rowCount": size[0], "columnCount": max(size[1], len(header))}
+            }}},
+            {"appendCells": {
+                "sheetId": sheet_id,
+                "rows": [{"values": [cell_data(v) for v in header]}],
+                "fields": "userEnteredValue"
+            }}
+        ]
+        try:
+            call(spreadsheet.batch_update, {"requests": requests}, priority=priority)
+        except gspread.exceptions.APIError as e:
+            # Most likely the tab was created elsewhere since the tab list was cached.
+            forget_workbook(workbook_name)
+            if attempt or status_code(e) != 400:
+                raise
+            continue
+        sheet_ids[sheet_name] = sheet_id
+        logger.info(f"Created tab '{sheet_name}' in '{workbook_name}'")
+        return True
+    return False
@@ -0,0 +1,34 @@
+# request_auth.py
+
+"""
+This file checks who signed a request, for the admin-only endpoints (bulk user
+management, profiling).
+
+The caller sends their Firebase ID token as "Authorization: Bearer <token>". A user
+is an admin when the token's role claim is "admin", or, for accounts created before
+roles were set as custom claims, when their 'users' document says so.
+
+Usage:
+    if admin_uid() is None:
+        return jsonify({"error": "Admin sign-in required."}), 403
+"""
+
+from firebase_admin import auth
+from flask import request
+from firebase_config import db
+
+
+def admin_uid():
+    """Returns the UID of the admin who signed the current request, or None."""
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    try:
+        claims = auth.verify_id_token(header[len("Bearer "):])
+    except Exception:
+        return None
+    if claims.get("role") == "admin":
+        return claims["uid"]
+    # Accounts created before roles were set as custom claims only have the role in their profile.
+    user = db.collection("users").document(claims["uid"]).get()
+    return claims["uid"] if user.exists and (user.to_dict() or {}).get("role") == "admin" else None
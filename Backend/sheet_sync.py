@@ -0,0 +1,297 @@
+# sheet_sync.py
+
+"""
+This file regenerates a location's log sheet in the background after shift edits.
+
+A Senior PM correcting hours usually makes several edits in a row, and each one
+used to rewrite the whole log sheet before responding. Now each edit calls
+request_sync(location), which returns straight away. The sheet is regenerated once
+the location has had no new edits for SHEET_SYNC_DEBOUNCE_SECONDS (default 5), or
+at the latest SHEET_SYNC_MAX_DELAY_SECONDS (default 30) after the first pending
+edit, so a steady stream of edits still reaches the sheet.
+
+Every request gets a version number. Callers can poll sync_status(location), or
+call wait_for_sync(location, version, timeout) to block until that version (or a
+later one) is in the sheet. The versions are kept in the job database
+(SHEET_SYNC_DB_PATH, by default JOB_DB_PATH), shared by all worker processes, so
+a status poll is answered correctly by any of them. A regeneration queries
+Firestore (not the in-memory shift ledger, which can lag an edit), and each edit
+is written to Firestore before its sync is requested, so the regeneration covers
+every edit requested before it started, in any process.
+
+The rewrite runs in the Sheets scheduler as a task for the location's log workbook
+(sheets_scheduler.run_for_workbook), so it does not race the clock-in/out rows
+being appended to the same workbook.
+
+A regeneration is traced as a continuation of the latest edit's trace, with links
+to the other edits it covers.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from metrics import register_queue_depth
+from tracing import current_context, span
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE_SECONDS = float(os.getenv("SHEET_SYNC_DEBOUNCE_SECONDS", "5"))
+MAX_DELAY_SECONDS = float(os.getenv("SHEET_SYNC_MAX_DELAY_SECONDS", "30"))
+# A failed regeneration is tried again this many times before it is reported as an error.
+MAX_RETRIES = 2
+# At most this many pending edits are linked from a regeneration's trace span.
+MAX_TRACE_LINKS = 50
+DB_PATH = os.getenv("SHEET_SYNC_DB_PATH", os.getenv(
+    "JOB_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3")))
+# How often wait() checks the shared state for syncs finished by other processes.
+WAIT_POLL_SECONDS = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_sync (
+    location TEXT PRIMARY KEY,
+    requested INTEGER NOT NULL DEFAULT 0,
+    synced INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    last_synced TEXT
+);
+"""
+
+
+class SyncVersions:
+    """The requested and synced versions of each location, shared by all processes."""
+
+    def __init__(self, db_path=DB_PATH):
+        self._db_path = db_path
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so each thread has its own.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def request(self, location):
+        """Records an edit and returns its version."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO sheet_sync (location) VALUES (?)", (location,))
+            conn.execute("UPDATE sheet_sync SET requested = requested + 1 WHERE location = ?", (location,))
+            version = conn.execute("SELECT requested FROM sheet_sync WHERE location = ?", (location,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return version
+
+    def get(self, location):
+        row = self._connection().execute("SELECT * FROM sheet_sync WHERE location = ?", (location,)).fetchone()
+        return dict(row) if row else {"requested": 0, "synced": 0, "error": None, "failures": 0, "last_synced": None}
+
+    def finished(self, location, version, error=None):
+        """Records the outcome of a regeneration that started at the given version."""
+        if error:
+            self._connection().execute(
+                "UPDATE sheet_sync SET error = ?, failures = failures + 1 WHERE location = ?", (error, location))
+        else:
+            self._connection().execute(
+                "UPDATE sheet_sync SET synced = MAX(synced, ?), error = NULL, last_synced = ? WHERE location = ?",
+                (version, datetime.now().isoformat(), location))
+
+
+class _LocationState:
+    def __init__(self):
+        self.requested = 0        # Count of this process's edits.
+        self.synced = 0           # How many of them are known to be in the sheet.
+        self.first_pending = None # When the oldest unsynced edit was requested.
+        self.timer = None
+        self.running = False
+        self.retries = 0
+        self.traces = []          # Trace contexts of the edits not yet synced.
+
+
+class SheetSync:
+    """Debounces and coalesces sheet regeneration requests per location."""
+
+    def __init__(self, regenerate, debounce=DEBOUNCE_SECONDS, max_delay=MAX_DELAY_SECONDS, versions=None):
+        self._regenerate = regenerate
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._condition = threading.Condition()
+        # This process's debounce timers; the versions callers see are in self._versions.
+        self._states = {}
+        self._versions = versions or SyncVersions()
+
+    def pending_count(self):
+        with self._condition:
+            return sum(1 for state in self._states.values() if state.synced < state.requested)
+
+    def _schedule(self, location, state):
+        # Caller holds self._condition.
+        if state.timer:
+            state.timer.cancel()
+        deadline = state.first_pending + self._max_delay
+        delay = max(0, min(self._debounce, deadline - time.monotonic()))
+        state.timer = threading.Timer(delay, self._run, args=(location,))
+        state.timer.daemon = True
+        state.timer.start()
+
+    def request(self, location):
+        """
+        Records that a location's sheet is out of date and schedules a regeneration.
+
+        Returns:
+            dict: {"status": "pending", "version": int}
+        """
+        version = self._versions.request(location)
+        with self._condition:
+            state = self._states.setdefault(location, _LocationState())
+            state.requested += 1
+            state.retries = 0
+            trace = current_context()
+            if trace is not None:
+                state.traces = (state.traces + [trace])[-MAX_TRACE_LINKS:]
+            if state.first_pending is None:
+                state.first_pending = time.monotonic()
+            # A regeneration that is already running reschedules itself when it finishes.
+            if not state.running:
+                self._schedule(location, state)
+        return {"status": "pending", "version": version}
+
+    def _run(self, location):
+        with self._condition:
+            state = self._states[location]
+            state.timer = None
+            if state.running:
+                return
+            state.running = True
+            version = state.requested
+            state.first_pending = None
+            traces, state.traces = state.traces, []
+
+        error = None
+        # Every edit requested so far, in any process, is in Firestore and so in this run.
+        shared_version = self._versions.get(location)["requested"]
+        with span("sheet_sync regenerate", parent=traces[-1] if traces else None, links=traces[:-1],
+                  attributes={"location": location, "version": version}) as sync_span:
+            try:
+                result = self._regenerate(location)
+                if isinstance(result, dict) and "error" in result:
+                    error = result["error"]
+            except Exception as e:
+                error = str(e)
+            if error and sync_span is not None:
+                sync_span.error = error
+        try:
+            self._versions.finished(location, shared_version, error)
+        except sqlite3.Error as e:
+            logger.error(f"Error recording the sheet sync state for {location}: {e}")
+
+        with self._condition:
+            state.running = False
+            if error:
+                logger.error(f"Background sheet sync for {location} failed: {error}")
+                state.retries += 1
+                state.traces = (traces + state.traces)[-MAX_TRACE_LINKS:]
+            else:
+                state.synced = max(state.synced, version)
+                state.retries = 0
+            # Edits made while this run was in progress need another run, and so does a
+            # failed run, up to MAX_RETRIES times in a row.
+            retry = error and state.retries <= MAX_RETRIES
+            if state.requested > version or retry:
+                if state.first_pending is None:
+                    state.first_pending = time.monotonic()
+                self._schedule(location, state)
+            self._condition.notify_all()
+
+    def status(self, location):
+        """
+        Returns the sync status of a location's sheet.
+
+        Returns:
+            dict: "status" is "synced", "pending" or "error", plus the requested and
+            synced versions, the last error and when the sheet was last synced.
+        """
+        shared = self._versions.get(location)
+        with self._condition:
+            state = self._states.get(location)
+            retrying = state is not None and (state.running or state.timer is not None)
+        if shared["synced"] >= shared["requested"]:
+            status = "synced"
+        elif shared["error"] and not retrying:
+            status = "error"
+        else:
+            status = "pending"
+        return {
+            "location": location,
+            "status": status,
+            "requested_version": shared["requested"],
+            "synced_version": shared["synced"],
+            "error": shared["error"],
+            "last_synced": shared["last_synced"]
+        }
+
+    def wait(self, location, version=None, timeout=30):
+        """
+        Blocks until the given version (default: the latest request) is in the sheet,
+        the sync fails, or the timeout passes. Returns the status afterwards.
+        """
+        start = self._versions.get(location)
+        target = version or start["requested"]
+        deadline = time.monotonic() + timeout
+        while True:
+            # Another process may run the sync, so the shared state is polled.
+            current = self._versions.get(location)
+            remaining = deadline - time.monotonic()
+            if current["synced"] >= target or current["failures"] > start["failures"] or remaining <= 0:
+                break
+            with self._condition:
+                self._condition.wait(min(WAIT_POLL_SECONDS, remaining))
+        return self.status(location)
+
+
+def _regenerate_in_order(location):
+    """Regenerates a location's log sheet through the Sheets scheduler, in order with its appends."""
+    # Imported here because edit_work_hours and logging_google_sheets use this module.
+    import sheets_scheduler
+    from edit_work_hours import _regenerate_log_sheet
+    from workbook_routing import log_workbook
+    return sheets_scheduler.run_for_workbook(log_workbook(location), _regenerate_log_sheet, location)
+
+
+_sheet_sync = None
+_sheet_sync_lock = threading.Lock()
+
+
+def get_sheet_sync():
+    global _sheet_sync
+    with _sheet_sync_lock:
+        if _sheet_sync is None:
+            _sheet_sync = SheetSync(_regenerate_in_order)
+            register_queue_depth("sheet_sync", _sheet_sync.pending_count)
+        return _sheet_sync
+
+
+def request_sync(location):
+    return get_sheet_sync().request(location)
+
+
+def sync_status(location):
+    return get_sheet_sync().status(location)
+
+
+def wait_for_sync(location, version=None, timeout=30):
+    return get_sheet_sync().wait(location, version, timeout)
@@ -0,0 +1,579 @@
+# sheets_scheduler.py
+
+"""
+This file routes every Google Sheets write through one quota-aware scheduler.
+
+All of the sheet writers (clock-in/out logging, log sheet regeneration, attendance
+reports, 15-day summaries and old-sheet cleanup) share the same Google project
+quota. Instead of each of them calling the API whenever it likes, they go through
+this scheduler, which:
+
+1. Spends requests from a token bucket sized to the Sheets quota
+   (SHEETS_REQUESTS_PER_MINUTE, default 60 - the per-user write quota). The bucket
+   lives in one process, so the rate is split between SHEETS_SCHEDULER_PROCESSES
+   processes (default WEB_CONCURRENCY, gunicorn's worker count, or 1).
+2. Serves INTERACTIVE work (a staff member waiting at the kiosk) before REPORT work.
+3. Merges all queued row appends for the same workbook into a single batchUpdate.
+4. Retries rate-limited (429) and temporary server errors with jittered exponential
+   back-off instead of printing the error and losing the row. If a workbook's rows
+   still cannot be written, the workbook is held back for a while and its rows keep
+   their place in the queue, so they are still written before rows queued later.
+
+Queued row appends are also saved in SQLite (SHEETS_QUEUE_DB_PATH, by default the
+job database) until they are written, so a restart or deploy does not lose rows
+that callers were told were queued. Rows left behind by a process that stopped
+are picked up by another process (or the restarted one) once the old owner has
+sent no heartbeat for STALE_SECONDS. Work queued with submit() is only held in
+memory: those are report regenerations, which can simply be run again.
+
+run_for_workbook() queues a function that rewrites part of one workbook (e.g. a log
+sheet regeneration) and waits for it. It is ordered with that workbook's appends:
+it does not run while they are being written, and appends queued while it runs wait
+for it.
+
+Queued work is traced: a task runs in a span whose parent is the span that queued
+it, and a merged append batch also links to the spans of the other rows in it.
+
+Usage:
+    sheets_scheduler.append_rows("House of Wisdom Log", sheet_name, rows, header=HEADER)
+    sheets_scheduler.call(worksheet.append_rows, rows, priority=sheets_scheduler.REPORT)
+    sheets_scheduler.submit(cleanup_old_sheets, "House of Wisdom Log", priority=sheets_scheduler.REPORT)
+    sheets_scheduler.run_for_workbook("House of Wisdom Log", regenerate, location)
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+import gspread
+from dotenv import load_dotenv
+from metrics import inc, register_queue_depth
+from tracing import current_context, span
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+REPORT = 1
+
+# The quota is per Google project, but the token bucket below is per process: each
+# gunicorn worker gets an equal share so that together they stay within it.
+REQUESTS_PER_MINUTE = float(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "60"))
+PROCESSES = max(1, int(os.getenv("SHEETS_SCHEDULER_PROCESSES", os.getenv("WEB_CONCURRENCY", "1"))))
+# Worker threads; each workbook is written by at most one of them at a time.
+WORKERS = int(os.getenv("SHEETS_SCHEDULER_WORKERS", "4"))
+# How many requests may be sent back to back after a quiet period.
+BURST = int(os.getenv("SHEETS_REQUEST_BURST", "10"))
+MAX_ATTEMPTS = 6
+BASE_RETRY_DELAY_SECONDS = 1.0
+MAX_RETRY_DELAY_SECONDS = 64.0
+# How long a workbook's rows are held back after every retry failed.
+HOLD_SECONDS = MAX_RETRY_DELAY_SECONDS
+# Status codes worth retrying: rate limiting and temporary server errors.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+QUEUE_DB_PATH = os.getenv("SHEETS_QUEUE_DB_PATH", os.getenv(
+    "JOB_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3")))
+HEARTBEAT_SECONDS = 15
+# Saved appends whose owner has not sent a heartbeat for this long are taken over.
+STALE_SECONDS = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_appends (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    heartbeat_at REAL NOT NULL,
+    priority INTEGER NOT NULL,
+    workbook_name TEXT NOT NULL,
+    sheet_name TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    header TEXT,
+    size TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sheet_appends_owner ON sheet_appends (owner, heartbeat_at);
+"""
+
+
+class TokenBucket:
+    """
+    A token bucket where lower-priority callers wait while any higher-priority
+    caller is waiting for a token.
+    """
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+        self._waiting = {}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=REPORT):
+        """Blocks until a request may be sent at the given priority."""
+        with self._condition:
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    self._refill()
+                    outranked = any(count for p, count in self._waiting.items() if p < priority)
+                    if self._tokens >= 1 and not outranked:
+                        self._tokens -= 1
+                        return
+                    self._condition.wait(max((1 - self._tokens) / self.rate, 0.05))
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+
+_bucket = TokenBucket(REQUESTS_PER_MINUTE / 60 / PROCESSES, max(1, BURST // PROCESSES))
+
+
+def status_code(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) or getattr(error, "code", None)
+
+
+def call(fn, *args, priority=REPORT, **kwargs):
+    """
+    Runs one Sheets API call under the quota, retrying rate-limited and temporary
+    server errors with jittered exponential back-off.
+
+    Args:
+        fn (callable): The gspread method to call, e.g. worksheet.append_rows.
+        priority (int): INTERACTIVE or REPORT.
+
+    Returns:
+        The return value of fn.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        _bucket.acquire(priority)
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = status_code(e)
+            if status not in RETRYABLE_STATUS_CODES or attempt == MAX_ATTEMPTS - 1:
+                raise
+            # "Full jitter": spreads retries out so throttled callers do not all return at once.
+            delay = random.uniform(0, min(MAX_RETRY_DELAY_SECONDS, BASE_RETRY_DELAY_SECONDS * 2 ** attempt))
+            inc("sheets_retries_total", {"status": status})
+            logger.warning(f"Sheets API returned {status}; retrying in {delay:.1f}s (attempt {attempt + 1}/{MAX_ATTEMPTS})")
+            time.sleep(delay)
+
+
+# {workbook_name: (spreadsheet, {sheet title: sheet id})}, shared by everything that writes
+# through batchUpdate so repeat writes skip the lookups and agree on which tabs exist.
+_workbooks = {}
+_workbooks_lock = threading.Lock()
+
+
+def open_workbook(workbook_name, priority=REPORT):
+    """
+    Returns (spreadsheet, {sheet title: sheet id}) for a workbook, opening it on first use.
+    The returned dict is shared; add newly created tabs to it.
+    """
+    with _workbooks_lock:
+        if workbook_name in _workbooks:
+            return _workbooks[workbook_name]
+    # Imported here because logging_google_sheets itself uses this module.
+    import logging_google_sheets
+    client = logging_google_sheets.get_gspread_client()
+    if not client:
+        raise Exception("Could not connect to Google Sheets.")
+    spreadsheet = call(client.open, workbook_name, priority=priority)
+    sheet_ids = {ws.title: ws.id for ws in call(spreadsheet.worksheets, priority=priority)}
+    with _workbooks_lock:
+        return _workbooks.setdefault(workbook_name, (spreadsheet, sheet_ids))
+
+
+def forget_workbook(workbook_name):
+    """Drops a cached workbook, e.g. after a tab was deleted or renamed."""
+    with _workbooks_lock:
+        _workbooks.pop(workbook_name, None)
+
+
+def cell_data(value):
+    """Converts a Python value to a Sheets CellData entry."""
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+class _AppendTask:
+    def __init__(self, workbook_name, sheet_name, rows, header, size, saved_id=None):
+        self.workbook_name = workbook_name
+        self.sheet_name = sheet_name
+        self.rows = rows
+        self.header = header
+        self.size = size
+        self.rejected = False
+        self.trace = current_context()
+        self.saved_id = saved_id
+        self.priority = None
+        self.sequence = None  # Queue order, kept when the task is queued again.
+
+
+class _CallTask:
+    def __init__(self, fn, args, kwargs, workbook_name=None, future=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        # Set for run_for_workbook(): the workbook it writes, and where its result goes.
+        self.workbook_name = workbook_name
+        self.future = future
+        self.trace = current_context()
+        self.priority = None
+        self.sequence = None
+
+
+class AppendStore:
+    """Saves queued appends in SQLite until they have been written to the sheet."""
+
+    def __init__(self, db_path=QUEUE_DB_PATH):
+        self._db_path = db_path
+        self._local = threading.local()
+        # Identifies this process's rows; a restarted process gets a new owner ID.
+        self.owner = uuid.uuid4().hex
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so each thread has its own.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def save(self, priority, task):
+        """Saves a queued append and returns its ID."""
+        cursor = self._connection().execute(
+            "INSERT INTO sheet_appends (owner, heartbeat_at, priority, workbook_name, sheet_name, rows, header, size) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.owner, time.time(), priority, task.workbook_name, task.sheet_name,
+             json.dumps(task.rows, default=str), json.dumps(task.header, default=str), json.dumps(list(task.size))))
+        return cursor.lastrowid
+
+    def remove(self, tasks):
+        """Forgets appends that were written (or given up on)."""
+        ids = [task.saved_id for task in tasks if task.saved_id is not None]
+        if ids:
+            self._connection().execute(
+                f"DELETE FROM sheet_appends WHERE id IN ({', '.join('?' * len(ids))})", ids)
+
+    def heartbeat(self):
+        self._connection().execute("UPDATE sheet_appends SET heartbeat_at = ? WHERE owner = ?",
+                                   (time.time(), self.owner))
+
+    def claim_orphans(self):
+        """Takes over the appends of processes that stopped. Returns [(priority, task)]."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT * FROM sheet_appends WHERE owner != ? AND heartbeat_at < ? ORDER BY id",
+                                (self.owner, time.time() - STALE_SECONDS)).fetchall()
+            if rows:
+                conn.execute(f"UPDATE sheet_appends SET owner = ?, heartbeat_at = ? "
+                             f"WHERE id IN ({', '.join('?' * len(rows))})",
+                             (self.owner, time.time(), *[row["id"] for row in rows]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [(row["priority"], _AppendTask(row["workbook_name"], row["sheet_name"], json.loads(row["rows"]),
+                                              json.loads(row["header"]), tuple(json.loads(row["size"])), row["id"]))
+                for row in rows]
+
+
+class SheetsScheduler:
+    """
+    Runs queued Sheets work on background threads, highest priority first.
+    Queued appends for the same workbook are sent together as one batchUpdate, and
+    different workbooks are written in parallel (still sharing the one quota).
+    """
+
+    def __init__(self, workers=WORKERS, store=None):
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        # Workbooks a worker is currently appending to, so their rows stay in order.
+        self._busy = set()
+        # {workbook_name: time.monotonic() until which its appends are held back}
+        self._held = {}
+        self._store = store or AppendStore()
+        self._recover()
+        self._workers = [threading.Thread(target=self._run, name=f"sheets-scheduler-{i}", daemon=True)
+                         for i in range(max(1, workers))]
+        for worker in self._workers:
+            worker.start()
+        threading.Thread(target=self._heartbeat, name="sheets-scheduler-heartbeat", daemon=True).start()
+        register_queue_depth("sheets_scheduler", self.depth)
+
+    def _recover(self):
+        """Queues the saved appends of processes that stopped before writing them."""
+        try:
+            orphans = self._store.claim_orphans()
+        except sqlite3.Error as e:
+            logger.error(f"Error recovering saved Sheets appends: {e}")
+            return
+        for priority, task in orphans:
+            self._put(priority, task)
+        if orphans:
+            logger.warning(f"Recovered {sum(len(task.rows) for _, task in orphans)} queued rows "
+                           f"that a stopped process had not written")
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            try:
+                self._store.heartbeat()
+            except sqlite3.Error as e:
+                logger.error(f"Error updating the Sheets append heartbeat: {e}")
+            self._recover()
+
+    def depth(self):
+        with self._condition:
+            return len(self._queue)
+
+    def _put(self, priority, task, sequence=None):
+        """Queues a task. A task queued again passes its old sequence to keep its place."""
+        with self._condition:
+            task.priority = priority
+            task.sequence = next(self._sequence) if sequence is None else sequence
+            heapq.heappush(self._queue, (priority, task.sequence, task))
+            self._condition.notify()
+
+    def append_rows(self, workbook_name, sheet_name, rows, header=None, size=(250, 10), priority=INTERACTIVE):
+        """
+        Queues rows to be appended to a worksheet, creating the worksheet (with header)
+        if it does not exist yet. Returns immediately.
+
+        Args:
+            workbook_name (str): The spreadsheet name, e.g. "House of Wisdom Log".
+            sheet_name (str): The worksheet (tab) name.
+            rows (list): The rows to append.
+            header (list, optional): The first row of a newly created worksheet.
+            size (tuple): (rows, cols) of a newly created worksheet.
+            priority (int): INTERACTIVE or REPORT.
+        """
+        task = _AppendTask(workbook_name, sheet_name, [list(r) for r in rows], header, size)
+        try:
+            task.saved_id = self._store.save(priority, task)
+        except sqlite3.Error as e:
+            # Still queue the rows; they are only at risk if the process stops too.
+            logger.error(f"Error saving queued rows for '{workbook_name}': {e}")
+        self._put(priority, task)
+
+    def submit(self, fn, *args, priority=REPORT, **kwargs):
+        """Queues a function that makes its own Sheets calls (through call()). Returns immediately."""
+        self._put(priority, _CallTask(fn, args, kwargs))
+
+    def run_for_workbook(self, workbook_name, fn, *args, priority=REPORT, **kwargs):
+        """
+        Queues a function that writes to one workbook, and waits for it. It runs
+        while no appends to that workbook are being written, in queue order with them.
+
+        Returns:
+            The return value of fn; an exception it raises is raised here.
+        """
+        future = Future()
+        self._put(priority, _CallTask(fn, args, kwargs, workbook_name, future))
+        return future.result()
+
+    def _pop_ready(self):
+        """Pops the highest-priority task whose workbook is not being written to or held back, if any."""
+        now = time.monotonic()
+        for workbook_name in [name for name, until in self._held.items() if until <= now]:
+            del self._held[workbook_name]
+        skipped = []
+        found = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            workbook_name = entry[2].workbook_name
+            if workbook_name is not None and (workbook_name in self._busy or workbook_name in self._held):
+                skipped.append(entry)
+                continue
+            found = entry
+            break
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return found
+
+    def _take_batch(self):
+        """Pops the next task, plus every other queued append for the same workbook."""
+        with self._condition:
+            entry = self._pop_ready()
+            while entry is None:
+                # Wake up when the next held-back workbook is released.
+                timeout = max(0.05, min(self._held.values()) - time.monotonic()) if self._held else None
+                self._condition.wait(timeout)
+                entry = self._pop_ready()
+            priority, _, task = entry
+            if not isinstance(task, _AppendTask):
+                if task.workbook_name is not None:
+                    self._busy.add(task.workbook_name)
+                return priority, [task]
+            self._busy.add(task.workbook_name)
+            batch = [task]
+            remaining = []
+            for entry in self._queue:
+                other = entry[2]
+                if isinstance(other, _AppendTask) and other.workbook_name == task.workbook_name:
+                    batch.append(other)
+                else:
+                    remaining.append(entry)
+            heapq.heapify(remaining)
+            self._queue = remaining
+            # The heap is only partly ordered; rows are written in the order they were queued.
+            batch.sort(key=lambda t: t.sequence)
+            return priority, batch
+
+    def _run(self):
+        while True:
+            priority, batch = self._take_batch()
+            try:
+                self._traced_execute(priority, batch)
+            finally:
+                if batch[0].workbook_name is not None:
+                    with self._condition:
+                        self._busy.discard(batch[0].workbook_name)
+                        self._condition.notify_all()
+
+    def _traced_execute(self, priority, batch):
+        task = batch[0]
+        if isinstance(task, _CallTask):
+            name = f"sheets task {getattr(task.fn, '__name__', 'call')}"
+            attributes = {"priority": priority, "workbook": task.workbook_name}
+        else:
+            name = "sheets append batch"
+            attributes = {"priority": priority, "workbook": task.workbook_name, "tasks": len(batch),
+                          "rows": sum(len(t.rows) for t in batch)}
+        with span(name, parent=task.trace, kind="consumer", attributes=attributes,
+                  links=[t.trace for t in batch[1:]]):
+            self._execute(priority, batch)
+
+    def _execute(self, priority, batch):
+        try:
+            if isinstance(batch[0], _CallTask):
+                task = batch[0]
+                result = task.fn(*task.args, **task.kwargs)
+                if task.future is not None:
+                    task.future.set_result(result)
+            else:
+                self._flush_appends(batch, priority)
+        except Exception as e:
+            if isinstance(batch[0], _CallTask) and batch[0].future is not None:
+                # The caller is waiting and handles the error.
+                batch[0].future.set_exception(e)
+                return
+            logger.error(f"Error running queued Sheets work: {e}")
+            if isinstance(batch[0], _AppendTask):
+                # Forget the cached sheet IDs in case a tab was deleted or renamed.
+                forget_workbook(batch[0].workbook_name)
+                if isinstance(e, gspread.exceptions.APIError) and status_code(e) not in RETRYABLE_STATUS_CODES:
+                    # A stale tab list is the usual cause, so retry once with a fresh one.
+                    retry = [task for task in batch if not task.rejected]
+                    for task in retry:
+                        task.rejected = True
+                        self._put(task.priority, task, task.sequence)
+                    dropped = sum(len(t.rows) for t in batch if t not in retry)
+                    self._forget([t for t in batch if t not in retry])
+                    if dropped:
+                        logger.warning(f"Dropping {dropped} rows for '{batch[0].workbook_name}': request was rejected")
+                    return
+                # Still rate limited or offline after every retry: keep the rows and try again
+                # later. The workbook is held back instead of sleeping here, so this worker
+                # stays free for other workbooks, and the rows keep their place in the queue.
+                with self._condition:
+                    self._held[batch[0].workbook_name] = time.monotonic() + HOLD_SECONDS
+                for task in batch:
+                    self._put(task.priority, task, task.sequence)
+
+    def _forget(self, tasks):
+        try:
+            self._store.remove(tasks)
+        except sqlite3.Error as e:
+            # The rows would be appended again after a restart.
+            logger.error(f"Error removing written rows from the saved Sheets queue: {e}")
+
+    def _flush_appends(self, tasks, priority):
+        """Sends every queued append for one workbook in a single batchUpdate."""
+        spreadsheet, sheet_ids = open_workbook(tasks[0].workbook_name, priority)
+
+        rows_by_sheet = {}
+        new_sheets = {}
+        for task in tasks:
+            rows = rows_by_sheet.setdefault(task.sheet_name, [])
+            if task.sheet_name not in sheet_ids and task.sheet_name not in new_sheets:
+                new_sheets[task.sheet_name] = task
+                if task.header:
+                    rows.append(list(task.header))
+            rows.extend(task.rows)
+
+        requests = []
+        for sheet_name, task in new_sheets.items():
+            # Choosing the sheet ID ourselves lets the new tab be filled in the same request.
+            sheet_id = random.randrange(1, 2 ** 31 - 1)
+            sheet_ids[sheet_name] = sheet_id
+            requests.append({"addSheet": {"properties": {
+                "sheetId": sheet_id,
+                "title": sheet_name,
+                "gridProperties": {"rowCount": task.size[0], "columnCount": task.size[1]}
+            }}})
+        for sheet_name, rows in rows_by_sheet.items():
+            requests.append({"appendCells": {
+                "sheetId": sheet_ids[sheet_name],
+                "rows": [{"values": [cell_data(v) for v in row]} for row in rows],
+                "fields": "userEnteredValue"
+            }})
+
+        try:
+            call(spreadsheet.batch_update, {"requests": requests}, priority=priority)
+        except Exception:
+            for sheet_name in new_sheets:
+                sheet_ids.pop(sheet_name, None)
+            raise
+        self._forget(tasks)
+        logger.info(f"Appended {sum(len(t.rows) for t in tasks)} rows to {len(rows_by_sheet)} sheets in "
+                    f"'{tasks[0].workbook_name}' with one request")
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Returns the process-wide scheduler, starting its worker on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = SheetsScheduler()
+        return _scheduler
+
+
+def append_rows(workbook_name, sheet_name, rows, header=None, size=(250, 10), priority=INTERACTIVE):
+    get_scheduler().append_rows(workbook_name, sheet_name, rows, header, size, priority)
+
+
+def submit(fn, *args, priority=REPORT, **kwargs):
+    get_scheduler().submit(fn, *args, priority=priority, **kwargs)
+
+
+def run_for_workbook(workbook_name, fn, *args, priority=REPORT, **kwargs):
+    return get_scheduler().run_for_workbook(workbook_name, fn, *args, priority=priority, **kwargs)
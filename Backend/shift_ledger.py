@@ -0,0 +1,289 @@
+# shift_ledger.py
+
+"""
+This file keeps each location's shifts for the open pay period in memory.
+
+The 15-day summary, payroll CSVs and the Senior PM's shift look-ups all need the
+current period's shifts, and each of them used to query Firestore again every time.
+A LocationLedger loads a location's period once through an on_snapshot listener on
+the range query
+
+    shifts where location == L and timestamp >= period start and timestamp <= period end
+
+and Firestore then pushes every added, edited or deleted shift to it, so reads are
+answered from memory. The summary and payroll reports take each user's running
+hours straight from it. A single shift look-up spans every location, so it only
+uses ledgers that are already running and otherwise queries Firestore.
+
+Events are stored column by column in compact arrays (user, event type and role are
+interned to small integers), with indexes by user and by (user, day) that are kept
+sorted by timestamp.
+
+When the ledger is not ready (the listener has not delivered its first snapshot
+within LEDGER_READY_TIMEOUT_SECONDS, or it failed), the functions here return None
+and the callers fall back to querying Firestore. The listener counts as failed when
+applying a snapshot raised, when it has stopped streaming (Firestore closes it after
+an error it cannot recover from, without calling the callback), or when its latest
+snapshot is older than LEDGER_MAX_STALENESS_SECONDS (default 600). Firestore only
+calls the callback when something changed, so a quiet location's ledger is also
+reloaded that often; a failed ledger is replaced on the next read. Set
+SHIFT_LEDGER_ENABLED=false to turn the ledger off.
+"""
+
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import insort
+from datetime import datetime
+from dotenv import load_dotenv
+from firebase_config import db
+from logging_google_sheets import get_pay_period_dates, sum_shift_durations
+from metrics import inc
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("SHIFT_LEDGER_ENABLED", "true").lower() != "false"
+READY_TIMEOUT_SECONDS = float(os.getenv("LEDGER_READY_TIMEOUT_SECONDS", "5"))
+MAX_STALENESS_SECONDS = float(os.getenv("LEDGER_MAX_STALENESS_SECONDS", "600"))
+
+
+class _Interner:
+    """Maps repeated strings (user IDs, event types, roles) to small integers."""
+
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def intern(self, value):
+        index = self._index.get(value)
+        if index is None:
+            index = self._index[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+    def lookup(self, value):
+        return self._index.get(value)
+
+
+class LocationLedger:
+    """The shifts of one location in one pay period, kept current by a Firestore listener."""
+
+    def __init__(self, location, start_date, end_date):
+        self.location = location
+        self.start_date = start_date
+        self.end_date = end_date
+        self._lock = threading.RLock()
+        self._ready = threading.Event()
+        self.failed = False
+        # The read time of the latest snapshot, and when it arrived (time.monotonic()).
+        self.read_time = None
+        self._received_at = None
+
+        self._users = _Interner()
+        self._events = _Interner()
+        self._roles = _Interner()
+        # One slot per shift document; freed slots are reused.
+        self._ids = []
+        self._timestamps = []
+        self._user_col = array('l')
+        self._event_col = array('h')
+        self._role_col = array('h')
+        self._slot_by_id = {}
+        self._free = []
+        # Slots sorted by timestamp, per user and per (user, day).
+        self._by_user = {}
+        self._by_user_day = {}
+
+        start_iso = datetime.combine(start_date, datetime.min.time()).isoformat()
+        end_iso = datetime.combine(end_date, datetime.max.time()).isoformat()
+        query = (db.collection('shifts').where('location', '==', location)
+                 .where('timestamp', '>=', start_iso).where('timestamp', '<=', end_iso))
+        self._watch = query.on_snapshot(self._on_snapshot)
+
+    def _sort_key(self, slot):
+        return self._timestamps[slot]
+
+    def _add(self, doc_id, data):
+        timestamp = data.get('timestamp')
+        if not isinstance(timestamp, str):
+            return
+        slot = self._free.pop() if self._free else len(self._ids)
+        user = self._users.intern(data.get('user_id'))
+        values = (doc_id, timestamp, user, self._events.intern(data.get('event')), self._roles.intern(data.get('role')))
+        if slot == len(self._ids):
+            self._ids.append(values[0])
+            self._timestamps.append(values[1])
+            self._user_col.append(values[2])
+            self._event_col.append(values[3])
+            self._role_col.append(values[4])
+        else:
+            self._ids[slot], self._timestamps[slot] = values[0], values[1]
+            self._user_col[slot], self._event_col[slot], self._role_col[slot] = values[2], values[3], values[4]
+        self._slot_by_id[doc_id] = slot
+        insort(self._by_user.setdefault(user, []), slot, key=self._sort_key)
+        insort(self._by_user_day.setdefault((user, timestamp[:10]), []), slot, key=self._sort_key)
+
+    def _remove(self, doc_id):
+        slot = self._slot_by_id.pop(doc_id, None)
+        if slot is None:
+            return
+        user = self._user_col[slot]
+        day_key = (user, self._timestamps[slot][:10])
+        self._by_user[user].remove(slot)
+        self._by_user_day[day_key].remove(slot)
+        if not self._by_user_day[day_key]:
+            del self._by_user_day[day_key]
+        self._ids[slot] = None
+        self._timestamps[slot] = ""
+        self._free.append(slot)
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        try:
+            with self._lock:
+                for change in changes:
+                    doc_id = change.document.id
+                    self._remove(doc_id)
+                    if change.type.name != 'REMOVED':
+                        self._add(doc_id, change.document.to_dict() or {})
+                self.read_time = read_time
+                self._received_at = time.monotonic()
+            inc("shift_ledger_changes_total", {"location": self.location}, len(changes))
+        except Exception as e:
+            logger.error(f"Error applying shift changes to the {self.location} ledger: {e}")
+            self.failed = True
+        self._ready.set()
+
+    def healthy(self):
+        """
+        Returns False if the ledger can no longer be trusted: a snapshot failed to apply,
+        the listener stopped, or no snapshot has arrived for MAX_STALENESS_SECONDS.
+        """
+        if self.failed:
+            return False
+        # Firestore's Watch closes itself on an unrecoverable stream error without
+        # telling the callback, so its state is checked directly.
+        if getattr(self._watch, "_closed", False) or not getattr(self._watch, "is_active", True):
+            logger.warning(f"The {self.location} ledger listener has stopped.")
+            self.failed = True
+            return False
+        if self._received_at is not None and time.monotonic() - self._received_at > MAX_STALENESS_SECONDS:
+            logger.info(f"The {self.location} ledger's latest snapshot (read at {self.read_time}) is stale.")
+            self.failed = True
+            return False
+        return True
+
+    def wait_ready(self, timeout=READY_TIMEOUT_SECONDS):
+        return self._ready.wait(timeout) and self.healthy()
+
+    def close(self):
+        try:
+            self._watch.unsubscribe()
+        except Exception as e:
+            logger.error(f"Error closing the {self.location} ledger listener: {e}")
+
+    def _shift(self, slot):
+        return {
+            "event": self._events.values[self._event_col[slot]],
+            "user_id": self._users.values[self._user_col[slot]],
+            "timestamp": self._timestamps[slot],
+            "location": self.location,
+            "role": self._roles.values[self._role_col[slot]]
+        }
+
+    def shifts_for_user(self, user_id, day=None):
+        """Returns a user's (doc_id, shift) pairs, for the whole period or one day ("YYYY-MM-DD")."""
+        with self._lock:
+            user = self._users.lookup(user_id)
+            if user is None:
+                return []
+            slots = self._by_user.get(user, []) if day is None else self._by_user_day.get((user, day), [])
+            return [(self._ids[slot], self._shift(slot)) for slot in slots]
+
+    def hours_worked(self, user_id):
+        """Returns a user's hours worked at this location so far in the period."""
+        shifts = [shift for _, shift in self.shifts_for_user(user_id)]
+        return sum_shift_durations(shifts, self.start_date, self.end_date).total_seconds() / 3600
+
+    def hours_by_user(self):
+        """Returns {user_id: hours worked so far in the period} for everyone with shifts here."""
+        with self._lock:
+            users = [self._users.values[user] for user, slots in self._by_user.items() if slots]
+        return {user_id: self.hours_worked(user_id) for user_id in users}
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+# One lock per location, so a slow listener start only holds up its own location.
+_location_locks = {}
+
+
+def _current_ledger(location, start_date):
+    """Returns the location's healthy ledger for the period starting start_date, or None."""
+    with _ledgers_lock:
+        ledger = _ledgers.get(location)
+        if ledger is None or (ledger.start_date == start_date and ledger.healthy()):
+            return ledger
+        # A new pay period has started, or the listener broke or went stale: start over.
+        del _ledgers[location]
+    ledger.close()
+    return None
+
+
+def get_ledger(location, day=None):
+    """
+    Returns the ready ledger for the location's pay period containing day (default
+    today), or None if that is not the open period or the ledger is not available.
+    Starts the location's listener if it is not running.
+    """
+    if not ENABLED:
+        return None
+    start_date, end_date = get_pay_period_dates()
+    if day is not None and not (start_date <= day <= end_date):
+        return None
+
+    with _ledgers_lock:
+        location_lock = _location_locks.setdefault(location, threading.Lock())
+    with location_lock:
+        ledger = _current_ledger(location, start_date)
+        if ledger is None:
+            try:
+                ledger = LocationLedger(location, start_date, end_date)
+            except Exception as e:
+                logger.warning(f"Could not start the shift ledger for {location}: {e}")
+                return None
+            with _ledgers_lock:
+                _ledgers[location] = ledger
+
+    if not ledger.wait_ready():
+        inc("shift_ledger_misses_total", {"location": location})
+        return None
+    return ledger
+
+
+def running_ledger(location, day):
+    """
+    Returns the location's ledger if its listener is already running and ready for
+    the pay period containing day, without starting it or waiting for it.
+    """
+    if not ENABLED:
+        return None
+    start_date, end_date = get_pay_period_dates()
+    if not (start_date <= day <= end_date):
+        return None
+    ledger = _current_ledger(location, start_date)
+    return ledger if ledger is not None and ledger.wait_ready(0) else None
+
+
+def period_hours_by_user(location, start_date, end_date):
+    """
+    Returns {user_id: hours worked} at the location in a pay period, computed from
+    the ledger without a Firestore call, or None if the period is not the open one.
+    """
+    ledger = get_ledger(location, start_date)
+    if ledger is None or ledger.end_date != end_date:
+        return None
+    return ledger.hours_by_user()
@@ -0,0 +1,111 @@
+# single_flight.py
+
+"""
+This file lets identical read requests that arrive at the same time share one
+backend fetch.
+
+At the start of a session every tablet at a site asks for the same roster,
+attendance count, student list and online sessions within a few milliseconds,
+and each request used to run the same Firestore queries. A view decorated with
+@coalesce runs once per key at a time: the first request (the "leader") runs it,
+and identical requests that arrive before it finishes wait for it and get a copy
+of its response. Nothing is cached; a request that arrives after the leader has
+finished runs the view again.
+
+The key is the route rule, its URL arguments and the sorted query parameters, so
+"/online_sessions?status=active&admin_uid=x" and "?admin_uid=x&status=active"
+share a fetch, while different locations do not.
+
+Metrics:
+- single_flight_requests_total{route, role="leader"|"coalesced"}
+- the queue_depth gauge with queue="single_flight": fetches running right now
+"""
+
+import threading
+from functools import wraps
+from flask import Response, current_app, request
+from metrics import describe, inc, register_queue_depth
+
+# How long a follower waits for the leader before running the view itself.
+WAIT_TIMEOUT_SECONDS = 30
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time and shares its result with concurrent callers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key, fn):
+        """
+        Returns fn(), or the result of the identical call already running.
+
+        Returns:
+            tuple: (result, True if it was shared with another caller's call)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if not call.done.wait(WAIT_TIMEOUT_SECONDS):
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+
+_flights = SingleFlight()
+register_queue_depth("single_flight", _flights.in_flight)
+describe("single_flight_requests_total",
+         "Requests to coalesced routes, by whether they ran the fetch (leader) or shared one (coalesced).")
+
+
+def request_key():
+    """The normalized route and arguments of the current request."""
+    view_args = tuple(sorted((request.view_args or {}).items()))
+    query = tuple(sorted(request.args.items(multi=True)))
+    return request.method, request.url_rule.rule, view_args, query
+
+
+def _freeze(rv):
+    # Each request needs its own Response object (after_request hooks add headers to
+    # it), so only the body, status and headers are shared.
+    response = current_app.make_response(rv)
+    return response.get_data(), response.status_code, list(response.headers.items())
+
+
+def coalesce(view):
+    """Decorates a read-only Flask view so concurrent identical requests share one run."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        (body, status, headers), shared = _flights.do(request_key(), lambda: _freeze(view(*args, **kwargs)))
+        inc("single_flight_requests_total", {"route": request.url_rule.rule,
+                                             "role": "coalesced" if shared else "leader"})
+        return Response(body, status=status, headers=headers)
+
+    return wrapper
@@ -0,0 +1,199 @@
+# static_frontend.py
+
+"""
+This file lets the backend serve the compiled React app (frontend/build) itself, so
+the kiosk tablets load the app and the API from one origin without a separate
+static server.
+
+Set SERVE_FRONTEND=true to turn it on. FRONTEND_BUILD_DIR points at the build
+(default ../frontend/build). After `npm run build`, precompress the files once:
+
+    python static_frontend.py
+
+This writes a .gz (and, if the brotli package is installed, a .br) copy next to
+every compressible file, and the server sends the smallest variant the browser
+accepts, without compressing anything per request.
+
+Caching:
+- Files with a content hash in their name (static/js/main.1a2b3c4d.js) never change,
+  so they are sent with "Cache-Control: public, max-age=31536000, immutable".
+- Everything else (index.html, manifest.json, ...) is sent with "no-cache", so
+  browsers revalidate it. Every file has an ETag, and a matching If-None-Match gets
+  an empty 304 response.
+
+Any other GET path without a file extension (e.g. /tutordashboard) gets index.html,
+so React Router can handle it. The API routes are matched before this fallback.
+"""
+
+import argparse
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import sys
+from dotenv import load_dotenv
+from flask import jsonify, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("SERVE_FRONTEND", "false").lower() == "true"
+BUILD_DIR = os.getenv("FRONTEND_BUILD_DIR",
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "frontend", "build"))
+
+COMPRESSIBLE = ('.html', '.js', '.css', '.json', '.map', '.svg', '.txt', '.ico', '.xml', '.webmanifest')
+# Smaller files are not worth the Content-Encoding overhead.
+MIN_COMPRESS_BYTES = 1024
+# Encodings in order of preference, with the suffix of their precompressed file.
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# Create React App names built assets like main.1a2b3c4d.js or 453.9f8e7d6c.chunk.css.
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.(chunk\.)?[a-z0-9]+$")
+IMMUTABLE_MAX_AGE = 31536000
+
+
+def precompress(build_dir=BUILD_DIR):
+    """
+    Writes .br and .gz copies of the compressible files in a build. Copies that are
+    up to date or not smaller than the original are skipped.
+
+    Returns:
+        dict: How many files were compressed per encoding.
+    """
+    counts = {"br": 0, "gzip": 0}
+    for root, _, files in os.walk(build_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if not name.endswith(COMPRESSIBLE) or os.path.getsize(path) < MIN_COMPRESS_BYTES:
+                continue
+            with open(path, "rb") as f:
+                content = f.read()
+            for encoding, suffix in ENCODINGS:
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                if encoding == "br":
+                    if brotli is None:
+                        continue
+                    compressed = brotli.compress(content, quality=11)
+                else:
+                    # mtime=0 keeps the output identical between builds.
+                    compressed = gzip.compress(content, compresslevel=9, mtime=0)
+                if len(compressed) >= len(content):
+                    continue
+                with open(target, "wb") as f:
+                    f.write(compressed)
+                counts[encoding] += 1
+    return counts
+
+
+class StaticBuild:
+    """The files of one build, with their ETags and precompressed variants."""
+
+    def __init__(self, build_dir):
+        self.build_dir = os.path.abspath(build_dir)
+        self.files = {}
+        suffixes = tuple(suffix for _, suffix in ENCODINGS)
+        for root, _, names in os.walk(self.build_dir):
+            for name in names:
+                if name.endswith(suffixes):
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, self.build_dir).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()[:20]
+                variants = {encoding: path + suffix for encoding, suffix in ENCODINGS
+                            if os.path.exists(path + suffix) and os.path.getmtime(path + suffix) >= os.path.getmtime(path)}
+                self.files[relative] = {
+                    "path": path,
+                    "etag": digest,
+                    "variants": variants,
+                    "mimetype": mimetypes.guess_type(name)[0] or "application/octet-stream",
+                    "immutable": bool(HASHED_NAME.search(name))
+                }
+
+    def serve(self, relative):
+        """Returns the response for a file of the build, or None if it is not in it."""
+        entry = self.files.get(relative)
+        if entry is None:
+            return None
+        path, encoding = entry["path"], None
+        for candidate, _ in ENCODINGS:
+            if candidate in entry["variants"] and candidate in request.accept_encodings:
+                path, encoding = entry["variants"][candidate], candidate
+                break
+        # Each variant has its own ETag, as its bytes differ.
+        etag = f"{entry['etag']}-{encoding}" if encoding else entry["etag"]
+        response = send_file(path, mimetype=entry["mimetype"], etag=etag, conditional=True,
+                             max_age=IMMUTABLE_MAX_AGE if entry["immutable"] else 0)
+        # send_file names the .br/.gz file here; the browser should only see the original.
+        response.headers.pop("Content-Disposition", None)
+        if encoding and response.status_code != 304:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        if entry["immutable"]:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+
+_build = None
+
+
+def index():
+    """Returns index.html, or None when static serving is off."""
+    return _build.serve("index.html") if _build else None
+
+
+def init_app(app, build_dir=BUILD_DIR):
+    """
+    Serves the React build from the app when SERVE_FRONTEND is true. Werkzeug
+    matches fixed routes before '/<path:path>', so API routes always win.
+    """
+    global _build
+    if not ENABLED:
+        return
+    if not os.path.isfile(os.path.join(build_dir, "index.html")):
+        logger.warning(f"SERVE_FRONTEND is on, but there is no build in {os.path.abspath(build_dir)}. Run `npm run build` first.")
+        return
+    _build = StaticBuild(build_dir)
+    precompressed = sum(1 for entry in _build.files.values() if entry["variants"])
+    logger.info(f"Serving the frontend build from {_build.build_dir} ({len(_build.files)} files, {precompressed} precompressed)")
+
+    @app.route('/<path:path>', methods=['GET'])
+    def frontend_file(path):
+        response = _build.serve(path)
+        if response is not None:
+            return response
+        # Paths with an extension are missing files, not app pages.
+        if "." in path.rsplit("/", 1)[-1]:
+            return jsonify({"error": "Not found."}), 404
+        return _build.serve("index.html")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompress the React build for static serving.")
+    parser.add_argument("build_dir", nargs="?", default=BUILD_DIR, help="the build directory (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.build_dir):
+        print(f"No build directory at {args.build_dir}. Run `npm run build` in frontend/ first.")
+        return 1
+    if brotli is None:
+        print("The brotli package is not installed; writing gzip files only.")
+    counts = precompress(args.build_dir)
+    print(f"Compressed {counts['br']} files with brotli and {counts['gzip']} with gzip.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
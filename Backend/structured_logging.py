@@ -0,0 +1,207 @@
+# structured_logging.py
+
+"""
+This file sets up the backend's logging: JSON lines written by a background thread,
+so a slow log sink never blocks a request thread.
+
+Modules log through the standard library (logger = logging.getLogger(__name__)).
+setup() puts a QueueHandler on the root logger. Emitting a record only formats
+its message and puts it on an in-memory queue; a QueueListener thread writes the
+queue to stdout (or LOG_FILE). When the queue is full (LOG_QUEUE_SIZE records)
+new records are dropped and counted instead of waiting.
+
+Every line is one JSON object:
+
+    {"ts": "2026-10-19T14:02:11.532+00:00", "level": "INFO", "logger": "payroll_validation",
+     "message": "...", "request_id": "4f1c...", "route": "/payroll/approval",
+     "elapsed_ms": 182.4, "thread": "Thread-7", "trace_id": "0af7...", "span_id": "b7ad..."}
+
+request_id comes from the X-Request-ID header, or a new one is made; it is sent
+back in the response's X-Request-ID header. elapsed_ms is the time since the
+request started. Outside requests, route is "background" and request_id is null.
+trace_id and span_id identify the current span (see tracing.py), so log lines can
+be matched to traces.
+Extra fields can be added with logger.info("...", extra={"fields": {...}}).
+
+Sampling: LOG_SAMPLING keeps only a fraction of the records below WARNING from
+chatty loggers, e.g. LOG_SAMPLING="logging_google_sheets.rows=0.1,sheet_sync=0.5".
+The most specific configured logger name applies. Warnings and errors are never
+sampled out.
+
+LOG_LEVEL sets the minimum level (default INFO).
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from flask import g, request
+from metrics import current_route, describe, inc
+from tracing import current_context
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE")
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+DEFAULT_SAMPLING = "logging_google_sheets.rows=0.1"
+
+describe("log_records_dropped_total", "Log records not written, by logger and reason (sampled or queue_full).")
+
+# {"id": request ID, "start": perf_counter at request start} for the current request.
+_request_context = ContextVar("log_request_context", default=None)
+_listener = None
+
+
+def parse_sampling(spec):
+    """Parses "name=rate,name=rate" into {name: rate}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the request context. Runs in the thread that logs."""
+
+    def filter(self, record):
+        context = _request_context.get()
+        record.request_id = context["id"] if context else None
+        record.route = current_route.get()
+        record.elapsed_ms = round((time.perf_counter() - context["start"]) * 1000, 1) if context else None
+        span = current_context()
+        record.trace_id = span.trace_id if span else None
+        record.span_id = span.span_id if span else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the sub-WARNING records of the configured loggers."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._cache = {}
+
+    def _rate(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate, candidate = 1.0, name
+            while candidate:
+                if candidate in self.rates:
+                    rate = self.rates[candidate]
+                    break
+                candidate = candidate.rpartition(".")[0]
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        inc("log_records_dropped_total", {"logger": record.name, "reason": "sampled"})
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records instead of blocking when the queue is full."""
+
+    def prepare(self, record):
+        # Resolve the message and traceback here, in the logging thread, but keep
+        # them apart so the formatter can put the traceback in its own field.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            inc("log_records_dropped_total", {"logger": record.name, "reason": "queue_full"})
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON line."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "route": getattr(record, "route", None),
+            "elapsed_ms": getattr(record, "elapsed_ms", None),
+            "thread": record.threadName,
+            "trace_id": getattr(record, "trace_id", None),
+            "span_id": getattr(record, "span_id", None)
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def setup():
+    """Routes all logging through the queue and the background writer. Safe to call twice."""
+    global _listener
+    if _listener is not None:
+        return
+    records = queue.Queue(maxsize=QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(parse_sampling(os.getenv("LOG_SAMPLING", DEFAULT_SAMPLING))))
+
+    sink = logging.FileHandler(LOG_FILE) if LOG_FILE else logging.StreamHandler(sys.stdout)
+    sink.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(records, sink, respect_handler_level=True)
+    _listener.start()
+    # Write what is still queued when the process exits.
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+
+def init_app(app):
+    """Gives every request an ID and a start time for its log lines."""
+
+    @app.before_request
+    def _start_request_log_context():
+        request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        g.log_context_token = _request_context.set({"id": request_id[:64], "start": time.perf_counter()})
+
+    @app.after_request
+    def _add_request_id(response):
+        context = _request_context.get()
+        if context:
+            response.headers["X-Request-ID"] = context["id"]
+        return response
+
+    @app.teardown_request
+    def _reset_request_log_context(exc):
+        token = g.pop("log_context_token", None)
+        if token is not None:
+            _request_context.reset(token)
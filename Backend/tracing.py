@@ -0,0 +1,306 @@
+# tracing.py
+
+"""
+This file records trace spans, so a slow request can be broken down afterwards
+into the Firestore, Google Sheets, SMTP and Identity Toolkit calls it made.
+
+Every Flask request gets a server span. Every call wrapped in metrics.track_call()
+gets a client span nested under it, so the instrumented Firestore client, the
+gspread session, the SMTP sends and the Identity Toolkit sign-in are all covered.
+Work handed to background threads carries the trace along:
+- jobs (job_queue) run in a span whose parent is the request that queued them;
+- Sheets scheduler batches and clock journal flushes link to every request whose
+  rows or events they contain;
+- background sheet syncs continue the trace of the latest edit;
+- functions wrapped with bind() run under the span they were bound in.
+
+An incoming W3C traceparent header continues the caller's trace, and each
+response carries an X-Trace-Id header to find its spans.
+
+Spans are written by a background thread to TRACE_FILE (default traces.jsonl
+next to this file) as OTLP/JSON lines: each line is an ExportTraceServiceRequest
+with up to EXPORT_BATCH spans, the format the OpenTelemetry collector's file
+exporter writes and its otlpjsonfile receiver reads. The file is rotated at
+TRACE_FILE_MAX_BYTES. TRACE_SAMPLE_RATE (0-1) samples whole traces; set
+TRACING_ENABLED=false to turn tracing off.
+"""
+
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ENABLED = os.getenv("TRACING_ENABLED", "true").lower() != "false"
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = 3
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "house-of-wisdom-backend")
+QUEUE_SIZE = 10000
+EXPORT_BATCH = 100
+
+_KINDS = {"internal": "SPAN_KIND_INTERNAL", "server": "SPAN_KIND_SERVER", "client": "SPAN_KIND_CLIENT",
+          "consumer": "SPAN_KIND_CONSUMER"}
+
+# The span that new spans in this thread or request are nested under.
+_current_span = ContextVar("current_span", default=None)
+
+
+class SpanContext:
+    """The identity of a span, as carried across threads and processes."""
+
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id, span_id, sampled=True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(header):
+    """Parses a W3C traceparent header. Returns a SpanContext, or None if it is invalid."""
+    try:
+        version, trace_id, span_id, flags = (header or "").strip().split("-")
+        int(trace_id, 16), int(span_id, 16)
+        if len(trace_id) != 32 or len(span_id) != 16 or trace_id == "0" * 32:
+            return None
+        return SpanContext(trace_id.lower(), span_id.lower(), bool(int(flags, 16) & 1))
+    except (ValueError, AttributeError):
+        return None
+
+
+class Span:
+    def __init__(self, name, parent=None, kind="internal", attributes=None, links=None):
+        self.name = name
+        self.kind = kind
+        self.parent_id = parent.span_id if parent else None
+        if parent:
+            self.context = SpanContext(parent.trace_id, secrets.token_hex(8), parent.sampled)
+        else:
+            self.context = SpanContext(secrets.token_hex(16), secrets.token_hex(8), random.random() < SAMPLE_RATE)
+        self.attributes = dict(attributes or {})
+        self.links = [link for link in (links or []) if link is not None]
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if error is not None:
+                self.error = f"{type(error).__name__}: {error}"
+            if self.context.sampled:
+                _exporter().export(self)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": _KINDS.get(self.kind, "SPAN_KIND_INTERNAL"),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            "status": {"code": "STATUS_CODE_ERROR", "message": self.error} if self.error else {"code": "STATUS_CODE_UNSET"}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.links:
+            span["links"] = [{"traceId": link.trace_id, "spanId": link.span_id} for link in self.links]
+        return span
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class _FileExporter:
+    """Writes finished spans to the trace file on a background thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        threading.Thread(target=self._run, name="trace-exporter", daemon=True).start()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _rotate(self):
+        for i in range(TRACE_FILE_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _write(self, spans):
+        line = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [span.to_otlp() for span in spans]}]
+        }]}, default=str)
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= TRACE_FILE_MAX_BYTES:
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def _run(self):
+        while True:
+            spans = [self._queue.get()]
+            while len(spans) < EXPORT_BATCH:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(spans)
+            except Exception:
+                # Tracing must never take the app down; the spans are lost.
+                self.dropped += len(spans)
+
+
+_exporter_instance = None
+_exporter_lock = threading.Lock()
+
+
+def _exporter():
+    global _exporter_instance
+    if _exporter_instance is None:
+        with _exporter_lock:
+            if _exporter_instance is None:
+                _exporter_instance = _FileExporter(TRACE_FILE)
+    return _exporter_instance
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_context():
+    """The SpanContext of the current span, or None outside any span."""
+    span = _current_span.get()
+    return span.context if span else None
+
+
+def current_traceparent():
+    context = current_context()
+    return context.traceparent() if context else None
+
+
+def set_attribute(key, value):
+    """Sets an attribute on the current span, if there is one."""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attribute(key, value)
+
+
+def start_span(name, parent=None, kind="internal", attributes=None, links=None, activate=True):
+    """
+    Starts a span and, if activate is true, makes it current. Returns (span, token);
+    pass both to finish_span. parent defaults to the current span.
+    """
+    span = Span(name, parent or current_context(), kind, attributes, links)
+    return span, (_current_span.set(span) if activate else None)
+
+
+def finish_span(span, token, error=None):
+    span.end(error)
+    if token is not None:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name, parent=None, kind="internal", attributes=None, links=None, activate=True):
+    """
+    Records the enclosed block as a span.
+
+    Args:
+        name (str): The span name, e.g. "firestore read".
+        parent (SpanContext, optional): Defaults to the current span; a new trace
+            is started when there is neither.
+        kind (str): "internal", "server", "client" or "consumer".
+        attributes (dict, optional): Span attributes.
+        links (list, optional): SpanContexts of related spans in other traces.
+        activate (bool): Whether the span is the current span inside the block. A
+            generator that yields inside the block must pass False: the caller's code
+            runs between the items, and would otherwise run under this span.
+    """
+    if not ENABLED:
+        yield None
+        return
+    current, token = start_span(name, parent, kind, attributes, links, activate)
+    error = None
+    try:
+        yield current
+    except GeneratorExit:
+        # The caller stopped iterating a generator that had this span open.
+        raise
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_span(current, token, error)
+
+
+def bind(fn):
+    """Returns fn wrapped to run under the current span, e.g. in a thread pool."""
+    parent = _current_span.get()
+
+    def run(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+
+    return run
+
+
+def init_app(app):
+    """Wraps every request in a server span."""
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_span():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.trace_span, g.trace_token = start_span(
+            f"{request.method} {route}", parent=parse_traceparent(request.headers.get("traceparent")), kind="server",
+            attributes={"http.method": request.method, "http.route": route, "http.target": request.path})
+
+    @app.after_request
+    def _add_trace_header(response):
+        current = g.get("trace_span")
+        if current is not None:
+            current.set_attribute("http.status_code", response.status_code)
+            response.headers["X-Trace-Id"] = current.context.trace_id
+        return response
+
+    @app.teardown_request
+    def _finish_request_span(exc):
+        current = g.pop("trace_span", None)
+        token = g.pop("trace_token", None)
+        if current is not None:
+            finish_span(current, token, exc)
@@ -0,0 +1,278 @@
+# user_import.py
+
+"""
+This file imports many users at once, e.g. a new term's students, from CSV or JSON.
+
+/register creates one Auth user, sets its role claim and writes its profile, one
+request per person. An import instead sends up to CHUNK_SIZE users to Firebase Auth
+in one import_users call (passwords hashed locally with PBKDF2-SHA256, the role set
+as a custom claim) and writes their profiles in one Firestore batch.
+
+Each user's UID is derived from their email address, so importing the same file
+again cannot create duplicates. A row whose email already has an account is
+reported as an error unless the import is run with update_existing, which then
+overwrites that account's name, password, role claim and profile. The rows that were
+imported are recorded in the 'user_imports' collection under the import's ID (by
+default a hash of the file), so re-running an import after a failure skips them and
+retries only the rest.
+
+Results are produced row by row so the endpoint can stream them as they happen.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from firebase_admin import auth, firestore
+from firebase_config import db
+from metrics import inc
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# import_users takes at most 1000 users and a Firestore batch at most 500 writes.
+CHUNK_SIZE = 500
+# get_users takes at most 100 identifiers.
+LOOKUP_LIMIT = 100
+HASH_ROUNDS = int(os.getenv("USER_IMPORT_HASH_ROUNDS", "100000"))
+HASH_WORKERS = 4
+VALID_ROLES = ('student', 'tutor', 'seniorProjectManager', 'juniorProjectManager', 'admin')
+IMPORTS_COLLECTION = 'user_imports'
+
+
+def build_user_profile(email, first_name, last_name, role, data):
+    """
+    Builds a 'users' document following the User Account DB Schema.
+
+    Args:
+        email (str): The user's email address.
+        first_name (str): First name.
+        last_name (str): Last name.
+        role (str): The user's role.
+        data (dict): The submitted fields, for the role-specific ones.
+
+    Returns:
+        dict: The profile document.
+    """
+    user_data = {
+        'email': email,
+        'firstName': first_name,
+        'lastName': last_name,
+        'role': role,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+
+    if role == 'student':
+        user_data.update({
+            'gradeLevel': data.get('gradeLevel', None),
+            'parentContact': data.get('parentContact', ''),
+            'tutoringLocation': data.get('tutoringLocation') or [],
+            'topics': []
+        })
+    elif role == 'tutor':
+        user_data.update({
+            'googleMeetsLink': '',
+            'tutoringLocation': data.get('tutoringLocation') or [],
+            'topics': []
+        })
+    elif role in ['seniorProjectManager', 'juniorProjectManager']:
+        user_data.update({
+            'tutoringLocation': data.get('tutoringLocation') or [],
+        })
+    return user_data
+
+
+def parse_rows(content, fmt):
+    """
+    Parses an import file.
+
+    Args:
+        content (str): The file contents.
+        fmt (str): "csv" (with a header row) or "json" (a list of objects).
+
+    Returns:
+        list: One dict per user. In CSV, tutoringLocation may list several
+        locations separated by ";".
+    """
+    if fmt == 'json':
+        rows = json.loads(content)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("JSON imports must be a list of objects")
+        return rows
+    if fmt == 'csv':
+        rows = []
+        for row in csv.DictReader(io.StringIO(content)):
+            row = {key.strip(): (value or '').strip() for key, value in row.items() if key}
+            if row.get('tutoringLocation'):
+                row['tutoringLocation'] = [loc.strip() for loc in row['tutoringLocation'].split(';') if loc.strip()]
+            rows.append(row)
+        return rows
+    raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def user_uid(email):
+    """The UID an imported user gets: stable for the same (case-insensitive) email."""
+    return "imp_" + hashlib.sha256(email.strip().lower().encode("utf-8")).hexdigest()[:24]
+
+
+def import_id_for(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:20]
+
+
+def _validate(row, seen_emails):
+    email = (row.get('email') or '').strip()
+    if not all([email, row.get('firstName'), row.get('lastName')]):
+        return "email, firstName, and lastName are required"
+    if (row.get('role') or 'student') not in VALID_ROLES:
+        return f"role must be one of {', '.join(VALID_ROLES)}"
+    if email.lower() in seen_emails:
+        return f"email {email} appears more than once in the file"
+    return None
+
+
+def _hash_password(password):
+    salt = secrets.token_bytes(16)
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, HASH_ROUNDS), salt
+
+
+def _existing_uids(emails):
+    """Returns {email (lowercase): uid} for the emails that already have an Auth account."""
+    existing = {}
+    for start in range(0, len(emails), LOOKUP_LIMIT):
+        identifiers = [auth.EmailIdentifier(email) for email in emails[start:start + LOOKUP_LIMIT]]
+        for user in auth.get_users(identifiers).users:
+            existing[user.email.lower()] = user.uid
+    return existing
+
+
+def _import_chunk(chunk, update_existing=False):
+    """
+    Imports one chunk of (row number, row) pairs into Auth and Firestore.
+
+    Args:
+        chunk (list): (row number, row) pairs.
+        update_existing (bool): Whether rows whose email already has an account
+            overwrite it (only accounts created by an import can be updated).
+
+    Yields:
+        dict: One result per row.
+    """
+    emails = [row['email'].strip() for _, row in chunk]
+    existing = _existing_uids(emails)
+
+    records, pending = [], []
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+        # hashlib releases the GIL while hashing, so passwords are hashed in parallel.
+        hashes = list(pool.map(lambda item: _hash_password(item[1]['password']) if item[1].get('password') else None,
+                               chunk))
+    for (row_number, row), password in zip(chunk, hashes):
+        email = row['email'].strip()
+        uid = user_uid(email)
+        # import_users does not check that emails are unique, so this has to.
+        if existing.get(email.lower(), uid) != uid:
+            yield {"row": row_number, "email": email, "status": "error", "error": "Email address already in use"}
+            continue
+        if email.lower() in existing and not update_existing:
+            yield {"row": row_number, "email": email, "status": "error",
+                   "error": "An account with this email already exists; import with update_existing to update it"}
+            continue
+        role = row.get('role') or 'student'
+        records.append(auth.UserImportRecord(
+            uid=uid,
+            email=email,
+            display_name=f"{row['firstName']} {row['lastName']}",
+            custom_claims={'role': role},
+            password_hash=password[0] if password else None,
+            password_salt=password[1] if password else None
+        ))
+        pending.append((row_number, row, uid, role))
+
+    if not records:
+        return
+    result = auth.import_users(records, hash_alg=auth.UserImportHash.pbkdf2_sha256(rounds=HASH_ROUNDS))
+    failed = {error.index: error.reason for error in result.errors}
+
+    batch = db.batch()
+    imported = []
+    for index, (row_number, row, uid, role) in enumerate(pending):
+        if index in failed:
+            yield {"row": row_number, "email": row['email'].strip(), "status": "error", "error": failed[index]}
+            continue
+        profile = build_user_profile(row['email'].strip(), row['firstName'], row['lastName'], role, row)
+        batch.set(db.collection('users').document(uid), profile, merge=True)
+        imported.append((row_number, row, uid, role))
+    if imported:
+        batch.commit()
+    inc("users_imported_total", {"status": "imported"}, len(imported))
+    inc("users_imported_total", {"status": "failed"}, len(failed))
+    for row_number, row, uid, role in imported:
+        yield {"row": row_number, "email": row['email'].strip(), "status": "imported", "uid": uid, "role": role}
+
+
+def import_users(rows, import_id, update_existing=False):
+    """
+    Imports users chunk by chunk, skipping rows that an earlier run of the same
+    import already imported.
+
+    Args:
+        rows (list): User dicts as returned by parse_rows.
+        import_id (str): Identifies this import for resuming.
+        update_existing (bool): Whether existing imported accounts are overwritten;
+            otherwise their rows are reported as errors.
+
+    Yields:
+        dict: A result for every row ("imported", "skipped" or "error"), then a
+        summary line with "done": True.
+    """
+    state_ref = db.collection(IMPORTS_COLLECTION).document(import_id)
+    state = state_ref.get()
+    done_rows = set(state.to_dict().get('imported_rows', [])) if state.exists else set()
+    counts = {"imported": 0, "skipped": 0, "error": 0}
+
+    valid, seen_emails = [], set()
+    for row_number, row in enumerate(rows, start=1):
+        error = _validate(row, seen_emails)
+        if error:
+            counts["error"] += 1
+            yield {"row": row_number, "email": row.get('email'), "status": "error", "error": error}
+            continue
+        seen_emails.add(row['email'].strip().lower())
+        if row_number in done_rows:
+            counts["skipped"] += 1
+            yield {"row": row_number, "email": row['email'].strip(), "status": "skipped", "uid": user_uid(row['email'])}
+            continue
+        valid.append((row_number, row))
+
+    for start in range(0, len(valid), CHUNK_SIZE):
+        chunk = valid[start:start + CHUNK_SIZE]
+        imported, reported = [], set()
+        try:
+            for result in _import_chunk(chunk, update_existing):
+                counts[result["status"]] += 1
+                reported.add(result["row"])
+                if result["status"] == "imported":
+                    imported.append(result["row"])
+                yield result
+        except Exception as e:
+            # The rows without a result yet are not recorded as imported, so running
+            # the import again retries them.
+            logger.error(f"Error importing users (import {import_id}, rows {chunk[0][0]}-{chunk[-1][0]}): {e}")
+            for row_number, row in chunk:
+                if row_number not in reported:
+                    counts["error"] += 1
+                    yield {"row": row_number, "email": row['email'].strip(), "status": "error", "error": str(e)}
+        if imported:
+            state_ref.set({
+                'imported_rows': firestore.ArrayUnion(imported),
+                'rows': len(rows),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+
+    yield {"done": True, "import_id": import_id, "rows": len(rows), **counts}
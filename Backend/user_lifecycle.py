@@ -0,0 +1,274 @@
+# user_lifecycle.py
+
+"""
+This file deactivates, deletes or reassigns many users at once, e.g. at the end
+of a term.
+
+DELETE /user/<uid> removes one Auth account and one profile and leaves the user's
+shifts, attendance marks and online-session tutor entries behind. delete_users()
+removes Auth accounts with auth.delete_users (up to AUTH_BATCH_LIMIT per call) and
+then cascades over the dependent documents:
+
+- 'shifts' with the user's user_id are deleted;
+- the user's entry in each 'attendance' document's student map is removed;
+- the user is removed from the 'tutors' list of every online session;
+- the 'users' profile is deleted.
+
+The cascade runs CASCADE_WORKERS users in parallel, in chunks of CASCADE_CHUNK
+writes. Every Firestore and Auth request first takes a token from a bucket
+refilled at LIFECYCLE_REQUESTS_PER_SECOND, so a large operation cannot starve the
+interactive routes. Shifts that were already moved to cold storage are not touched.
+
+All operations take a progress callback (fraction, message) and return a summary
+with per-user errors; they run as background jobs (see app.py).
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+from firebase_admin import auth, firestore
+from firebase_config import db
+import analytics_mirror
+import delta_sync
+from metrics import inc
+from sheet_sync import request_sync
+from sheets_scheduler import TokenBucket
+from tracing import bind
+
+load_dotenv()
+
+AUTH_BATCH_LIMIT = 1000
+CASCADE_CHUNK = 200
+CASCADE_WORKERS = int(os.getenv("LIFECYCLE_WORKERS", "4"))
+REQUESTS_PER_SECOND = float(os.getenv("LIFECYCLE_REQUESTS_PER_SECOND", "10"))
+
+_bucket = TokenBucket(REQUESTS_PER_SECOND, max(1, int(REQUESTS_PER_SECOND)))
+
+
+def _throttle():
+    _bucket.acquire()
+
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+class _Progress:
+    """Counts finished steps across worker threads and reports them."""
+
+    def __init__(self, total, callback):
+        self._total = max(1, total)
+        self._done = 0
+        self._callback = callback
+        self._lock = threading.Lock()
+
+    def step(self, message):
+        with self._lock:
+            self._done += 1
+            done = self._done
+        if self._callback:
+            self._callback(done / self._total, message)
+
+
+def _profiles(uids):
+    """Returns {uid: profile dict} for the uids that have a 'users' document."""
+    profiles = {}
+    for chunk in _chunks(uids, CASCADE_CHUNK):
+        _throttle()
+        refs = [db.collection('users').document(uid) for uid in chunk]
+        profiles.update({snapshot.id: snapshot.to_dict() or {} for snapshot in db.get_all(refs) if snapshot.exists})
+    return profiles
+
+
+def _update_profiles(updates):
+    """Applies {uid: update dict} to 'users' documents in batches."""
+    for chunk in _chunks(list(updates.items()), CASCADE_CHUNK):
+        _throttle()
+        batch = db.batch()
+        for uid, update in chunk:
+            batch.update(db.collection('users').document(uid), {**update, 'updated_at': firestore.SERVER_TIMESTAMP})
+        batch.commit()
+
+
+def deactivate_users(uids, progress=None):
+    """
+    Disables the users' Auth accounts, signs them out everywhere and marks their
+    profiles inactive. Their data is kept.
+
+    Returns:
+        dict: The deactivated UIDs and {uid: error} for the rest.
+    """
+    tracker = _Progress(len(uids) + 1, progress)
+    errors = {}
+    lock = threading.Lock()
+
+    def deactivate(uid):
+        try:
+            _throttle()
+            auth.update_user(uid, disabled=True)
+            _throttle()
+            auth.revoke_refresh_tokens(uid)
+        except Exception as e:
+            with lock:
+                errors[uid] = str(e)
+        tracker.step(f"Deactivated {uid}")
+
+    # Auth has no batch update, so the accounts are updated in parallel.
+    with ThreadPoolExecutor(max_workers=CASCADE_WORKERS) as pool:
+        list(pool.map(bind(deactivate), uids))
+
+    done = [uid for uid in uids if uid not in errors]
+    existing = _profiles(done)
+    _update_profiles({uid: {'active': False, 'deactivated_at': firestore.SERVER_TIMESTAMP} for uid in existing})
+    tracker.step("Updated profiles")
+    inc("user_lifecycle_total", {"operation": "deactivate"}, len(done))
+    return {"message": f"Deactivated {len(done)} users.", "deactivated": done, "errors": errors}
+
+
+def _delete_shifts(uid):
+    """Deletes the user's shifts. Returns how many, and the locations they were at."""
+    deleted = 0
+    locations = set()
+    while True:
+        _throttle()
+        docs = list(db.collection('shifts').where('user_id', '==', uid).limit(CASCADE_CHUNK).stream())
+        if not docs:
+            return deleted, locations
+        _throttle()
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+            location = (doc.to_dict() or {}).get('location')
+            locations.add(location)
+            delta_sync.record_deletions('shifts', [doc.id], location, batch=batch)
+        batch.commit()
+        analytics_mirror.forget('shifts', [doc.id for doc in docs])
+        deleted += len(docs)
+
+
+def _remove_attendance_marks(uid):
+    removed = 0
+    # The first mark of a day is stored under the 'student_id' map (see take_attendance).
+    for field in ('student', 'student_id'):
+        while True:
+            _throttle()
+            # Ordering by the user's mark only returns the documents that have one.
+            docs = list(db.collection('attendance').order_by(f'{field}.{uid}.status').limit(CASCADE_CHUNK).stream())
+            if not docs:
+                break
+            _throttle()
+            batch = db.batch()
+            for doc in docs:
+                batch.update(doc.reference, {f'{field}.{uid}': firestore.DELETE_FIELD,
+                                             'updated_at': firestore.SERVER_TIMESTAMP})
+            batch.commit()
+            removed += len(docs)
+    return removed
+
+
+def _remove_from_sessions(uids):
+    """Removes the users from every online session's tutor list. Returns the sessions changed."""
+    uids = set(uids)
+    changed = 0
+    _throttle()
+    for session in db.collection('online_sessions').stream():
+        tutors = [tutor for tutor in (session.to_dict() or {}).get('tutors', []) if tutor.get('tutor_id') in uids]
+        if tutors:
+            _throttle()
+            session.reference.update({'tutors': firestore.ArrayRemove(tutors), 'updated_at': firestore.SERVER_TIMESTAMP})
+            changed += 1
+    return changed
+
+
+def delete_users(uids, progress=None):
+    """
+    Deletes the users' Auth accounts, profiles and dependent documents.
+
+    Returns:
+        dict: The deleted UIDs, counts of removed shifts, attendance marks and session
+        entries, and {uid: error} for users that could not be fully deleted.
+    """
+    tracker = _Progress(len(_chunks(uids, AUTH_BATCH_LIMIT)) + len(uids) + 1, progress)
+    errors = {}
+    lock = threading.Lock()
+
+    for chunk in _chunks(uids, AUTH_BATCH_LIMIT):
+        _throttle()
+        result = auth.delete_users(chunk)
+        for error in result.errors:
+            errors[chunk[error.index]] = error.reason
+        tracker.step(f"Deleted {result.success_count} Auth accounts")
+
+    # Users whose Auth account could not be deleted keep their data, so that nothing
+    # is left without an account or the other way round. (delete_users treats accounts
+    # that no longer exist as deleted.)
+    removable = [uid for uid in uids if uid not in errors]
+    counts = {"shifts": 0, "attendance_marks": 0}
+    changed_locations = set()
+
+    def cascade(uid):
+        try:
+            shifts, shift_locations = _delete_shifts(uid)
+            marks = _remove_attendance_marks(uid)
+            _throttle()
+            batch = db.batch()
+            batch.delete(db.collection('users').document(uid))
+            delta_sync.record_deletions('users', [uid], batch=batch)
+            batch.commit()
+            with lock:
+                counts["shifts"] += shifts
+                counts["attendance_marks"] += marks
+                changed_locations.update(shift_locations)
+        except Exception as e:
+            with lock:
+                errors[uid] = str(e)
+        tracker.step(f"Removed data for {uid}")
+
+    with ThreadPoolExecutor(max_workers=CASCADE_WORKERS) as pool:
+        # bind() keeps the pool's Firestore calls in the job's trace.
+        list(pool.map(bind(cascade), removable))
+
+    counts["sessions"] = _remove_from_sessions(removable)
+    tracker.step("Updated online sessions")
+    # The log sheets of the locations that lost shifts are rewritten in the background.
+    for location in changed_locations - {None}:
+        request_sync(location)
+    deleted = [uid for uid in uids if uid not in errors]
+    inc("user_lifecycle_total", {"operation": "delete"}, len(deleted))
+    return {"message": f"Deleted {len(deleted)} users.", "deleted": deleted, "removed": counts, "errors": errors}
+
+
+def reassign_location(uids, add=None, remove=None, progress=None):
+    """
+    Changes the users' tutoringLocation list: adds one location and/or removes one.
+
+    Args:
+        uids (list): The users to change.
+        add (str, optional): Location to add.
+        remove (str, optional): Location to remove, or "*" to remove all others.
+
+    Returns:
+        dict: The UIDs updated and {uid: error} for users without a profile.
+    """
+    profiles = _profiles(uids)
+    errors = {uid: "User not found." for uid in uids if uid not in profiles}
+    updates = {}
+    for uid, profile in profiles.items():
+        current = profile.get('tutoringLocation') or []
+        if remove == '*':
+            locations = []
+        else:
+            locations = [location for location in current if location != remove]
+        if add and add not in locations:
+            locations.append(add)
+        if locations != current:
+            updates[uid] = {'tutoringLocation': locations, 'location_updated_at': datetime.now().isoformat()}
+
+    tracker = _Progress(len(_chunks(list(updates), CASCADE_CHUNK)), progress)
+    for chunk in _chunks(list(updates.items()), CASCADE_CHUNK):
+        _update_profiles(dict(chunk))
+        tracker.step(f"Updated {len(chunk)} profiles")
+    inc("user_lifecycle_total", {"operation": "reassign"}, len(updates))
+    return {"message": f"Updated {len(updates)} users.", "updated": sorted(updates), "errors": errors}
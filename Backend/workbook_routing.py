@@ -0,0 +1,85 @@
+# workbook_routing.py
+
+"""
+This file decides which Google Sheets workbook holds each location's clock log tabs
+and 15-day summary tabs.
+
+By default every location shares "House of Wisdom Log" and "HOW-15-Day-Summary",
+as before. Giving each location its own workbook keeps a busy location from
+slowing down the others: writes to different workbooks run in parallel, and
+cleanup only has to list that location's tabs.
+
+Routing is configured with either or both of:
+- WORKBOOK_ROUTING_FILE: a JSON file such as
+      {"log": {"Everett": "House of Wisdom Log - Everett"},
+       "summary": {"Everett": "HOW-15-Day-Summary - Everett"}}
+- LOG_WORKBOOK_TEMPLATE / SUMMARY_WORKBOOK_TEMPLATE: a name with a {location}
+  placeholder, e.g. "House of Wisdom Log - {location}", used for every location
+  that is not listed in the file.
+
+Use migrate_workbooks.py to move existing tabs after changing the routing.
+"""
+
+import json
+import logging
+import os
+from dotenv import load_dotenv
+from locations import locations
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKBOOKS = {"log": "House of Wisdom Log", "summary": "HOW-15-Day-Summary"}
+TEMPLATES = {
+    "log": os.getenv("LOG_WORKBOOK_TEMPLATE"),
+    "summary": os.getenv("SUMMARY_WORKBOOK_TEMPLATE"),
+}
+
+_routes = None
+
+
+def _load_routes():
+    global _routes
+    if _routes is None:
+        _routes = {}
+        path = os.getenv("WORKBOOK_ROUTING_FILE")
+        if path:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    _routes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read workbook routing from {path}; using the shared workbooks: {e}")
+    return _routes
+
+
+def workbook_for(location, sheet_type="log"):
+    """
+    Returns the name of the workbook that holds a location's tabs.
+
+    Args:
+        location (str): The location name, as in locations.py.
+        sheet_type (str): "log" or "summary".
+
+    Returns:
+        str: The workbook name.
+    """
+    routed = _load_routes().get(sheet_type, {}).get(location)
+    if routed:
+        return routed
+    if TEMPLATES[sheet_type]:
+        return TEMPLATES[sheet_type].format(location=location)
+    return DEFAULT_WORKBOOKS[sheet_type]
+
+
+def log_workbook(location):
+    return workbook_for(location, "log")
+
+
+def summary_workbook(location):
+    return workbook_for(location, "summary")
+
+
+def all_workbooks(sheet_type="log"):
+    """Returns every distinct workbook used by the locations in locations.py, in order."""
+    return list(dict.fromkeys(workbook_for(location, sheet_type) for location in locations))